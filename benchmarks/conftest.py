@@ -0,0 +1,89 @@
+import tracemalloc
+
+import pytest
+
+from benchmarks.mock_pacs import MockArchive, MockDICOMQRPACS, MockHTTPPACS
+from dicomtrolleytool.cli.base import TrolleyToolContext
+from dicomtrolleytool.persistence import TrolleyToolSettings
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("mock pacs")
+    group.addoption(
+        "--mock-latency",
+        type=float,
+        default=0.0,
+        help="Milliseconds the mock PACS waits before answering each request",
+    )
+    group.addoption(
+        "--mock-instance-kb",
+        type=int,
+        default=256,
+        help="Size of each instance the mock PACS sends, in kilobytes",
+    )
+
+
+@pytest.fixture(scope="session")
+def a_mock_archive(request):
+    return MockArchive(
+        latency=request.config.getoption("--mock-latency") / 1000,
+        instance_size=request.config.getoption("--mock-instance-kb") * 1024,
+    )
+
+
+@pytest.fixture(scope="session")
+def a_mock_http_pacs(a_mock_archive):
+    with MockHTTPPACS(a_mock_archive) as pacs:
+        yield pacs
+
+
+@pytest.fixture(scope="session")
+def a_mock_dicom_qr_pacs(a_mock_archive):
+    with MockDICOMQRPACS(a_mock_archive) as pacs:
+        yield pacs
+
+
+@pytest.fixture
+def a_context():
+    """Context as used by trolley commands, without session cache. Searchers and
+    downloaders created with it get the tool's own sessions, retries, throttling
+    and association pools, so those are measured too
+    """
+    return TrolleyToolContext(
+        settings=TrolleyToolSettings(
+            searcher_name="mock", downloader_name="mock", session_cache=False
+        )
+    )
+
+
+@pytest.fixture
+def record_rate(benchmark):
+    """Store amount per second of the mean benchmark round in the benchmark's
+    extra info, so it is saved and compared along with the timings
+    """
+
+    def record(amount: float, unit: str):
+        benchmark.extra_info[unit] = amount
+        if benchmark.stats:  # None when run with --benchmark-disable
+            benchmark.extra_info[f"{unit}/s"] = amount / benchmark.stats.stats.mean
+
+    return record
+
+
+@pytest.fixture
+def record_peak_memory(benchmark):
+    """Run a function once more under tracemalloc and store its peak memory use in
+    the benchmark's extra info. Kept out of the timed rounds, as tracing slows
+    down allocation
+    """
+
+    def record(function, *args, **kwargs):
+        tracemalloc.start()
+        try:
+            function(*args, **kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        benchmark.extra_info["peak_memory_KB"] = round(peak / 1024, 1)
+
+    return record
@@ -0,0 +1,382 @@
+"""A local stand-in for a PACS, for benchmarking. Serves the same generated
+archive over MINT, QIDO-RS, WADO-RS, rad69 and DICOM-QR C-FIND.
+
+Latency and instance size are configurable so that the cost of the tool itself
+can be separated from the cost of waiting for a server.
+"""
+import json
+import re
+import socket
+import threading
+import time
+from dataclasses import dataclass
+from functools import cached_property
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Dict, Iterator, List, Optional
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import quoteattr
+
+from pydicom import Dataset
+from pydicom.dataset import FileMetaDataset
+from pydicom.multival import MultiValue
+from pydicom.uid import ExplicitVRLittleEndian, SecondaryCaptureImageStorage
+
+UID_ROOT = "1.2.826.0.1.3680043.10.1"
+MINT_NAMESPACE = "http://medical.nema.org/mint"
+BOUNDARY = "mock-pacs-boundary"
+
+# Elements per level. These are what find_studies results are made of
+STUDY_KEYWORDS = [
+    "StudyInstanceUID",
+    "AccessionNumber",
+    "PatientID",
+    "PatientName",
+    "StudyDate",
+    "StudyDescription",
+    "ModalitiesInStudy",
+    "NumberOfStudyRelatedInstances",
+]
+SERIES_KEYWORDS = ["SeriesInstanceUID", "Modality", "SeriesNumber", "SeriesDescription"]
+INSTANCE_KEYWORDS = ["SOPInstanceUID", "SOPClassUID", "InstanceNumber"]
+
+
+@dataclass
+class MockArchive:
+    """Generated content of a mock PACS.
+
+    Every study has the same number of series and every series the same number
+    of instances. Object i at any level has UID '<parent uid>.<i>'
+    """
+
+    studies: int = 100
+    series_per_study: int = 4
+    instances_per_series: int = 20
+    instance_size: int = 256 * 1024  # bytes of pixel data per instance
+    latency: float = 0.0  # seconds to wait before answering each request
+
+    def study_uid(self, study: int) -> str:
+        return f"{UID_ROOT}.{study}"
+
+    def study(self, study: int) -> Dataset:
+        ds = Dataset()
+        ds.StudyInstanceUID = self.study_uid(study)
+        ds.AccessionNumber = f"ACC{study:06d}"
+        ds.PatientID = f"PAT{study % 1000:04d}"
+        ds.PatientName = f"Patient^{study % 1000:04d}"
+        ds.StudyDate = f"2023{(study % 12) + 1:02d}{(study % 28) + 1:02d}"
+        ds.StudyDescription = "Mock study"
+        ds.ModalitiesInStudy = ["CT", "SR"]
+        ds.NumberOfStudyRelatedInstances = (
+            self.series_per_study * self.instances_per_series
+        )
+        return ds
+
+    def series(self, study: int, series: int) -> Dataset:
+        ds = Dataset()
+        ds.SeriesInstanceUID = f"{self.study_uid(study)}.{series}"
+        ds.Modality = "CT"
+        ds.SeriesNumber = series
+        ds.SeriesDescription = f"Mock series {series}"
+        return ds
+
+    def instance(self, study: int, series: int, instance: int) -> Dataset:
+        ds = Dataset()
+        ds.SOPInstanceUID = f"{self.study_uid(study)}.{series}.{instance}"
+        ds.SOPClassUID = SecondaryCaptureImageStorage
+        ds.InstanceNumber = instance
+        return ds
+
+    def find(
+        self,
+        level: str,
+        study_uid: Optional[str] = None,
+        series_uid: Optional[str] = None,
+        accession_number: Optional[str] = None,
+    ) -> Iterator[Dataset]:
+        """Flat datasets at level 'STUDY', 'SERIES' or 'IMAGE' matching the given
+        values, each including all higher level elements like a C-FIND response.
+        Empty values and '*' match anything
+        """
+        for study in range(self.studies):
+            study_ds = self.study(study)
+            if not matches(study_ds.StudyInstanceUID, study_uid) or not matches(
+                study_ds.AccessionNumber, accession_number
+            ):
+                continue
+            if level == "STUDY":
+                yield study_ds
+                continue
+            for series in range(self.series_per_study):
+                series_ds = self.series(study, series)
+                if not matches(series_ds.SeriesInstanceUID, series_uid):
+                    continue
+                series_ds.update(study_ds)
+                if level == "SERIES":
+                    yield series_ds
+                    continue
+                for instance in range(self.instances_per_series):
+                    instance_ds = self.instance(study, series, instance)
+                    instance_ds.update(series_ds)
+                    yield instance_ds
+
+    @cached_property
+    def instance_bytes(self) -> bytes:
+        """A DICOM file of about instance_size. The same for every instance, as
+        downloaders do not care
+        """
+        ds = self.instance(0, 0, 0)
+        ds.update(self.series(0, 0))
+        ds.update(self.study(0))
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        ds.Rows, ds.Columns = max(self.instance_size // 1024, 1), 512
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 16, 15
+        ds.SamplesPerPixel, ds.PixelRepresentation = 1, 0
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.PixelData = bytes(ds.Rows * ds.Columns * 2)
+        buffer = BytesIO()
+        ds.save_as(buffer, enforce_file_format=True)
+        return buffer.getvalue()
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+
+def matches(value: str, search: Optional[str]) -> bool:
+    return not search or search == "*" or value == search
+
+
+def multipart(parts: List[bytes], content_type: str) -> bytes:
+    """Parts as multipart/related body, separated by BOUNDARY"""
+    body = BytesIO()
+    for part in parts:
+        body.write(f"--{BOUNDARY}\r\nContent-Type: {content_type}\r\n\r\n".encode())
+        body.write(part)
+        body.write(b"\r\n")
+    body.write(f"--{BOUNDARY}--\r\n".encode())
+    return body.getvalue()
+
+
+def mint_attributes(ds: Dataset, keywords: List[str]) -> str:
+    return "".join(
+        f'<attr tag="{ds[x].tag:08x}" vr="{ds[x].VR}" '
+        f"val={quoteattr(mint_value(ds[x].value))}/>"
+        for x in keywords
+    )
+
+
+def mint_value(value) -> str:
+    if isinstance(value, MultiValue):
+        return "\\".join(str(x) for x in value)
+    return str(value)
+
+
+def mint_response(archive: MockArchive, params: Dict[str, str]) -> bytes:
+    """MINT study search results. Nested down to the requested level"""
+    level = {"STUDY": 0, "SERIES": 1, "INSTANCE": 2}[params.get("QueryLevel", "STUDY")]
+    studies = []
+    for study in archive.find(
+        "STUDY",
+        study_uid=params.get("StudyInstanceUID"),
+        accession_number=params.get("AccessionNumber"),
+    ):
+        index = int(study.StudyInstanceUID.split(".")[-1])
+        series_xml = ""
+        for series in range(archive.series_per_study if level > 0 else 0):
+            if not matches(
+                f"{study.StudyInstanceUID}.{series}", params.get("SeriesInstanceUID")
+            ):
+                continue
+            instance_xml = "".join(
+                "<instance>"
+                + mint_attributes(archive.instance(index, series, x), INSTANCE_KEYWORDS)
+                + "</instance>"
+                for x in range(archive.instances_per_series if level > 1 else 0)
+            )
+            series_xml += (
+                "<series>"
+                + mint_attributes(archive.series(index, series), SERIES_KEYWORDS)
+                + instance_xml
+                + "</series>"
+            )
+        studies.append(
+            f'<study studyUUID="{index}" lastModified="2023-01-01T00:00:00.000Z">'
+            + mint_attributes(study, STUDY_KEYWORDS)
+            + series_xml
+            + "</study>"
+        )
+    return (
+        f'<studySearchResults xmlns="{MINT_NAMESPACE}">'
+        + "".join(studies)
+        + "</studySearchResults>"
+    ).encode()
+
+
+class MockPACSHandler(BaseHTTPRequestHandler):
+    """Routes requests to the MINT, QIDO-RS, WADO-RS and rad69 endpoints and a
+    Vitrea-like login
+    """
+
+    protocol_version = "HTTP/1.1"  # keep-alive, like a real server
+    archive: MockArchive  # set on subclass by MockHTTPPACS
+
+    def setup(self):
+        super().setup()
+        # Send small responses right away instead of waiting for an ACK
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):  # noqa: A002
+        pass  # keep benchmark output clean
+
+    def send_body(self, body: bytes, content_type: str, status: int = 200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):  # noqa: N802
+        self.archive.wait()
+        url = urlparse(self.path)
+        params = {x: y[0] for x, y in parse_qs(url.query).items()}
+        if url.path.startswith("/mint/studies"):
+            self.send_body(mint_response(self.archive, params), "application/xml")
+        elif url.path.startswith("/qido/"):
+            self.handle_qido(url.path, params)
+        elif url.path.startswith("/wado/"):
+            self.handle_wado(url.path)
+        else:
+            self.send_body(b"not found", "text/plain", status=404)
+
+    def do_POST(self):  # noqa: N802
+        self.archive.wait()
+        request = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.startswith("/login"):
+            self.send_response(200)
+            self.send_header("Set-Cookie", "session=mock; Path=/")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path.startswith("/rad69"):
+            count = request.count(b"DocumentUniqueId>") // 2  # open and close tags
+            soap = b'<?xml version="1.0" encoding="UTF-8"?><Envelope/>'
+            body = multipart(
+                [soap] + [self.archive.instance_bytes] * count, "application/dicom"
+            )
+            self.send_body(
+                body,
+                f'multipart/related; type="application/xop+xml"; '
+                f"boundary={BOUNDARY}",
+            )
+        else:
+            self.send_body(b"not found", "text/plain", status=404)
+
+    def handle_qido(self, path: str, params: Dict[str, str]):
+        """DICOM JSON for /studies, /series, /instances and those same levels
+        under /studies/{uid} and /studies/{uid}/series/{uid}
+        """
+        found = re.match(
+            r"/qido/(?:studies/(?P<study>[^/]+)/)?(?:series/(?P<series>[^/]+)/)?"
+            r"(?P<level>studies|series|instances)$",
+            path,
+        )
+        if not found:
+            self.send_body(b"not found", "text/plain", status=404)
+            return
+        level = {"studies": "STUDY", "series": "SERIES", "instances": "IMAGE"}[
+            found["level"]
+        ]
+        datasets = self.archive.find(
+            level,
+            study_uid=found["study"] or params.get("StudyInstanceUID"),
+            series_uid=found["series"] or params.get("SeriesInstanceUID"),
+            accession_number=params.get("AccessionNumber"),
+        )
+        body = json.dumps([x.to_json_dict() for x in datasets]).encode()
+        self.send_body(body, "application/dicom+json")
+
+    def handle_wado(self, path: str):
+        """All instances in /studies/{uid}/series/{uid}, or a single one if path
+        ends in /instances/{uid}
+        """
+        found = re.match(
+            r"/wado/studies/[^/]+/series/[^/]+(?P<instance>/instances/[^/]+)?$", path
+        )
+        if not found:
+            self.send_body(b"not found", "text/plain", status=404)
+            return
+        count = 1 if found["instance"] else self.archive.instances_per_series
+        body = multipart([self.archive.instance_bytes] * count, "application/dicom")
+        self.send_body(
+            body, f'multipart/related; type="application/dicom"; boundary={BOUNDARY}'
+        )
+
+
+class MockHTTPPACS:
+    """Serves a MockArchive over http on localhost, in a background thread.
+
+    Endpoints: {url}/mint, {url}/qido, {url}/wado, {url}/rad69 and {url}/login
+    """
+
+    def __init__(self, archive: MockArchive):
+        handler = type("Handler", (MockPACSHandler,), {"archive": archive})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MockDICOMQRPACS:
+    """Answers DICOM-QR C-FIND on the study root model, on localhost"""
+
+    def __init__(self, archive: MockArchive, ae_title: str = "MOCKPACS"):
+        self.archive = archive
+        self.ae_title = ae_title
+        self.server = None
+
+    def handle_find(self, event):
+        self.archive.wait()
+        identifier = event.identifier
+        for ds in self.archive.find(
+            identifier.QueryRetrieveLevel,
+            study_uid=identifier.get("StudyInstanceUID"),
+            series_uid=identifier.get("SeriesInstanceUID"),
+            accession_number=identifier.get("AccessionNumber"),
+        ):
+            ds.QueryRetrieveLevel = identifier.QueryRetrieveLevel
+            yield 0xFF00, ds  # pending, more to come
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def __enter__(self):
+        from pynetdicom import AE, evt
+        from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind
+
+        ae = AE(ae_title=self.ae_title)
+        ae.add_supported_context(StudyRootQueryRetrieveInformationModelFind)
+        self.server = ae.start_server(
+            ("127.0.0.1", 0),
+            block=False,
+            evt_handlers=[(evt.EVT_C_FIND, self.handle_find)],
+        )
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
@@ -0,0 +1,25 @@
+"""Time to start the trolley command. Paid on every call from a script. Runs the
+same launcher as the installed trolley script, including the check for a daemon
+"""
+import subprocess
+import sys
+
+import pytest
+
+
+@pytest.mark.parametrize("args", [["--help"], ["query", "--help"]])
+def test_cli_startup(benchmark, args):
+    command = [
+        sys.executable,
+        "-c",
+        "from dicomtrolleytool.cli.launcher import main; main()",
+        *args,
+    ]
+    result = benchmark.pedantic(
+        subprocess.run,
+        args=(command,),
+        kwargs={"capture_output": True, "check": True},
+        rounds=10,
+        warmup_rounds=1,
+    )
+    assert b"Usage" in result.stdout
@@ -0,0 +1,57 @@
+"""Download speed per downloader channel type, against the mock PACS"""
+import pytest
+from dicomtrolley.parsing import DICOMParseTree
+
+from dicomtrolleytool.channels import DICOMWebChannel, Rad69Channel
+
+
+@pytest.fixture(params=["wado_rs", "rad69"])
+def a_downloader(request, a_context, a_mock_http_pacs):
+    if request.param == "wado_rs":
+        channel = DICOMWebChannel(
+            key="mock",
+            dicom_web_url=a_mock_http_pacs.url + "/wado",
+            user="user",
+            password="password",
+        )
+    else:
+        channel = Rad69Channel(
+            key="mock",
+            login_url=a_mock_http_pacs.url + "/login",
+            rad69_url=a_mock_http_pacs.url + "/rad69",
+            user="user",
+            password="password",
+            realm="realm",
+        )
+    return a_context.create_downloader(channel)
+
+
+@pytest.fixture
+def a_series(a_mock_archive):
+    """First series of the archive, with all its instances"""
+    tree = DICOMParseTree()
+    for ds in a_mock_archive.find(
+        "IMAGE", series_uid=a_mock_archive.study_uid(0) + ".0"
+    ):
+        tree.insert_dataset(ds)
+    return tree.as_studies()[0].series[0]
+
+
+def test_download_series(
+    benchmark, record_rate, a_downloader, a_series, a_mock_archive
+):
+    def download():
+        return sum(1 for _ in a_downloader.datasets([a_series]))
+
+    count = benchmark(download)
+    assert count == a_mock_archive.instances_per_series
+    record_rate(count * len(a_mock_archive.instance_bytes) / 1e6, "MB")
+
+
+def test_download_single_instance(benchmark, a_downloader, a_series):
+    """Latency of fetching one instance, where per-request overhead dominates"""
+
+    def download():
+        return list(a_downloader.datasets([a_series.instances[0]]))
+
+    assert len(benchmark(download)) == 1
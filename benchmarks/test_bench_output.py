@@ -0,0 +1,147 @@
+"""Formatting speed of query results, in rows per second, and peak memory use.
+No server involved
+"""
+from io import StringIO
+
+import pytest
+from dicomtrolley.core import Query
+from dicomtrolley.parsing import DICOMParseTree
+
+from benchmarks.mock_pacs import (
+    INSTANCE_KEYWORDS,
+    SERIES_KEYWORDS,
+    STUDY_KEYWORDS,
+    MockArchive,
+)
+from dicomtrolleytool.cli.export import write_query_results_arrow
+from dicomtrolleytool.cli.output import (
+    FormatLevel,
+    ResultFormat,
+    query_results_to_table,
+    write_query_results,
+)
+from dicomtrolleytool.query import QueryStudyResult
+
+FIELDS = STUDY_KEYWORDS + SERIES_KEYWORDS + INSTANCE_KEYWORDS
+
+
+def instance_level_results(archive: MockArchive):
+    """A result per study of archive, down to instance level"""
+    tree = DICOMParseTree()
+    for ds in archive.find("IMAGE"):
+        tree.insert_dataset(ds)
+    return [
+        QueryStudyResult(x, Query(StudyInstanceUID=x.uid)) for x in tree.as_studies()
+    ]
+
+
+def row_count(results, format_level: FormatLevel) -> int:
+    if format_level == FormatLevel.STUDY:
+        return len(results)
+    if format_level == FormatLevel.SERIES:
+        return sum(len(x.content.series) for x in results)
+    return sum(len(x.content.all_instances()) for x in results)
+
+
+@pytest.fixture(scope="module")
+def some_instance_level_results(a_mock_archive):
+    return instance_level_results(a_mock_archive)
+
+
+@pytest.fixture(scope="module")
+def a_large_result_set():
+    """10 studies x 10 series x 100 instances: 10,000 instance rows"""
+    return instance_level_results(
+        MockArchive(studies=10, series_per_study=10, instances_per_series=100)
+    )
+
+
+@pytest.mark.parametrize(
+    "output_format",
+    [ResultFormat.TABLE, ResultFormat.CSV, ResultFormat.JSONL, ResultFormat.RAW],
+)
+def test_write_instance_rows(
+    benchmark, record_rate, some_instance_level_results, output_format
+):
+    def write():
+        stream = StringIO()
+        write_query_results(
+            some_instance_level_results,
+            stream,
+            output_format=output_format,
+            include_fields=FIELDS,
+            format_level=FormatLevel.INSTANCE,
+        )
+        return stream
+
+    benchmark(write)
+    record_rate(
+        sum(len(x.content.all_instances()) for x in some_instance_level_results),
+        "rows",
+    )
+
+
+@pytest.mark.parametrize("format_level", list(FormatLevel))
+def test_build_table(
+    benchmark, record_rate, record_peak_memory, a_large_result_set, format_level
+):
+    """Building the table behind TABLE, GITHUB and non-streaming CSV output"""
+    table = benchmark(query_results_to_table, a_large_result_set, None, format_level)
+    rows = row_count(a_large_result_set, format_level)
+    assert all(len(x) == rows for x in table.values())
+    record_rate(rows, "rows")
+    record_peak_memory(query_results_to_table, a_large_result_set, None, format_level)
+
+
+@pytest.mark.parametrize("output_format", [ResultFormat.CSV, ResultFormat.JSONL])
+@pytest.mark.parametrize("format_level", list(FormatLevel))
+def test_write_streaming(
+    benchmark,
+    record_rate,
+    record_peak_memory,
+    a_large_result_set,
+    output_format,
+    format_level,
+):
+    """Streaming text writers. Peak memory should not grow with row count"""
+
+    def write():
+        write_query_results(
+            a_large_result_set,
+            StringIO(),
+            output_format=output_format,
+            include_fields=FIELDS,
+            format_level=format_level,
+        )
+
+    benchmark(write)
+    record_rate(row_count(a_large_result_set, format_level), "rows")
+    record_peak_memory(write)
+
+
+@pytest.mark.parametrize("output_format", [ResultFormat.ARROW, ResultFormat.PARQUET])
+@pytest.mark.parametrize("format_level", list(FormatLevel))
+def test_write_arrow(
+    benchmark,
+    record_rate,
+    record_peak_memory,
+    a_large_result_set,
+    tmp_path,
+    output_format,
+    format_level,
+):
+    pytest.importorskip("pyarrow")
+    path = tmp_path / "results"
+
+    def write():
+        write_query_results_arrow(
+            a_large_result_set,
+            path,
+            fields=FIELDS,
+            output_format=output_format,
+            format_level=format_level,
+        )
+
+    benchmark(write)
+    record_rate(row_count(a_large_result_set, format_level), "rows")
+    record_peak_memory(write)
@@ -0,0 +1,62 @@
+"""Query throughput per searcher channel type, against the mock PACS"""
+import pytest
+from dicomtrolley.core import Query, QueryLevels
+
+from dicomtrolleytool.channels import DICOMQRChannel, DICOMWebChannel, MintChannel
+
+
+@pytest.fixture(params=["mint", "qido_rs", "dicom_qr", "dicom_qr_pooled"])
+def a_searcher(request, a_context, a_mock_http_pacs, a_mock_dicom_qr_pacs):
+    if request.param == "mint":
+        channel = MintChannel(
+            key="mock",
+            login_url=a_mock_http_pacs.url + "/login",
+            mint_url=a_mock_http_pacs.url + "/mint",
+            user="user",
+            password="password",
+            realm="realm",
+        )
+    elif request.param == "qido_rs":
+        channel = DICOMWebChannel(
+            key="mock",
+            dicom_web_url=a_mock_http_pacs.url + "/qido",
+            user="user",
+            password="password",
+        )
+    else:
+        channel = DICOMQRChannel(
+            key="mock",
+            host="127.0.0.1",
+            port=str(a_mock_dicom_qr_pacs.port),
+            aet="TROLLEY",
+            aec=a_mock_dicom_qr_pacs.ae_title,
+            reuse_associations=request.param == "dicom_qr_pooled",
+        )
+    return a_context.create_searcher(channel)
+
+
+def test_find_all_studies(benchmark, record_rate, a_searcher, a_mock_archive):
+    studies = benchmark(a_searcher.find_studies, Query(query_level=QueryLevels.STUDY))
+    assert len(studies) == a_mock_archive.studies
+    record_rate(len(studies), "studies")
+
+
+def test_find_instances_of_series(benchmark, record_rate, a_searcher, a_mock_archive):
+    query = Query(
+        StudyInstanceUID=a_mock_archive.study_uid(0),
+        SeriesInstanceUID=a_mock_archive.study_uid(0) + ".0",
+        query_level=QueryLevels.INSTANCE,
+    )
+    studies = benchmark(a_searcher.find_studies, query)
+    instances = studies[0].all_instances()
+    assert len(instances) == a_mock_archive.instances_per_series
+    record_rate(len(instances), "instances")
+
+
+def test_find_by_accession_number(benchmark, a_searcher):
+    """Latency of the single small query that most trolley calls run"""
+    studies = benchmark(
+        a_searcher.find_studies,
+        Query(AccessionNumber="ACC000042", query_level=QueryLevels.STUDY),
+    )
+    assert len(studies) == 1
@@ -0,0 +1,232 @@
+"""DICOM QR with reused associations
+
+dicomtrolley DICOMQR opens a new association for each C-FIND and releases it
+afterwards. For servers where setting up an association is slow, this takes
+longer than the query itself. An AssociationPool keeps a few associations open
+and runs C-FINDs on them one after the other. Several associations can be used at
+the same time for parallel queries.
+"""
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+from dicomtrolley.dicom_qr import DICOMQR, DICOMQuery
+from pydicom import Dataset
+from pynetdicom import AE, debug_logger
+from pynetdicom.association import Association
+from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind
+
+from dicomtrolleytool.logs import get_module_logger
+from dicomtrolleytool.retry import AssociationError
+
+logger = get_module_logger("associations")
+
+
+class AssociationPool:
+    """Keeps associations to a DICOM server open for reuse. Safe to use from
+    several threads.
+
+    Associations not used for idle_timeout seconds are released. Associations
+    that were aborted or dropped by the server are replaced with new ones.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        aet: str,
+        aec: str,
+        max_size: int = 4,
+        idle_timeout: float = 60.0,
+        timeout: Optional[float] = 30.0,
+    ):
+        """
+
+        Parameters
+        ----------
+        host:
+            Hostname of DICOM QR server
+        port:
+            Port of DICOM QR server
+        aet:
+            Calling application entity title. This side
+        aec:
+            Called application entity title. The server
+        max_size:
+            Never have more than this many associations open. Queries wait for a
+            free association
+        idle_timeout:
+            Release associations that were not used for this many seconds
+        timeout:
+            Seconds to wait for association setup and for each response from the
+            server. None means wait forever
+        """
+        self.host = host
+        self.port = port
+        self.aec = aec
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.ae = AE(ae_title=aet)
+        self.ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)
+        self.ae.acse_timeout = timeout
+        self.ae.dimse_timeout = timeout
+        self.ae.network_timeout = timeout
+        self.associations_opened = 0
+        self._idle: List[Tuple[Association, float]] = []  # with time last used
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._reaper: Optional[threading.Thread] = None
+        self._closed = threading.Event()
+        atexit.register(self.close)
+
+    def __str__(self):
+        return f"AssociationPool {self.aec}@{self.host}:{self.port}"
+
+    @contextmanager
+    def association(self, fresh: bool = False) -> Iterator[Tuple[Association, bool]]:
+        """An established association, for the duration of this context. Put back
+        in the pool afterwards if it is still established
+
+        Parameters
+        ----------
+        fresh:
+            Always open a new association, instead of reusing one
+
+        Returns
+        -------
+        Tuple[Association, bool]
+            The association and whether it was reused
+
+        Raises
+        ------
+        AssociationError
+            If no association could be established
+        """
+        with self._slots:
+            association = None if fresh else self._take_idle()
+            reused = association is not None
+            if association is None:
+                association = self._associate()
+            try:
+                yield association, reused
+            except BaseException:
+                association.abort()  # state unknown. Do not reuse
+                raise
+            self._put_idle(association)
+
+    def _take_idle(self) -> Optional[Association]:
+        """Most recently used idle association that is still established"""
+        with self._lock:
+            while self._idle:
+                association, _ = self._idle.pop()
+                if association.is_established:
+                    return association
+        return None
+
+    def _put_idle(self, association: Association):
+        if not association.is_established:
+            return
+        with self._lock:
+            self._idle.append((association, time.monotonic()))
+            if self._reaper is None:
+                self._reaper = threading.Thread(
+                    target=self._reap, name="association-reaper", daemon=True
+                )
+                self._reaper.start()
+
+    def _associate(self) -> Association:
+        association = self.ae.associate(self.host, self.port, ae_title=self.aec)
+        if not association.is_established:
+            raise AssociationError(
+                f"Association with {self.aec}@{self.host}:{self.port} rejected, "
+                f"aborted or never connected"
+            )
+        self.associations_opened += 1
+        logger.debug(f"Opened association {self.associations_opened} with {self}")
+        return association
+
+    def _reap(self):
+        """Release idle associations after idle_timeout, until closed"""
+        while not self._closed.wait(max(self.idle_timeout / 4, 0.01)):
+            self.release_idle(older_than=self.idle_timeout)
+
+    def release_idle(self, older_than: float = 0.0):
+        """Release associations that have not been used for older_than seconds"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [x for x, used in self._idle if now - used >= older_than]
+            self._idle = [
+                (x, used) for x, used in self._idle if now - used < older_than
+            ]
+        for association in expired:
+            if association.is_established:
+                association.release()
+
+    def close(self):
+        """Release all idle associations and stop releasing them after idle
+        timeout. Associations in use are released when put back
+        """
+        self._closed.set()
+        self.release_idle()
+
+
+class PooledDICOMQR(DICOMQR):
+    """DICOMQR that runs C-FINDs on reused associations from an AssociationPool"""
+
+    def __init__(self, pool: AssociationPool, debug: bool = False):
+        super().__init__(
+            host=pool.host,
+            port=pool.port,
+            aet=pool.ae.ae_title,
+            aec=pool.aec,
+            debug=debug,
+        )
+        self.pool = pool
+
+    def send_c_find(self, query: DICOMQuery) -> List[Dataset]:
+        """Perform a C-FIND on a pooled association. If a reused association turns
+        out to be dropped by the server, try once more on a new one
+
+        Raises
+        ------
+        AssociationError
+            When finding fails because of the association
+        """
+        if self.debug:
+            debug_logger()
+        dataset = query.as_dataset()
+        with self.pool.association() as (association, reused):
+            responses = self.c_find(association, dataset)
+            if responses is None:
+                association.abort()  # do not put back in pool
+        if responses is None and reused:
+            logger.debug("Reused association was dropped. Opening a new one")
+            with self.pool.association(fresh=True) as (association, _):
+                responses = self.c_find(association, dataset)
+        if responses is None:
+            raise AssociationError(
+                "Connection timed out, was aborted or received invalid response"
+            )
+        return responses
+
+    @staticmethod
+    def c_find(association: Association, dataset: Dataset) -> Optional[List[Dataset]]:
+        """Send C-FIND and collect all matches. None if the association failed
+        before any match came in
+        """
+        responses: List[Dataset] = []
+        for status, identifier in association.send_c_find(
+            dataset, StudyRootQueryRetrieveInformationModelFind
+        ):
+            if not status:
+                if responses:
+                    raise AssociationError(
+                        "Connection timed out, was aborted or received invalid "
+                        "response"
+                    )
+                return None
+            if identifier:
+                responses.append(identifier)
+        return responses
@@ -0,0 +1,294 @@
+"""Caching query results on disk to avoid repeated calls to server"""
+import json
+import pathlib
+import sqlite3
+import time
+import zlib
+from contextlib import closing
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence
+
+from dicomtrolley.core import Query, Searcher, Study
+from pydantic.main import BaseModel
+
+from dicomtrolleytool.federation import is_partial
+from dicomtrolleytool.logs import get_module_logger
+from dicomtrolleytool.query import (
+    QueryResult,
+    QueryStudyResult,
+    iter_stored_or_run,
+    query_key,
+)
+from dicomtrolleytool.serialization import (
+    SerializationError,
+    studies_from_list,
+    studies_to_list,
+)
+from dicomtrolleytool.wrappers import SearcherWrapper
+
+logger = get_module_logger("cache")
+
+DEFAULT_CACHE_PATH = pathlib.Path.home() / ".trolleytool" / "query_cache.sqlite"
+
+
+class CacheStats(BaseModel):
+    """Information on the contents and use of a query cache"""
+
+    entries: int
+    size: int  # in bytes
+    hits: int
+    misses: int
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class QueryCache:
+    """Stores query results in a sqlite database on disk
+
+    Entries expire after max_age seconds. When the total size of all entries
+    exceeds max_size, the least recently used entries are removed.
+
+    Notes
+    -----
+    Each operation opens its own connection. This makes the cache safe to use
+    from several threads and processes at the same time.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path = DEFAULT_CACHE_PATH,
+        max_age: Optional[int] = 86400,
+        max_size: int = 100 * 1024 * 1024,
+    ):
+        """
+
+        Parameters
+        ----------
+        path:
+            Path to sqlite database file. Created if it does not exist
+        max_age:
+            Entries older than this many seconds are not returned. Set to None to
+            never expire entries. Defaults to 86400 (one day)
+        max_size:
+            Maximum total size of stored entries in bytes. Defaults to 100MB
+        """
+        self.path = pathlib.Path(path)
+        self.max_age = max_age
+        self.max_size = max_size
+        self._initialized = False
+
+    def __str__(self):
+        return f"QueryCache at '{self.path}'"
+
+    def connect(self) -> sqlite3.Connection:
+        if not self._initialized:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(str(self.path), timeout=30)
+        if not self._initialized:
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, "
+                    "created REAL, accessed REAL, size INTEGER, value BLOB)"
+                )
+                connection.execute(
+                    "CREATE INDEX IF NOT EXISTS entries_accessed ON entries(accessed)"
+                )
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, "
+                    "value INTEGER)"
+                )
+            self._initialized = True
+        return connection
+
+    def get(self, key: str, max_age: Optional[int] = None) -> Optional[List[Study]]:
+        """Get studies stored under key
+
+        Parameters
+        ----------
+        key:
+            Cache key, as created by query_key()
+        max_age:
+            Only return entries younger than this many seconds. Defaults to the
+            max_age of this cache
+
+        Returns
+        -------
+        Optional[List[Study]]
+            The cached studies, or None if not found, expired or unreadable
+        """
+        if max_age is None:
+            max_age = self.max_age
+        now = time.time()
+        with closing(self.connect()) as connection, connection:
+            row = connection.execute(
+                "SELECT created, value FROM entries WHERE key=?", (key,)
+            ).fetchone()
+            if row and (max_age is None or now - row[0] <= max_age):
+                connection.execute(
+                    "UPDATE entries SET accessed=? WHERE key=?", (now, key)
+                )
+                self._count(connection, "hits")
+                value = row[1]
+            else:
+                self._count(connection, "misses")
+                return None
+        try:
+            return studies_from_list(json.loads(zlib.decompress(value)))
+        except (SerializationError, zlib.error, ValueError) as e:
+            logger.warning(f"Could not read cached entry {key}: {e}. Ignoring")
+            return None
+
+    def put(self, key: str, studies: Sequence[Study]):
+        """Store studies under key. Removes least recently used entries if
+        cache is full.
+        """
+        try:
+            value = zlib.compress(json.dumps(studies_to_list(studies)).encode())
+        except SerializationError as e:
+            logger.warning(f"Could not cache query result: {e}")
+            return
+        now = time.time()
+        with closing(self.connect()) as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (key, now, now, len(value), value),
+            )
+            self._evict(connection)
+
+    def _evict(self, connection: sqlite3.Connection):
+        """Remove least recently used entries until total size is below max"""
+        total = connection.execute("SELECT SUM(size) FROM entries").fetchone()[0]
+        if not total or total <= self.max_size:
+            return
+        to_remove = []
+        for key, size in connection.execute(
+            "SELECT key, size FROM entries ORDER BY accessed"
+        ):
+            if total <= self.max_size:
+                break
+            to_remove.append((key,))
+            total -= size
+        logger.debug(f"Cache full. Evicting {len(to_remove)} entries")
+        connection.executemany("DELETE FROM entries WHERE key=?", to_remove)
+
+    @staticmethod
+    def _count(connection: sqlite3.Connection, name: str):
+        connection.execute(
+            "INSERT INTO stats VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET value=value+1",
+            (name,),
+        )
+
+    def stats(self) -> CacheStats:
+        with closing(self.connect()) as connection:
+            entries, size = connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+            counts = dict(connection.execute("SELECT name, value FROM stats"))
+        return CacheStats(
+            entries=entries,
+            size=size,
+            hits=counts.get("hits", 0),
+            misses=counts.get("misses", 0),
+        )
+
+    def clear(self):
+        """Remove all entries and reset statistics"""
+        with closing(self.connect()) as connection, connection:
+            connection.execute("DELETE FROM entries")
+            connection.execute("DELETE FROM stats")
+        with closing(self.connect()) as connection:
+            connection.execute("VACUUM")
+
+
+class CachedSearcher(SearcherWrapper):
+    """Searcher that returns results from a QueryCache if possible"""
+
+    def __init__(
+        self,
+        searcher: Searcher,
+        cache: QueryCache,
+        channel_key: str,
+        max_age: Optional[int] = None,
+    ):
+        """
+
+        Parameters
+        ----------
+        searcher:
+            Search with this if result is not in cache
+        cache:
+            Cache to get results from and store results in
+        channel_key:
+            Key of the channel searcher belongs to. Results from different
+            channels are cached separately
+        max_age:
+            Only use cached results younger than this many seconds. Defaults to
+            the max_age of the cache
+        """
+        super().__init__(searcher)
+        self.cache = cache
+        self.channel_key = channel_key
+        self.max_age = max_age
+
+    def find_studies(self, query: Query) -> Sequence[Study]:
+        key = query_key(query, self.channel_key)
+        studies = self.cache.get(key, max_age=self.max_age)
+        if studies is not None:
+            logger.debug(f"Cache hit for {query.to_short_string()}")
+            return studies
+        studies = list(self.searcher.find_studies(query))
+        if not any(is_partial(x) for x in studies):
+            self.cache.put(key, studies)
+        return studies
+
+
+def iter_cached_results(
+    cache: QueryCache,
+    queries: Iterable[Query],
+    run_queries: Callable[[Iterable[Query]], Iterable[QueryResult]],
+    channel_key: str = "",
+    max_age: Optional[int] = None,
+) -> Iterator[QueryResult]:
+    """Answer each query from cache if possible. Run the others and store each
+    study found under the query that found it. Partial results of a federated
+    search are not stored, see federation.is_partial().
+
+    Queries are looked up one by one, before run_queries can combine them into
+    batches. This way a cached result is found no matter which other queries
+    it was combined with when it was stored. Cached results are yielded in query
+    order, see iter_stored_or_run().
+
+    Parameters
+    ----------
+    cache:
+        Get results from and store results in this cache
+    queries:
+        The queries to run. Can be a generator
+    run_queries:
+        Runs the queries it is given and yields one result per query. Like
+        iter_query_results(), with trolley and other arguments filled in
+    channel_key:
+        Key of the channel queries are sent to. Results from different channels
+        are cached separately
+    max_age:
+        Only use cached results younger than this many seconds. Defaults to the
+        max_age of the cache
+    """
+
+    def get_cached(query: Query) -> Optional[QueryResult]:
+        studies = cache.get(query_key(query, channel_key), max_age=max_age)
+        if studies is None or len(studies) != 1:
+            return None
+        logger.debug(f"Cache hit for {query.to_short_string()}")
+        return QueryStudyResult(content=studies[0], query=query)
+
+    def store(result: QueryResult):
+        if isinstance(result, QueryStudyResult) and not is_partial(result.content):
+            cache.put(query_key(result.query, channel_key), [result.content])
+
+    return iter_stored_or_run(
+        queries, get_stored=get_cached, run_queries=run_queries, on_result=store
+    )
@@ -1,24 +1,99 @@
-"""Models ways of communicating with a DICOM server"""
-from typing import Any, Dict, List
+"""Models ways of communicating with a DICOM server
+
+Notes
+-----
+dicomtrolley protocol modules and requests are imported only when a searcher or
+downloader is created. This keeps CLI startup fast for commands that do not
+communicate with a server.
+"""
+from typing import TYPE_CHECKING, Any, ClassVar, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
 
-import requests
-from dicomtrolley.core import Downloader, Searcher
-from dicomtrolley.qido_rs import QidoRS
-from dicomtrolley.wado_rs import WadoRS
 from pydantic.main import BaseModel
 from pydantic.types import SecretStr
-from dicomtrolley.auth import create_session
-from dicomtrolley.dicom_qr import DICOMQR
-from dicomtrolley.mint import Mint
-from dicomtrolley.rad69 import Rad69
-from requests.auth import HTTPBasicAuth
 
 from dicomtrolleytool.exceptions import TrolleyToolError
 from dicomtrolleytool.logs import get_module_logger
+from dicomtrolleytool.retry import RetryPolicy
+
+if TYPE_CHECKING:
+    from dicomtrolley.core import Downloader, Searcher
+    from dicomtrolley.dicom_qr import DICOMQR
+    from dicomtrolley.mint import Mint
+    from dicomtrolley.qido_rs import QidoRS
+    from dicomtrolley.rad69 import Rad69
+    from dicomtrolley.wado_rs import WadoRS
+
+    from dicomtrolleytool.associations import AssociationPool
+    from dicomtrolleytool.query import QueryPlanner
 
 logger = get_module_logger("channels")
 
 
+class Throttle(BaseModel):
+    """Limits for using a server. Part of channel settings. Limits are shared by
+    all queries and downloads on the channel
+    """
+
+    # None means no limit
+    requests_per_second: Optional[float] = None
+    bytes_per_second: Optional[float] = None
+
+    # Find the highest number of parallel requests the server handles well, instead
+    # of always using the maximum
+    adaptive_concurrency: bool = False
+    # Halve parallel requests when latency rises above this many times the lowest
+    # latency seen
+    latency_tolerance: float = 2.0
+    # Same, for downloads. Higher, as download time also depends on study size
+    download_latency_tolerance: float = 10.0
+
+    def is_rate_limited(self) -> bool:
+        return bool(self.requests_per_second or self.bytes_per_second)
+
+
+class HTTPTransport(BaseModel):
+    """How http connections to a server are made and reused. Part of settings for
+    channels that use http
+    """
+
+    # Keep connection pools for this many different hosts
+    pool_connections: int = 10
+    # Keep up to this many open connections per host for reuse. Set to at least the
+    # number of parallel queries or downloads to avoid reconnecting for each request
+    pool_maxsize: int = 16
+    # Never open more than pool_maxsize connections per host. Wait for a free one
+    # instead
+    pool_block: bool = False
+    # Reuse connections for next requests. Switch off for servers that drop idle
+    # connections badly. Logins for Mint and Rad69 require keep-alive
+    keep_alive: bool = True
+    # Ask the server to compress responses, like QIDO-RS json or MINT xml
+    compression: bool = True
+    # Seconds to wait for a connection and between bytes received. None means
+    # wait forever
+    connect_timeout: Optional[float] = 10.0
+    read_timeout: Optional[float] = 300.0
+
+
+class HedgePolicy(BaseModel):
+    """When to send a request to a second replica as well. Part of settings for
+    replicated channels
+    """
+
+    enabled: bool = True
+    # Hedge when the first replica takes longer than this percentile of its recent
+    # latencies. Higher means fewer, later hedges
+    percentile: float = 95.0
+    # Never hedge more than this fraction of requests. Caps extra load on servers
+    max_hedge_ratio: float = 0.1
+    # Seconds to wait before hedging until min_samples latencies are known
+    initial_delay: float = 1.0
+    min_samples: int = 20
+    # Never hedge sooner than this many seconds
+    min_delay: float = 0.01
+
+
 class Channel(BaseModel):
     """A ready-to-use channel of interaction with a DICOM server, with credentials
 
@@ -27,6 +102,8 @@ class Channel(BaseModel):
 
     key: str  # for storage and retrieval
     description: str = ""  # single-line human-readable description
+    # Limits on requests to the server, shared by all queries and downloads
+    throttle: Throttle = Throttle()
 
     @classmethod
     def init_from_dict(cls, dict_in):
@@ -47,14 +124,79 @@ class Channel(BaseModel):
 
 
 class DownloaderChannel(Channel):
-    def init_downloader(self) -> Downloader:
+    def init_downloader(
+        self,
+        session=None,
+        http_chunk_size: Optional[int] = None,
+        request_per_series: bool = True,
+    ) -> "Downloader":
+        """Create a downloader instance from this channel
+
+        Parameters
+        ----------
+        session:
+            Use this http session. Defaults to None, meaning create a new one if
+            needed
+        http_chunk_size:
+            Read streamed responses in chunks of this many bytes. Larger chunks
+            mean fewer reads but more memory per download. Defaults to None,
+            meaning use the downloader default
+        request_per_series:
+            If True, request each series separately. If False, request all
+            instances at once. Defaults to True
+        """
         raise NotImplementedError()
 
 
 class SearcherChannel(Channel):
-    def init_searcher(self) -> Searcher:
+    # Never run more than this many queries on this channel at the same time.
+    # Keeps parallel queries from overloading the server
+    max_parallel_queries: int = 4
+    # Combine at most this many lookups into a single query to the server. 1 means
+    # never combine. Only has effect for channels that define batch_fields
+    max_query_batch_size: int = 1
+    # Try failed queries again if the error might be temporary, like a busy server
+    retry: RetryPolicy = RetryPolicy()
+    # In a federated search over several channels, stop waiting for this channel
+    # after this many seconds. None means use the timeout given for the search
+    federated_timeout: Optional[float] = None
+    # Also combine queries on AccessionNumber. The DICOM standard only defines
+    # lists of values for UIDs, but many servers accept them for AccessionNumber
+    # too. Only has effect for channels that define batch_fields
+    batch_accession_numbers: bool = False
+
+    # Queries that differ only in one of these fields can be combined into one
+    batch_fields: ClassVar[Tuple[str, ...]] = ()
+    # Join multiple values of a batch field with this in a combined query
+    batch_separator: ClassVar[str] = ","
+    # Only combine queries at these levels. None means all levels
+    batch_query_levels: ClassVar[Optional[Tuple[str, ...]]] = None
+
+    def init_searcher(self) -> "Searcher":
         raise NotImplementedError()
 
+    def get_query_planner(self, max_batch_size: Optional[int] = None) -> "QueryPlanner":
+        """Planner that combines queries as far as this channel supports
+
+        Parameters
+        ----------
+        max_batch_size:
+            Combine at most this many queries. Defaults to max_query_batch_size
+        """
+        from dicomtrolleytool.query import QueryPlanner
+
+        if max_batch_size is None:
+            max_batch_size = self.max_query_batch_size
+        batch_fields = self.batch_fields
+        if batch_fields and self.batch_accession_numbers:
+            batch_fields = batch_fields + ("AccessionNumber",)
+        return QueryPlanner(
+            batch_fields=batch_fields,
+            max_batch_size=max_batch_size,
+            separator=self.batch_separator,
+            query_levels=self.batch_query_levels,
+        )
+
 
 class MintChannel(SearcherChannel):
     """Can do DICOM searches with MINT
@@ -67,12 +209,34 @@ class MintChannel(SearcherChannel):
     user: str
     password: SecretStr
     realm: str
+    transport: HTTPTransport = HTTPTransport()
 
-    def init_searcher(self) -> Mint:
-        """Create a downloader instance from this connection"""
-        session = create_session(
-            self.login_url, self.user, self.password.get_secret_value(), self.realm
+    def get_session(self):
+        """A session that logs in to login_url automatically as needed"""
+        return create_vitrea_session(
+            self.login_url,
+            self.user,
+            self.password.get_secret_value(),
+            self.realm,
+            transport=self.transport,
         )
+
+    def get_session_key(self) -> Tuple[str, ...]:
+        """Channels with equal session keys can share one logged-in session"""
+        return (
+            "vitrea",
+            self.login_url,
+            self.user,
+            self.password.get_secret_value(),
+            self.realm,
+        )
+
+    def init_searcher(self, session=None) -> "Mint":
+        """Create a downloader instance from this connection"""
+        from dicomtrolley.mint import Mint
+
+        if not session:
+            session = self.get_session()
         return Mint(session, self.mint_url)
 
 
@@ -84,13 +248,45 @@ class Rad69Channel(DownloaderChannel):
     user: str
     password: SecretStr
     realm: str
+    transport: HTTPTransport = HTTPTransport()
 
-    def init_downloader(self) -> Rad69:
-        """Create a searcher instance from this connection"""
-        session = create_session(
-            self.login_url, self.user, self.password.get_secret_value(), self.realm
+    def get_session(self):
+        """A session that logs in to login_url automatically as needed"""
+        return create_vitrea_session(
+            self.login_url,
+            self.user,
+            self.password.get_secret_value(),
+            self.realm,
+            transport=self.transport,
+        )
+
+    def get_session_key(self) -> Tuple[str, ...]:
+        """Channels with equal session keys can share one logged-in session"""
+        return (
+            "vitrea",
+            self.login_url,
+            self.user,
+            self.password.get_secret_value(),
+            self.realm,
+        )
+
+    def init_downloader(
+        self,
+        session=None,
+        http_chunk_size: Optional[int] = None,
+        request_per_series: bool = True,
+    ) -> "Rad69":
+        """Create a downloader instance from this connection"""
+        from dicomtrolley.rad69 import Rad69
+
+        if not session:
+            session = self.get_session()
+        downloader = Rad69(
+            session=session, url=self.rad69_url, request_per_series=request_per_series
         )
-        return Rad69(session=session, url=self.rad69_url)
+        if http_chunk_size:  # not a Rad69 init parameter
+            downloader.http_chunk_size = http_chunk_size
+        return downloader
 
 
 class DICOMQRChannel(SearcherChannel):
@@ -100,10 +296,51 @@ class DICOMQRChannel(SearcherChannel):
     port: str
     aet: SecretStr
     aec: SecretStr
+    max_query_batch_size: int = 20
+    # Keep associations open and run the next queries on them, instead of
+    # associating for each query. Saves time on servers that are slow to associate.
+    # At most max_parallel_queries associations are open at the same time
+    reuse_associations: bool = False
+    # Release an open association after it was not used for this many seconds
+    association_idle_timeout: float = 60.0
+
+    # DICOM list of UID matching. See DICOM PS3.4 section C.2.2.2.2. Only on study
+    # level, as in hierarchical search unique keys above the query level must hold
+    # a single value. See DICOM PS3.4 section C.4.1.3.1.1
+    batch_fields: ClassVar[Tuple[str, ...]] = ("StudyInstanceUID",)
+    batch_separator: ClassVar[str] = "\\"
+    batch_query_levels: ClassVar[Optional[Tuple[str, ...]]] = ("STUDY",)
+
+    def init_association_pool(self) -> "AssociationPool":
+        """Pool of open associations for this channel. Share it between searchers
+        to share associations
+        """
+        from dicomtrolleytool.associations import AssociationPool
+
+        return AssociationPool(
+            host=self.host,
+            port=int(self.port),
+            aet=self.aet.get_secret_value(),
+            aec=self.aec.get_secret_value(),
+            max_size=self.max_parallel_queries,
+            idle_timeout=self.association_idle_timeout,
+        )
 
-    def init_searcher(self) -> Mint:
-        """Create a downloader instance from this connection"""
+    def init_searcher(self, pool: Optional["AssociationPool"] = None) -> "DICOMQR":
+        """Create a searcher instance from this connection
+
+        Parameters
+        ----------
+        pool:
+            Run queries on associations from this pool. Defaults to None, meaning
+            associate for each query
+        """
+        from dicomtrolley.dicom_qr import DICOMQR
+
+        if pool:
+            from dicomtrolleytool.associations import PooledDICOMQR
 
+            return PooledDICOMQR(pool)
         return DICOMQR(
             host=self.host,
             port=int(self.port),
@@ -112,39 +349,137 @@ class DICOMQRChannel(SearcherChannel):
         )
 
 
-class DICOMWebChannel(SearcherChannel):
+class DICOMWebChannel(SearcherChannel, DownloaderChannel):
     """QIDO-RS and WADO-RS. Optionally over the same connection"""
 
     dicom_web_url: str
     user: str
     password: SecretStr
+    max_query_batch_size: int = 20
+    transport: HTTPTransport = HTTPTransport()
+
+    # QIDO-RS comma-separated UID list matching. See DICOM PS3.18 section 8.3.4.
+    # Only on study level, as lower levels put StudyInstanceUID in the url path
+    batch_fields: ClassVar[Tuple[str, ...]] = ("StudyInstanceUID",)
+    batch_separator: ClassVar[str] = ","
+    batch_query_levels: ClassVar[Optional[Tuple[str, ...]]] = ("STUDY",)
 
     def get_session(self):
+        """A session for both QIDO-RS and WADO-RS. Pass it to init_searcher and
+        init_downloader to share connections between them
+        """
+        import requests
+        from requests.auth import HTTPBasicAuth
+
+        from dicomtrolleytool.sessions import configure_transport
+
         session = requests.Session()
         logger.debug(f'Creating basic auth session with user "{self.user}"')
         session.auth = HTTPBasicAuth(
             username=self.user, password=self.password.get_secret_value()
         )
+        configure_transport(session, self.transport)
         return session
 
-    def init_downloader(self, session=None) -> WadoRS:
+    def get_session_key(self) -> Tuple[str, ...]:
+        """Channels with equal session keys can share one session"""
+        return (
+            "basic",
+            urlsplit(self.dicom_web_url).netloc,
+            self.user,
+            self.password.get_secret_value(),
+        )
+
+    def init_downloader(
+        self,
+        session=None,
+        http_chunk_size: Optional[int] = None,
+        request_per_series: bool = True,
+    ) -> "WadoRS":
+        from dicomtrolley.wado_rs import WadoRS
+
         if not session:
             logger.debug("WadoRS session not given. Creating new one")
             session = self.get_session()
-        return WadoRS(session=session, url=self.dicom_web_url)
+        downloader = WadoRS(
+            session=session,
+            url=self.dicom_web_url,
+            request_per_series=request_per_series,
+        )
+        if http_chunk_size:
+            downloader.http_chunk_size = http_chunk_size
+        return downloader
+
+    def init_searcher(self, session=None) -> "QidoRS":
+        from dicomtrolley.qido_rs import QidoRS
 
-    def init_searcher(self, session=None) -> QidoRS:
         if not session:
             logger.debug("QidoRS session not given. Creating new one")
             session = self.get_session()
         return QidoRS(session=session, url=self.dicom_web_url)
 
 
+class VitreaChannel(MintChannel, Rad69Channel):
+    """Searches with MINT and downloads with rad69 on the same Vitrea server, with
+    one login
+    """
+
+
+class ReplicatedChannel(SearcherChannel, DownloaderChannel):
+    """Several channels to servers that hold the same data. Each query or download
+    goes to the replica that has been fastest lately, with hedged requests to a
+    second replica when it is slow. See hedging.Hedger
+
+    Replicas are other channels, by name. Their searchers and downloaders are
+    created with their own settings for retries, throttling and sessions.
+    """
+
+    replicas: List[str]
+    hedging: HedgePolicy = HedgePolicy()
+
+    def init_searcher(self, session=None) -> "Searcher":
+        raise ChannelFactoryError(
+            f"Channel '{self.key}' searches with its replicas. Create its searcher "
+            f"with TrolleyToolContext.create_searcher()"
+        )
+
+    def init_downloader(
+        self,
+        session=None,
+        http_chunk_size: Optional[int] = None,
+        request_per_series: bool = True,
+    ) -> "Downloader":
+        raise ChannelFactoryError(
+            f"Channel '{self.key}' downloads with its replicas. Create its "
+            f"downloader with TrolleyToolContext.create_downloader()"
+        )
+
+
+def create_vitrea_session(
+    login_url, user, password, realm, transport: Optional[HTTPTransport] = None
+):
+    """Like dicomtrolley.auth.create_session(), but keeps track of logins and uses
+    transport settings
+    """
+    import requests
+
+    from dicomtrolleytool.sessions import TrackingVitreaAuth, configure_transport
+
+    session = requests.Session()
+    session.auth = TrackingVitreaAuth(
+        login_url=login_url, user=user, password=password, realm=realm
+    )
+    configure_transport(session, transport or HTTPTransport())
+    return session
+
+
 CHANNEL_CLASSES: Dict[str, Any] = {
     "rad69": Rad69Channel,
     "mint": MintChannel,
     "dicomqr": DICOMQRChannel,
     "dicomweb": DICOMWebChannel,
+    "vitrea": VitreaChannel,
+    "replicated": ReplicatedChannel,
 }
 
 
@@ -1,18 +1,46 @@
 """Shared objects for CLI and basic CLI commands"""
 import logging
-from dataclasses import dataclass
+import pathlib
+from functools import partial
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
 
 import click
-from dicomtrolley.trolley import Trolley
 
+from dicomtrolleytool.channels import (
+    DICOMQRChannel,
+    DownloaderChannel,
+    ReplicatedChannel,
+    SearcherChannel,
+)
 from dicomtrolleytool.logs import get_module_logger, install_colouredlogs
 from dicomtrolleytool.persistence import (
     DEFAULT_SETTINGS_PATH,
     SettingsFile,
     KeyRingStorage,
+    Storage,
     TrolleyToolSettings,
 )
 
+if TYPE_CHECKING:
+    from concurrent.futures import ThreadPoolExecutor
+
+    from dicomtrolley.core import Downloader, Searcher
+    from dicomtrolley.trolley import Trolley
+
+    from requests import Session
+
+    from dicomtrolleytool.associations import AssociationPool
+    from dicomtrolleytool.cache import QueryCache
+    from dicomtrolleytool.channels import Channel
+    from dicomtrolleytool.federation import FederationMode
+    from dicomtrolleytool.hedging import Hedger
+    from dicomtrolleytool.index import MetadataIndex
+    from dicomtrolleytool.journal import QueryJournal
+    from dicomtrolleytool.profiling import Profiler
+    from dicomtrolleytool.query import QueryPlanner
+    from dicomtrolleytool.sessions import SessionCache
+    from dicomtrolleytool.throttle import AdaptiveConcurrencyLimit, RateLimiter
+
 logger = get_module_logger("trolleytool")
 
 
@@ -23,15 +51,671 @@ def configure_logging(verbose):
     if verbose >= 1:
         loglevel = logging.DEBUG
 
-    logging.info(f"Set loglevel to {loglevel}")
+    logging.debug(f"Set loglevel to {loglevel}")
     logging.basicConfig(level=loglevel)
     install_colouredlogs(level=loglevel)
 
 
-@dataclass
 class TrolleyToolContext:
-    settings: TrolleyToolSettings
-    trolley: Trolley
+    """Objects used by trolleytool commands.
+
+    Everything is created on first access. Settings are read, channels are loaded
+    from storage and searcher and downloader log in only when a command needs
+    them. Any object can also be passed in directly, for example for testing.
+    """
+
+    def __init__(
+        self,
+        settings: Optional[TrolleyToolSettings] = None,
+        trolley: Optional["Trolley"] = None,
+        searcher_channel: Optional[SearcherChannel] = None,
+        downloader_channel: Optional[DownloaderChannel] = None,
+        storage: Optional[Storage] = None,
+        settings_path: pathlib.Path = DEFAULT_SETTINGS_PATH,
+    ):
+        self._settings = settings
+        self._trolley = trolley
+        self._searcher_channel = searcher_channel
+        self._downloader_channel = downloader_channel
+        self._storage = storage
+        self._session_cache: Optional["SessionCache"] = None
+        self.settings_path = settings_path
+        # modification time of settings file when settings were read from it
+        self._settings_mtime: Optional[float] = None
+        # records timing of searches, downloads and requests if set
+        self.profiler: Optional["Profiler"] = None
+        # answer queries from this cache if set. See use_query_cache()
+        self.query_cache: Optional["QueryCache"] = None
+        self.query_cache_max_age: Optional[int] = None
+        # per channel key. Shared by searcher and downloader on the same channel
+        self._rate_limiters: Dict[str, "RateLimiter"] = {}
+        # per channel key and 'search' or 'download', as their latencies differ
+        self._concurrency_limits: Dict[Tuple[str, str], "AdaptiveConcurrencyLimit"] = {}
+        self._channels: Dict[str, "Channel"] = {}  # per channel name
+        # per session key. Shared by channels on the same server and credentials
+        self._sessions: Dict[Tuple[str, ...], "Session"] = {}
+        # per replicated channel key and 'search' or 'download'. Keeps latencies
+        self._hedgers: Dict[Tuple[str, str], "Hedger"] = {}
+        # per DICOM QR channel key. Keeps associations open between queries
+        self._association_pools: Dict[str, "AssociationPool"] = {}
+        # channels searched at the same time, if set. See use_federated_search()
+        self._federated_channels: Dict[str, SearcherChannel] = {}
+        self._federated_key: Optional[str] = None
+        # per channel key. Runs federated queries, at most max_parallel_queries
+        self._federated_executors: Dict[str, "ThreadPoolExecutor"] = {}
+
+    def fork(self) -> "TrolleyToolContext":
+        """Context for running a next command in the same process. Shares settings,
+        storage, loaded channels, sessions, limits and session cache with this
+        context. Changes made by a command, like overriding settings or profiling,
+        stay in the fork
+        """
+        forked = TrolleyToolContext(
+            settings=self._settings,
+            storage=self._storage,
+            settings_path=self.settings_path,
+        )
+        forked._settings_mtime = self._settings_mtime
+        forked._session_cache = self._session_cache
+        forked._channels = self._channels
+        forked._sessions = self._sessions
+        forked._rate_limiters = self._rate_limiters
+        forked._concurrency_limits = self._concurrency_limits
+        forked._hedgers = self._hedgers
+        forked._association_pools = self._association_pools
+        forked._federated_executors = self._federated_executors
+        return forked
+
+    @property
+    def settings(self) -> TrolleyToolSettings:
+        if self._settings is None:
+            self._settings = SettingsFile(path=self.settings_path).load_settings()
+            self._settings_mtime = self.get_settings_mtime()
+        return self._settings
+
+    @settings.setter
+    def settings(self, value: TrolleyToolSettings):
+        self._settings = value
+
+    def get_settings_mtime(self) -> Optional[float]:
+        """Modification time of settings file. None if there is no such file"""
+        try:
+            return self.settings_path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def reload_if_settings_changed(self) -> bool:
+        """Read settings again if the settings file changed since they were read,
+        for example by a 'channel set-searcher' in another process. Drops loaded
+        channels, sessions, limits, hedgers and association pools, as these were
+        created with the old settings. Sessions are stored in session cache first
+
+        Returns
+        -------
+        bool
+            True if settings were read again
+        """
+        if self._settings_mtime is None:  # not read from file, or not read yet
+            return False
+        if self.get_settings_mtime() == self._settings_mtime:
+            return False
+        logger.info(f'Settings file "{self.settings_path}" changed. Reloading')
+        self.close()
+        for pool in self._association_pools.values():
+            pool.close()
+        for session in self._sessions.values():
+            session.close()
+        for hedger in self._hedgers.values():
+            hedger.executor.shutdown(wait=False)
+        for executor in self._federated_executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        self._settings = None
+        self._settings_mtime = None
+        self._trolley = None
+        self._searcher_channel = None
+        self._downloader_channel = None
+        self._session_cache = None
+        self._channels = {}
+        self._sessions = {}
+        self._rate_limiters = {}
+        self._concurrency_limits = {}
+        self._hedgers = {}
+        self._association_pools = {}
+        self._federated_executors = {}
+        return True
+
+    @property
+    def storage(self) -> Storage:
+        if self._storage is None:
+            self._storage = KeyRingStorage()
+        return self._storage
+
+    def load_channel(self, name: str) -> "Channel":
+        """Load channel from storage. Loaded only once per name, so a channel used
+        as both searcher and downloader is read from storage once
+        """
+        if name not in self._channels:
+            logger.debug(f"Loading channel '{name}'")
+            self._channels[name] = self.storage.load_channel(name)
+        return self._channels[name]
+
+    @property
+    def searcher_channel(self) -> SearcherChannel:
+        if self._searcher_channel is None:
+            self._searcher_channel = self.load_channel(self.settings.searcher_name)
+        return self._searcher_channel
+
+    @searcher_channel.setter
+    def searcher_channel(self, value: SearcherChannel):
+        self._searcher_channel = value
+
+    @property
+    def downloader_channel(self) -> DownloaderChannel:
+        if self._downloader_channel is None:
+            self._downloader_channel = self.load_channel(self.settings.downloader_name)
+        return self._downloader_channel
+
+    @downloader_channel.setter
+    def downloader_channel(self, value: DownloaderChannel):
+        self._downloader_channel = value
+
+    @property
+    def trolley(self) -> "Trolley":
+        """Trolley with searcher and downloader from settings. Searcher and
+        downloader are created when the trolley first searches or downloads
+        """
+        if self._trolley is None:
+            from dicomtrolleytool.wrappers import LazyDownloader, LazySearcher
+
+            self._trolley = trolley_from_settings(
+                self.settings,
+                searcher=self.index_if_enabled(
+                    LazySearcher(self.create_searcher), self.settings.searcher_name
+                ),
+                downloader=LazyDownloader(self.create_downloader),
+            )
+        return self._trolley
+
+    @trolley.setter
+    def trolley(self, value: "Trolley"):
+        self._trolley = value
+
+    @property
+    def searcher_key(self) -> str:
+        """Identifies where queries go. Results for different keys are cached
+        separately
+        """
+        return self._federated_key or self.settings.searcher_name
+
+    @property
+    def searcher_channels(self) -> List[SearcherChannel]:
+        """All channels that queries are sent to"""
+        if self._federated_channels:
+            return list(self._federated_channels.values())
+        return [self.searcher_channel]
+
+    def index_if_enabled(self, searcher: "Searcher", channel_key: str) -> "Searcher":
+        """Store all results of searcher in the metadata index, if enabled"""
+        if not self.settings.metadata_index:
+            return searcher
+        from dicomtrolleytool.index import IndexingSearcher
+
+        return IndexingSearcher(
+            searcher, index=self.get_metadata_index(), channel_key=channel_key
+        )
+
+    def create_searcher(self, channel: Optional[SearcherChannel] = None) -> "Searcher":
+        """Searcher for channel with retries, throttling and profiling as configured
+
+        Parameters
+        ----------
+        channel:
+            Create searcher for this channel. Defaults to None, meaning the
+            searcher channel from settings
+        """
+        channel = channel or self.searcher_channel
+        if isinstance(channel, ReplicatedChannel):
+            return self.create_replicated_searcher(channel)
+        retry = channel.retry
+        session = self.get_session(channel)
+        if session:
+            if retry.max_attempts > 1:
+                retry.watch_session(session)
+            searcher = channel.init_searcher(session=session)
+        else:
+            pool = self.get_association_pool(channel)
+            searcher = (
+                channel.init_searcher(pool=pool) if pool else channel.init_searcher()
+            )
+        if self.profiler:  # inside retries, to record each attempt
+            from dicomtrolleytool.profiling import ProfilingSearcher
+
+            searcher = ProfilingSearcher(searcher, profiler=self.profiler)
+        concurrency = self.get_concurrency_limit(channel, "search")
+        # http requests are rate limited by session. Others per query
+        rate_limiter = None if session else self.get_rate_limiter(channel)
+        if concurrency or rate_limiter:
+            from dicomtrolleytool.wrappers import ThrottlingSearcher
+
+            searcher = ThrottlingSearcher(
+                searcher,
+                rate_limiter=rate_limiter,
+                concurrency=concurrency,
+                is_overload=retry.is_retryable,
+            )
+        if retry.max_attempts > 1:
+            from dicomtrolleytool.wrappers import RetryingSearcher
+
+            searcher = RetryingSearcher(searcher, policy=retry, profiler=self.profiler)
+        return searcher
+
+    def create_downloader(
+        self, channel: Optional[DownloaderChannel] = None
+    ) -> "Downloader":
+        """Downloader for channel with throttling and profiling as configured
+
+        Parameters
+        ----------
+        channel:
+            Create downloader for this channel. Defaults to None, meaning the
+            downloader channel from settings
+        """
+        channel = channel or self.downloader_channel
+        if isinstance(channel, ReplicatedChannel):
+            return self.create_replicated_downloader(channel)
+        downloader = channel.init_downloader(
+            session=self.get_session(channel),
+            http_chunk_size=self.settings.http_chunk_size,
+            request_per_series=self.settings.request_per_series,
+        )
+        if self.profiler:
+            from dicomtrolleytool.profiling import ProfilingDownloader
+
+            downloader = ProfilingDownloader(downloader, profiler=self.profiler)
+        concurrency = self.get_concurrency_limit(channel, "download")
+        if concurrency:
+            from dicomtrolleytool.retry import RetryPolicy
+            from dicomtrolleytool.wrappers import ThrottlingDownloader
+
+            downloader = ThrottlingDownloader(
+                downloader, concurrency, is_overload=RetryPolicy().is_retryable
+            )
+        return downloader
+
+    def create_replicated_searcher(self, channel: ReplicatedChannel) -> "Searcher":
+        """Searcher that sends each query to the fastest replica of channel"""
+        from dicomtrolleytool.hedging import HedgedSearcher
+
+        return HedgedSearcher(
+            replicas={
+                name: self.create_searcher(x)
+                for name, x in self.load_replicas(channel, SearcherChannel).items()
+            },
+            hedger=self.get_hedger(channel, "search"),
+        )
+
+    def create_replicated_downloader(self, channel: ReplicatedChannel) -> "Downloader":
+        """Downloader that downloads from the fastest replica of channel"""
+        from dicomtrolleytool.hedging import HedgedDownloader
+
+        return HedgedDownloader(
+            replicas={
+                name: self.create_downloader(x)
+                for name, x in self.load_replicas(channel, DownloaderChannel).items()
+            },
+            hedger=self.get_hedger(channel, "download"),
+        )
+
+    def load_replicas(
+        self, channel: ReplicatedChannel, kind: type
+    ) -> Dict[str, "Channel"]:
+        """Replicas of channel by name
+
+        Raises
+        ------
+        click.UsageError
+            If a replica is not of kind, or is replicated itself
+        """
+        replicas = {name: self.load_channel(name) for name in channel.replicas}
+        for name, replica in replicas.items():
+            if not isinstance(replica, kind) or isinstance(replica, ReplicatedChannel):
+                raise click.UsageError(
+                    f"Replica '{name}' of channel '{channel.key}' must be a "
+                    f"{kind.__name__}, and cannot be replicated itself"
+                )
+        return replicas
+
+    def get_hedger(self, channel: ReplicatedChannel, purpose: str) -> "Hedger":
+        """Hedger for channel, shared by all its searchers or downloaders so that
+        latencies are kept for the next command when running as daemon
+        """
+        if (channel.key, purpose) not in self._hedgers:
+            from dicomtrolleytool.hedging import Hedger
+
+            self._hedgers[(channel.key, purpose)] = Hedger(
+                channel.hedging,
+                max_workers=2 * channel.max_parallel_queries,
+                is_retryable=channel.retry.is_retryable,
+            )
+        return self._hedgers[(channel.key, purpose)]
+
+    def get_association_pool(
+        self, channel: SearcherChannel
+    ) -> Optional["AssociationPool"]:
+        """Association pool for channel, shared by all its searchers so that
+        associations stay open for the next command when running as daemon. None
+        if channel does not reuse associations
+        """
+        if not isinstance(channel, DICOMQRChannel) or not channel.reuse_associations:
+            return None
+        if channel.key not in self._association_pools:
+            self._association_pools[channel.key] = channel.init_association_pool()
+        return self._association_pools[channel.key]
+
+    def get_rate_limiter(self, channel: "Channel") -> Optional["RateLimiter"]:
+        """Rate limiter for channel, shared by all its sessions. None if channel
+        has no rate limit
+        """
+        if not channel.throttle.is_rate_limited():
+            return None
+        if channel.key not in self._rate_limiters:
+            from dicomtrolleytool.throttle import RateLimiter
+
+            self._rate_limiters[channel.key] = RateLimiter.init_from_throttle(
+                channel.throttle
+            )
+        return self._rate_limiters[channel.key]
+
+    def get_concurrency_limit(
+        self, channel: "Channel", purpose: str
+    ) -> Optional["AdaptiveConcurrencyLimit"]:
+        """Adaptive limit on requests in flight for channel. None if not enabled
+
+        Parameters
+        ----------
+        channel:
+            Limit requests to this channel
+        purpose:
+            'search' or 'download'. Each has its own limit, so that slow downloads
+            do not lower the limit for queries and the other way around
+        """
+        if not channel.throttle.adaptive_concurrency:
+            return None
+        if (channel.key, purpose) not in self._concurrency_limits:
+            from dicomtrolleytool.throttle import AdaptiveConcurrencyLimit
+
+            if purpose == "download":
+                limit = AdaptiveConcurrencyLimit(
+                    latency_tolerance=channel.throttle.download_latency_tolerance
+                )
+            else:
+                limit = AdaptiveConcurrencyLimit(
+                    max_limit=getattr(channel, "max_parallel_queries", None),
+                    latency_tolerance=channel.throttle.latency_tolerance,
+                )
+            self._concurrency_limits[(channel.key, purpose)] = limit
+        return self._concurrency_limits[(channel.key, purpose)]
+
+    def start_profiling(self):
+        """Record timing of everything searcher and downloader do from now on.
+
+        Has no effect on searcher or downloader that have already been created
+        """
+        from dicomtrolleytool.profiling import Profiler
+
+        self.profiler = Profiler()
+
+    def override_settings(self, **kwargs):
+        """Change settings for this command only. Values that are None are ignored.
+
+        Has no effect on searcher or downloader that have already been created
+        """
+        update = {key: value for key, value in kwargs.items() if value is not None}
+        if update:
+            self.settings = self.settings.model_copy(update=update)
+
+    @property
+    def session_cache(self) -> Optional["SessionCache"]:
+        """Cache for reusing logged-in sessions. None if disabled in settings"""
+        if not self.settings.session_cache:
+            return None
+        if self._session_cache is None:
+            from dicomtrolleytool.sessions import (
+                DEFAULT_SESSION_CACHE_PATH,
+                SessionCache,
+            )
+
+            self._session_cache = SessionCache(
+                path=self.settings.session_cache_path or DEFAULT_SESSION_CACHE_PATH,
+                max_age=self.settings.session_max_age,
+                refresh_margin=self.settings.session_refresh_margin,
+            )
+        return self._session_cache
+
+    def get_session(self, channel: "Channel") -> Optional["Session"]:
+        """Http session for channel, restored from session cache if possible.
+        Created once per server and credentials, so that searcher and downloader
+        on the same server share connections and login. Transport, throttle and
+        cache settings of the first channel to ask are used
+
+        Returns
+        -------
+        Optional[Session]
+            None if channel does not use http sessions
+        """
+        if not hasattr(channel, "get_session"):
+            return None
+        session_key = channel.get_session_key()
+        if session_key in self._sessions:
+            logger.debug(f"Reusing session for '{channel.key}'")
+            return self._sessions[session_key]
+        session = channel.get_session()
+        if self.profiler:  # before attaching, to include any login
+            from dicomtrolleytool.profiling import profile_session
+
+            profile_session(session, self.profiler)
+        rate_limiter = self.get_rate_limiter(channel)
+        if rate_limiter:  # after profiling, so waiting does not count as request
+            from dicomtrolleytool.throttle import limit_session
+
+            limit_session(session, rate_limiter)
+        if self.session_cache:
+            self.session_cache.attach(channel.key, session)
+        self._sessions[session_key] = session
+        return session
+
+    def close(self):
+        """Call when done. Stores sessions for use by the next command"""
+        if self._session_cache:
+            self._session_cache.save()
+
+    def max_parallel_queries(self, requested: int) -> int:
+        """The number of parallel queries to use, given that requested.
+
+        Never more than the searcher channel allows. For a federated search, never
+        more than the strictest of its channels allows
+        """
+        if requested <= 1:
+            return 1  # no need to look at channel
+        strictest = min(self.searcher_channels, key=lambda x: x.max_parallel_queries)
+        if requested > strictest.max_parallel_queries:
+            logger.info(
+                f"Requested {requested} parallel queries, but channel "
+                f"'{strictest.key}' allows at most "
+                f"{strictest.max_parallel_queries}. Using that"
+            )
+            return strictest.max_parallel_queries
+        return requested
+
+    def get_query_planner(self, batch_size: Optional[int] = None) -> "QueryPlanner":
+        """Planner for combining queries on the searcher channel. Queries are not
+        combined in a federated search, as channels combine queries differently
+
+        Parameters
+        ----------
+        batch_size:
+            Combine at most this many queries. Defaults to None, meaning use
+            the maximum set for the searcher channel
+        """
+        if self._federated_channels:
+            from dicomtrolleytool.query import QueryPlanner
+
+            return QueryPlanner()
+        return self.searcher_channel.get_query_planner(max_batch_size=batch_size)
+
+    def get_query_cache(self) -> "QueryCache":
+        from dicomtrolleytool.cache import DEFAULT_CACHE_PATH, QueryCache
+
+        return QueryCache(
+            path=self.settings.query_cache_path or DEFAULT_CACHE_PATH,
+            max_age=self.settings.query_cache_max_age,
+            max_size=self.settings.query_cache_max_size,
+        )
+
+    def use_query_cache(self, max_age: Optional[int] = None):
+        """Answer queries from cache where possible. Each query is looked up
+        before queries are combined into batches, see cache.iter_cached_results()
+
+        Parameters
+        ----------
+        max_age:
+            Only use cached results younger than this many seconds. Defaults to
+            query_cache_max_age in settings
+        """
+        self.query_cache = self.get_query_cache()
+        self.query_cache_max_age = max_age
+
+    def use_query_expansion(self):
+        """Make trolley run series and instance level queries level by level, with
+        up to max_parallel_queries of the searcher channel sub-queries at the
+        same time
+        """
+        from dicomtrolleytool.wrappers import ExpandingSearcher
+
+        self.trolley.searcher = ExpandingSearcher(
+            searcher=self.trolley.searcher,
+            max_in_flight=min(x.max_parallel_queries for x in self.searcher_channels),
+        )
+
+    def use_federated_search(
+        self,
+        channel_names: Sequence[str],
+        mode: "FederationMode",
+        timeout: Optional[float] = None,
+    ):
+        """Make trolley send each query to all channel_names at the same time. The
+        searcher from settings is not used, unless it is in channel_names
+
+        Parameters
+        ----------
+        channel_names:
+            Search these channels. Results of channels earlier in this list take
+            precedence when merging
+        mode:
+            How to combine results of the channels
+        timeout:
+            Stop waiting for a channel after this many seconds, unless set
+            differently for the channel. Defaults to None, meaning no timeout
+
+        Raises
+        ------
+        click.UsageError
+            If any of channel_names is not a searcher channel
+        """
+        from dicomtrolleytool.federation import FederatedSearcher, FederationMode
+        from dicomtrolleytool.wrappers import LazySearcher
+
+        mode = FederationMode(mode)
+        channels: Dict[str, SearcherChannel] = {}
+        for name in channel_names:
+            channel = self.load_channel(name)
+            if not isinstance(channel, SearcherChannel):
+                raise click.UsageError(f"Channel '{name}' cannot search")
+            channels[name] = channel
+        timeouts = {
+            name: timeout if x.federated_timeout is None else x.federated_timeout
+            for name, x in channels.items()
+        }
+        self.trolley.searcher = FederatedSearcher(
+            searchers={
+                name: self.index_if_enabled(
+                    LazySearcher(partial(self.create_searcher, x)), name
+                )
+                for name, x in channels.items()
+            },
+            mode=mode,
+            timeouts=timeouts,
+            executors={
+                name: self.get_federated_executor(x) for name, x in channels.items()
+            },
+        )
+        self._federated_channels = channels
+        self._federated_key = f"federated:{','.join(channels)}:{mode.value}"
+
+    def get_federated_executor(self, channel: SearcherChannel) -> "ThreadPoolExecutor":
+        """Runs queries on channel in a federated search. Kept for the next command
+        when running as daemon. At most max_parallel_queries of channel run at the
+        same time. Queries that time out keep a worker until they finish
+        """
+        if channel.key not in self._federated_executors:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._federated_executors[channel.key] = ThreadPoolExecutor(
+                max_workers=channel.max_parallel_queries,
+                thread_name_prefix=f"federated-{channel.key}",
+            )
+        return self._federated_executors[channel.key]
+
+    @property
+    def query_jobs_path(self) -> pathlib.Path:
+        from dicomtrolleytool.journal import DEFAULT_JOBS_PATH
+
+        return self.settings.query_jobs_path or DEFAULT_JOBS_PATH
+
+    def get_query_journal(self, job_id: Optional[str] = None) -> "QueryJournal":
+        """Journal of a batch query job, for storing results and resuming
+
+        Parameters
+        ----------
+        job_id:
+            Open the journal of this existing job. Defaults to None, meaning start
+            a new job
+
+        Raises
+        ------
+        click.UsageError
+            If there is no job with job_id
+        """
+        import secrets
+        import time
+
+        from dicomtrolleytool.journal import QueryJournal
+
+        if job_id is None:
+            job_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(2)}"
+        elif not (self.query_jobs_path / f"{job_id}.jsonl").exists():
+            raise click.UsageError(
+                f"No query job '{job_id}' in {self.query_jobs_path}. See "
+                f"'trolley job list'"
+            )
+        return QueryJournal(self.query_jobs_path / f"{job_id}.jsonl")
+
+    def get_metadata_index(self) -> "MetadataIndex":
+        from dicomtrolleytool.index import DEFAULT_INDEX_PATH, MetadataIndex
+
+        return MetadataIndex(
+            path=self.settings.metadata_index_path or DEFAULT_INDEX_PATH
+        )
+
+    def use_local_index(self):
+        """Make trolley answer queries from the local metadata index only. No
+        server is contacted
+        """
+        from dicomtrolleytool.index import LocalSearcher
+
+        self.trolley.searcher = LocalSearcher(
+            index=self.get_metadata_index(), channel_key=self.settings.searcher_name
+        )
 
 
 def get_context() -> TrolleyToolContext:
@@ -40,19 +724,43 @@ def get_context() -> TrolleyToolContext:
     Returns
     -------
     TrolleyToolContext
+        Nothing is loaded yet. See TrolleyToolContext
+    """
+    return TrolleyToolContext(settings_path=DEFAULT_SETTINGS_PATH)
+
+
+def report_profile(
+    profiler: "Profiler",
+    output_path: Optional[str] = None,
+    output_format: Optional[str] = None,
+):
+    """Print profile summary to stderr and optionally write all timings to file
+
+    Parameters
+    ----------
+    profiler:
+        Report on this
+    output_path:
+        Write all timings to this file. Defaults to None, meaning do not write
+    output_format:
+        'json' or 'trace', see write_profile(). Defaults to None, meaning json
     """
-    settings = SettingsFile(path=DEFAULT_SETTINGS_PATH).load_settings()
-    return TrolleyToolContext(
-        settings=settings, trolley=trolley_from_settings(settings)
-    )
-
-
-def trolley_from_settings(settings: TrolleyToolSettings):
-    storage = KeyRingStorage()
-    trolley = Trolley(
-        searcher=storage.load_channel(settings.searcher_name).init_searcher(),
-        downloader=storage.load_channel(settings.downloader_name).init_downloader(),
-    )
+    from dicomtrolleytool.profiling import write_profile
+
+    click.echo("\n" + profiler.format_summary(), err=True)
+    if output_path:
+        with open(output_path, "w") as f:
+            write_profile(profiler, f, output_format=output_format)
+        click.echo(f"Wrote profile to '{output_path}'", err=True)
+
+
+def trolley_from_settings(
+    settings: TrolleyToolSettings, searcher: "Searcher", downloader: "Downloader"
+) -> "Trolley":
+    """Trolley with the given searcher and downloader, configured by settings"""
+    from dicomtrolley.trolley import Trolley
+
+    trolley = Trolley(searcher=searcher, downloader=downloader)
     if settings.query_missing:
         trolley.query_missing = settings.query_missing
 
@@ -64,7 +772,9 @@ def trolley_from_settings(settings: TrolleyToolSettings):
 def status(context: TrolleyToolContext):
     """Get general status of this tool, show currently active server etc."""
     print("Status")
-    print(f"Settings file at '{DEFAULT_SETTINGS_PATH}'")
+    print(f"Settings file at '{context.settings_path}'")
+    print(f"searcher: {context.settings.searcher_name}")
+    print(f"downloader: {context.settings.downloader_name}")
     print(f"trolley: {context.trolley}")
 
 
@@ -0,0 +1,36 @@
+"""Commands for managing the local query result cache"""
+import click
+
+from dicomtrolleytool.cli.base import TrolleyToolContext
+
+
+@click.group()
+def cache():
+    """Manage local cache of query results"""
+
+
+@click.command(short_help="Show cache statistics")
+@click.pass_obj
+def stats(context: TrolleyToolContext):
+    """Show size and use of the query result cache"""
+    query_cache = context.get_query_cache()
+    cache_stats = query_cache.stats()
+    print(f"Cache at '{query_cache.path}'")
+    print(f"entries : {cache_stats.entries}")
+    print(f"size    : {cache_stats.size / 1024 / 1024:.2f} MB")
+    print(f"hits    : {cache_stats.hits}")
+    print(f"misses  : {cache_stats.misses}")
+    print(f"hit rate: {cache_stats.hit_rate:.1%}")
+
+
+@click.command(short_help="Remove all cached results")
+@click.pass_obj
+def clear(context: TrolleyToolContext):
+    """Remove all cached query results and reset statistics"""
+    query_cache = context.get_query_cache()
+    query_cache.clear()
+    print(f"Cleared cache at '{query_cache.path}'")
+
+
+cache.add_command(stats)
+cache.add_command(clear)
@@ -1,6 +1,7 @@
 """Custom click parameter types"""
+from typing import Sequence
+
 from click import ParamType
-from pydicom.datadict import tag_for_keyword
 
 
 class DICOMTagNameListParamType(ParamType):
@@ -8,6 +9,17 @@ class DICOMTagNameListParamType(ParamType):
 
     name = "dicom_tag_name_list"
 
+    def __init__(self, extra_keywords: Sequence[str] = ()):
+        """
+
+        Parameters
+        ----------
+        extra_keywords:
+            Also allow these, even though they are not DICOM keywords. Defaults to
+            none
+        """
+        self.extra_keywords = set(extra_keywords)
+
     def convert(self, value, param, ctx):
         """Check whether each keyword passed is a valid DICOM tag names
         like PatientID, AccessionNumber, etc.
@@ -18,6 +30,8 @@ class DICOMTagNameListParamType(ParamType):
             A list of valid DICOM tag names
 
         """
+        from pydicom.datadict import tag_for_keyword  # slow import. Only when used
+
         if not value:
             return []  # [] is default value if parameter not given
 
@@ -32,7 +46,7 @@ class DICOMTagNameListParamType(ParamType):
                 raise ValueError(
                     "Empty DICOM keyword in list. Do you have a " "trailing comma?"
                 )
-            if not tag_for_keyword(keyword):
+            if keyword not in self.extra_keywords and not tag_for_keyword(keyword):
                 raise ValueError(
                     f"{keyword} is not a valid DICOM tag name. " f"Format: CamelCase"
                 )
@@ -1,32 +1,158 @@
 """Commands for downloading data"""
 import tempfile
+from pathlib import Path
 
 import click
-from dicomtrolley.core import Query
-from dicomtrolley.trolley import Trolley
 
-from dicomtrolleytool.cli.base import TrolleyToolContext
+from dicomtrolleytool.cli.base import TrolleyToolContext, logger
+from dicomtrolleytool.cli.identifiers import (
+    column_option,
+    input_file_option,
+    iter_identifiers,
+)
+from dicomtrolleytool.identifiers import chunks
+from dicomtrolleytool.query import iter_query_results, split_error_results
+
+# Default name of download journal file, in output dir
+DEFAULT_JOURNAL_NAME = ".trolley_journal.jsonl"
 
 
 @click.group()
 @click.pass_obj
-def download(context):
+@click.option(
+    "--http-chunk-size",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Read downloads in chunks of this many bytes. Larger chunks are faster but "
+    "use more memory. Overrides http_chunk_size setting",
+)
+@click.option(
+    "--request-per-series/--request-per-study",
+    default=None,
+    help="Request each series separately, or whole studies at once. Overrides "
+    "request_per_series setting",
+)
+def download(context: TrolleyToolContext, http_chunk_size, request_per_series):
     """Download DICOM data"""
+    context.override_settings(
+        http_chunk_size=http_chunk_size, request_per_series=request_per_series
+    )
 
 
 @click.command(short_help="Download by StudyInstanceUID", name="suid")
 @click.pass_obj
 @click.option("-o", "--output-dir")
-@click.argument("suid", type=str)
-def download_suid(context: TrolleyToolContext, suid, output_dir):
-    """Query StudyInstanceUID"""
-    trolley: Trolley = context.trolley
-    study = trolley.find_study(Query(StudyInstanceUID=suid))
+@click.argument("suids", type=str, nargs=-1)
+@input_file_option
+@column_option
+@click.option(
+    "--chunk-size",
+    type=click.IntRange(min=1),
+    default=50,
+    help="Look up this many studies, then download them in one go",
+    show_default=True,
+)
+def download_suid(
+    context: TrolleyToolContext, suids, output_dir, input_file, column, chunk_size
+):
+    """Download StudyInstanceUID or space-separated list"""
+    from dicomtrolley.core import Query
+
+    trolley = context.trolley
     if output_dir is None:
         download_dir = tempfile.gettempdir()
     else:
         download_dir = output_dir
-    trolley.download(study, output_dir=download_dir)
+
+    queries = (
+        Query(StudyInstanceUID=suid)
+        for suid in iter_identifiers(suids, input_file=input_file, column=column)
+    )
+    not_found = 0
+    for chunk in chunks(iter_query_results(trolley, queries), chunk_size):
+        study_results, error_results = split_error_results(chunk)
+        not_found += len(error_results)
+        if study_results:
+            trolley.download(
+                [x.content for x in study_results], output_dir=download_dir
+            )
+    if not_found:
+        logger.warning(f"{not_found} studies could not be found. Not downloaded")
+
+
+@click.command(short_help="Download many studies in parallel", name="batch")
+@click.pass_obj
+@click.option("-o", "--output-dir", type=click.Path(file_okay=False), required=True)
+@click.argument("suids", type=str, nargs=-1)
+@input_file_option
+@column_option
+@click.option(
+    "--search-workers",
+    type=click.IntRange(min=1),
+    default=4,
+    help="Run this many searches at the same time. Capped by the maximum set for "
+    "the searcher channel",
+    show_default=True,
+)
+@click.option(
+    "--download-workers",
+    type=click.IntRange(min=1),
+    default=4,
+    help="Download this many studies at the same time",
+    show_default=True,
+)
+@click.option(
+    "--journal",
+    "journal_path",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Record progress in this file. Defaults to a file in output dir",
+)
+@click.option(
+    "--resume/--no-resume",
+    default=True,
+    help="Skip studies and instances that the journal says are already downloaded",
+    show_default=True,
+)
+def download_batch(
+    context: TrolleyToolContext,
+    output_dir,
+    suids,
+    input_file,
+    column,
+    search_workers,
+    download_workers,
+    journal_path,
+    resume,
+):
+    """Download StudyInstanceUIDs, searching and downloading several at once.
+
+    Keeps a journal of finished studies and instances. Running the same command
+    again after an interruption continues where it left off.
+    """
+    from dicomtrolleytool.download import BatchDownloader
+    from dicomtrolleytool.journal import DownloadJournal
+
+    output_dir = Path(output_dir)
+    if journal_path is None:
+        journal_path = output_dir / DEFAULT_JOURNAL_NAME
+    if not resume:
+        DownloadJournal(journal_path).clear()
+
+    with DownloadJournal(journal_path) as journal:
+        downloader = BatchDownloader(
+            trolley=context.trolley,
+            output_dir=output_dir,
+            journal=journal,
+            search_workers=context.max_parallel_queries(search_workers),
+            download_workers=download_workers,
+            planner=context.get_query_planner(),
+        )
+        report = downloader.download(
+            iter_identifiers(suids, input_file=input_file, column=column)
+        )
+    logger.info(f"Download finished\n{report.summary()}")
 
 
 download.add_command(download_suid)
+download.add_command(download_batch)
@@ -1,28 +1,69 @@
 """Entrypoint for trolley CLI command. All subcommands are connected here."""
+from functools import partial
+
 import click
 
+from dicomtrolleytool.cli.cache import cache
 from dicomtrolleytool.cli.download import download
 from dicomtrolleytool.cli.channel import channel
 from dicomtrolleytool.cli.base import (
     configure_logging,
     edit,
     get_context,
+    report_profile,
     settings,
     status,
 )
+from dicomtrolleytool.cli.index import index
+from dicomtrolleytool.cli.job import job
 from dicomtrolleytool.cli.query import query
+from dicomtrolleytool.cli.serve import serve
+from dicomtrolleytool.cli.session import session
 
 
 @click.group()
 @click.option("-v", "--verbose", count=True)
+@click.option(
+    "--profile",
+    is_flag=True,
+    default=False,
+    help="Print time spent on queries, downloads, requests, logins and output "
+    "when done",
+)
+@click.option(
+    "--profile-output",
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="Also write all timings to this file. Implies --profile",
+)
+@click.option(
+    "--profile-format",
+    type=click.Choice(["json", "trace"], case_sensitive=False),
+    default="json",
+    help="Format of --profile-output. 'trace' is Chrome trace event format, for "
+    "chrome://tracing or ui.perfetto.dev",
+    show_default=True,
+)
 @click.pass_context
-def main(ctx, verbose):
+def main(ctx, verbose, profile, profile_output, profile_format):
     r"""DICOM Trolley tool - DICOM interaction from the command line
 
     Use the commands below with -h for more info
     """
     configure_logging(verbose)
-    ctx.obj = get_context()
+    if ctx.obj is None:  # context might have been passed in already
+        ctx.obj = get_context()
+        ctx.call_on_close(ctx.obj.close)
+    if profile or profile_output:
+        ctx.obj.start_profiling()
+        ctx.call_on_close(
+            partial(
+                report_profile,
+                ctx.obj.profiler,
+                output_path=profile_output,
+                output_format=profile_format.lower(),
+            )
+        )
 
 
 settings.add_command(edit)
@@ -33,3 +74,8 @@ main.add_command(channel)
 main.add_command(settings)
 main.add_command(query)
 main.add_command(download)
+main.add_command(cache)
+main.add_command(session)
+main.add_command(index)
+main.add_command(job)
+main.add_command(serve)
@@ -0,0 +1,271 @@
+"""Writing query results with typed values, for analysis in other tools.
+
+JSON Lines needs nothing extra. Arrow and Parquet need pyarrow, which is an
+optional dependency: pip install dicomtrolleytool[parquet]
+"""
+import json
+from datetime import date, datetime, time
+from itertools import islice
+from os import PathLike
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    TextIO,
+    Union,
+)
+
+from pydicom.datadict import dictionary_VM, dictionary_VR, tag_for_keyword
+from pydicom.multival import MultiValue
+from pydicom.valuerep import DA, DS, DT, IS, TM
+
+from dicomtrolleytool.cli.output import (
+    SOURCE_CHANNEL_FIELD,
+    FormatLevel,
+    ResultFormat,
+    iter_result_values,
+)
+from dicomtrolleytool.exceptions import TrolleyToolError
+from dicomtrolleytool.logs import get_module_logger
+from dicomtrolleytool.query import QueryResult
+
+if TYPE_CHECKING:
+    import pyarrow
+    from pydicom import Dataset
+    from pydicom.dataelem import DataElement
+
+logger = get_module_logger("cli_export")
+
+# Write this many rows at a time to Arrow and Parquet files
+DEFAULT_BATCH_SIZE = 10000
+
+# How to turn a single DICOM value into a python value, per value representation
+CONVERTERS: Dict[str, Callable[[Any], Any]] = {
+    "DA": lambda x: date.fromisoformat(DA(x).isoformat()),
+    "TM": lambda x: time.fromisoformat(TM(x).isoformat()),
+    "DT": lambda x: datetime.fromisoformat(DT(x).isoformat()),
+    "IS": lambda x: int(IS(x)),
+    "DS": lambda x: float(DS(x)),
+    "SS": int,
+    "SL": int,
+    "SV": int,
+    "US": int,
+    "UL": int,
+    "UV": int,
+    "FL": float,
+    "FD": float,
+}
+
+
+def is_multi_valued(keyword: str) -> bool:
+    """True if this DICOM element can hold more than one value, like
+    ModalitiesInStudy. Such elements are always exported as lists
+    """
+    if keyword == SOURCE_CHANNEL_FIELD:
+        return True
+    tag = tag_for_keyword(keyword)
+    return tag is not None and dictionary_VM(tag) != "1"
+
+
+def value_representation(keyword: str) -> str:
+    """VR of DICOM element with this keyword. Defaults to LO for unknown keywords,
+    meaning values are exported as strings
+    """
+    tag = tag_for_keyword(keyword)
+    return dictionary_VR(tag) if tag is not None else "LO"
+
+
+def convert_value(value: Any, vr: str) -> Any:
+    """Single DICOM value as a python type. None for empty or unparsable values"""
+    if value is None or value == "":
+        return None
+    try:
+        return CONVERTERS.get(vr, str)(value)
+    except (ValueError, TypeError):
+        logger.debug(f"Could not convert '{value}' for VR {vr}. Leaving empty")
+        return None
+
+
+def typed_value(element: "DataElement") -> Any:
+    """Value of element as python type. Dates as dates, numbers as numbers and
+    multi-valued elements as lists
+    """
+    value = element.value
+    if isinstance(value, (MultiValue, list)):
+        return [convert_value(x, element.VR) for x in value]
+    if is_multi_valued(element.keyword):
+        return [] if value in (None, "") else [convert_value(value, element.VR)]
+    return convert_value(value, element.VR)
+
+
+def iter_typed_records(
+    results: Iterable[QueryResult],
+    fields: Optional[List[str]] = None,
+    format_level: Optional[FormatLevel] = None,
+) -> Iterator[Dict[str, Any]]:
+    """{Keyword: typed value} for each object at format level in results, flattened
+    like query_results_to_table(). Error results are skipped with a warning
+
+    Parameters
+    ----------
+    results:
+        For each query either the data sent by the server or the error that
+        occurred. Can be a generator
+    fields:
+        Only include these keywords. Defaults to None, meaning include all
+    format_level:
+        One of FormatLevel. Defaults to None, meaning guess for each result
+    """
+    field_set = set(fields) if fields else None
+
+    def extract(ds: "Dataset") -> Dict[str, Any]:
+        return {
+            x.keyword: typed_value(x)
+            for x in ds
+            if x.VR != "SQ"
+            and x.keyword  # private elements have none
+            and (field_set is None or x.keyword in field_set)
+        }
+
+    error_count = 0
+    for result in results:
+        if result.is_error():
+            error_count += 1
+            continue
+        for values in iter_result_values(result, extract, format_level=format_level):
+            if field_set is not None:
+                for added in ("StudyInstanceUID", SOURCE_CHANNEL_FIELD):
+                    if added not in field_set:
+                        values.pop(added, None)
+            yield values
+    if error_count:
+        logger.warning(
+            f"{error_count} queries resulted in error. Excluding those from export"
+        )
+
+
+def json_default(value: Any) -> str:
+    """Dates and times as ISO 8601 strings in JSON"""
+    if isinstance(value, (date, time)):  # datetime is a subclass of date
+        return value.isoformat()
+    raise TypeError(f"Cannot write {type(value)} to JSON")
+
+
+def write_query_results_jsonl(
+    results: Iterable[QueryResult],
+    stream: TextIO,
+    fields: Optional[List[str]] = None,
+    format_level: Optional[FormatLevel] = None,
+):
+    """Write a JSON object per line for each object at format level, as each result
+    comes in. Dates and times are written as ISO 8601 strings
+
+    Parameters
+    ----------
+    results:
+        For each query either the data sent by the server or the error that
+        occurred. Can be a generator
+    stream:
+        Write to this. Typically sys.stdout
+    fields:
+        Only include these keywords. Defaults to None, meaning include all
+    format_level:
+        One of FormatLevel. Defaults to None, meaning guess for each result
+    """
+    for record in iter_typed_records(results, fields, format_level=format_level):
+        stream.write(json.dumps(record, default=json_default) + "\n")
+    stream.flush()
+
+
+def arrow_type(keyword: str) -> "pyarrow.DataType":
+    """Arrow column type for the DICOM element with this keyword"""
+    import pyarrow as pa
+
+    vr = value_representation(keyword)
+    if vr == "DA":
+        column_type = pa.date32()
+    elif vr == "TM":
+        column_type = pa.time64("us")
+    elif vr == "DT":
+        column_type = pa.timestamp("us")
+    elif vr in ("DS", "FL", "FD"):
+        column_type = pa.float64()
+    elif vr in ("IS", "SS", "SL", "SV", "US", "UL", "UV"):
+        column_type = pa.int64()
+    else:
+        column_type = pa.string()
+    if is_multi_valued(keyword):
+        return pa.list_(column_type)
+    return column_type
+
+
+def arrow_schema(fields: List[str]) -> "pyarrow.Schema":
+    """Typed arrow schema with a column for each DICOM keyword in fields"""
+    import pyarrow as pa
+
+    return pa.schema([(x, arrow_type(x)) for x in fields])
+
+
+def write_query_results_arrow(
+    results: Iterable[QueryResult],
+    path: Union[str, PathLike],
+    fields: List[str],
+    output_format: ResultFormat = ResultFormat.PARQUET,
+    format_level: Optional[FormatLevel] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+):
+    """Write results to an Arrow IPC or Parquet file in record batches. Only one
+    batch is kept in memory at a time.
+
+    Parameters
+    ----------
+    results:
+        For each query either the data sent by the server or the error that
+        occurred. Can be a generator
+    path:
+        Write to this file. Overwrites if it exists
+    fields:
+        DICOM keywords to use as columns, in this order. Column types are
+        taken from the DICOM dictionary. Needed up front to fix the schema
+    output_format:
+        ResultFormat.ARROW or ResultFormat.PARQUET
+    format_level:
+        One of FormatLevel. Defaults to None, meaning guess for each result
+    batch_size:
+        Write this many rows at a time
+
+    Raises
+    ------
+    TrolleyToolError
+        If pyarrow is not installed or output_format is not a columnar format
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise TrolleyToolError(
+            f"Writing {output_format} needs pyarrow. Install with "
+            f"'pip install dicomtrolleytool[parquet]'"
+        ) from e
+
+    schema = arrow_schema(fields)
+    if output_format == ResultFormat.PARQUET:
+        writer = pa.parquet.ParquetWriter(path, schema)
+    elif output_format == ResultFormat.ARROW:
+        writer = pa.ipc.new_file(path, schema)
+    else:
+        raise TrolleyToolError(f"{output_format} is not a columnar format")
+
+    records = iter_typed_records(results, fields, format_level=format_level)
+    row_count = 0
+    with writer:
+        while batch := list(islice(records, batch_size)):
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            row_count += len(batch)
+    logger.debug(f"Wrote {row_count} rows to {path}")
@@ -0,0 +1,39 @@
+"""Options for passing identifiers to commands as arguments or in a file"""
+from itertools import chain
+from typing import Iterable, Iterator, Optional, TextIO
+
+import click
+
+from dicomtrolleytool.identifiers import IdentifierReadError, read_identifiers
+
+input_file_option = click.option(
+    "--input-file",
+    type=click.File("r"),
+    default=None,
+    help="Read identifiers from this file, one per line or in a CSV column (see "
+    "--column). Use '-' for stdin",
+)
+column_option = click.option(
+    "--column",
+    type=str,
+    default=None,
+    help="Read identifiers from this column in --input-file. File should be CSV "
+    "with a header line",
+)
+
+
+def iter_identifiers(
+    arguments: Iterable[str], input_file: Optional[TextIO], column: Optional[str]
+) -> Iterator[str]:
+    """All identifiers given as arguments followed by those in input_file.
+
+    The file is read only as identifiers are needed
+    """
+    if column and not input_file:
+        raise click.UsageError("--column can only be used with --input-file")
+    if not input_file:
+        return iter(arguments)
+    try:
+        return chain(arguments, read_identifiers(input_file, column=column))
+    except IdentifierReadError as e:
+        raise click.UsageError(str(e)) from e
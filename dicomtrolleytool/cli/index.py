@@ -0,0 +1,85 @@
+"""Commands for managing the local metadata index"""
+import click
+from click import Choice
+
+from dicomtrolleytool.cli.base import TrolleyToolContext
+from dicomtrolleytool.cli.query import QUERY_LEVELS, get_default_include_fields
+
+
+@click.group()
+def index():
+    """Manage local index of queried studies, series and instances"""
+
+
+@click.command(short_help="Fetch new studies into index")
+@click.pass_obj
+@click.option(
+    "--since",
+    type=click.DateTime(formats=["%Y-%m-%d", "%Y%m%d"]),
+    default=None,
+    help="Fetch studies with a study date on or after this date. Defaults to the "
+    "date of the last sync",
+)
+@click.option(
+    "--query-level",
+    type=Choice(choices=QUERY_LEVELS, case_sensitive=False),
+    default="STUDY",
+    help="Fetch information down to this level",
+    show_default=True,
+)
+@click.option(
+    "--result-limit",
+    type=click.IntRange(min=1),
+    default=None,
+    help="The most results the server returns for one query. Days with this many "
+    "studies are fetched again on the next sync",
+)
+def sync(context: TrolleyToolContext, since, query_level, result_limit):
+    """Query the searcher channel for all studies newer than the last sync and
+    store them in the index. Queries one study date at a time
+    """
+    from dicomtrolleytool.index import IndexSyncError, sync_index
+
+    metadata_index = context.get_metadata_index()
+    try:
+        count = sync_index(
+            metadata_index,
+            searcher=context.create_searcher(),
+            channel_key=context.settings.searcher_name,
+            since=since.date() if since else None,
+            query_level=query_level,
+            include_fields=get_default_include_fields(query_level),
+            result_limit=result_limit,
+        )
+    except IndexSyncError as e:
+        raise click.UsageError(f"{e}. Use --since") from e
+    print(f"Indexed {count} studies in '{metadata_index.path}'")
+
+
+@click.command(short_help="Show index statistics")
+@click.pass_obj
+def stats(context: TrolleyToolContext):
+    """Show number of objects in the metadata index"""
+    metadata_index = context.get_metadata_index()
+    index_stats = metadata_index.stats()
+    last_sync = metadata_index.get_last_sync(context.settings.searcher_name)
+    print(f"Index at '{metadata_index.path}'")
+    print(f"studies  : {index_stats.studies}")
+    print(f"series   : {index_stats.series}")
+    print(f"instances: {index_stats.instances}")
+    print(f"size     : {index_stats.size / 1024 / 1024:.2f} MB")
+    print(f"last sync: {last_sync or 'never'}")
+
+
+@click.command(short_help="Remove everything from index")
+@click.pass_obj
+def clear(context: TrolleyToolContext):
+    """Remove all indexed objects and sync dates"""
+    metadata_index = context.get_metadata_index()
+    metadata_index.clear()
+    print(f"Cleared index at '{metadata_index.path}'")
+
+
+index.add_command(sync)
+index.add_command(stats)
+index.add_command(clear)
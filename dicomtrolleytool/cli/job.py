@@ -0,0 +1,56 @@
+"""Commands for managing the journals of checkpointed query jobs"""
+import datetime
+
+import click
+
+from dicomtrolleytool.cli.base import TrolleyToolContext
+
+
+@click.group()
+def job():
+    """Manage checkpointed query jobs. See 'trolley query acc --help'"""
+
+
+@click.command(name="list", short_help="Show all query jobs")
+@click.pass_obj
+def list_jobs(context: TrolleyToolContext):
+    """Show all query jobs that can be resumed, oldest first"""
+    from dicomtrolleytool.journal import QueryJournal
+
+    paths = sorted(context.query_jobs_path.glob("*.jsonl"))
+    if not paths:
+        print(f"No query jobs in '{context.query_jobs_path}'")
+        return
+    print(f"{'job':<22} {'finished':>9} {'failed':>7} {'size (MB)':>10}  modified")
+    for path in paths:
+        journal = QueryJournal(path)
+        modified = datetime.datetime.fromtimestamp(path.stat().st_mtime)
+        print(
+            f"{journal.job_id:<22} {len(journal.offsets):>9} "
+            f"{len(journal.failed):>7} {path.stat().st_size / 1024 / 1024:>10.2f}  "
+            f"{modified:%Y-%m-%d %H:%M}"
+        )
+
+
+@click.command(short_help="Shrink the journal of a query job")
+@click.pass_obj
+@click.argument("job_id", type=str)
+def compact(context: TrolleyToolContext, job_id: str):
+    """Rewrite the journal of JOB_ID, keeping only the latest result per query"""
+    journal = context.get_query_journal(job_id=job_id)
+    before, after = journal.compact()
+    print(f"Compacted job '{job_id}' from {before} to {after} records")
+
+
+@click.command(short_help="Remove a query job")
+@click.pass_obj
+@click.argument("job_id", type=str)
+def delete(context: TrolleyToolContext, job_id: str):
+    """Remove the journal of JOB_ID and all results stored in it"""
+    context.get_query_journal(job_id=job_id).clear()
+    print(f"Removed job '{job_id}'")
+
+
+job.add_command(list_jobs)
+job.add_command(compact)
+job.add_command(delete)
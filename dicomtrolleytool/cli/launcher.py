@@ -0,0 +1,20 @@
+"""Entrypoint for the trolley script. Sends the command to a running daemon if
+there is one, otherwise runs it in this process.
+
+Imports as little as possible before knowing which. See dicomtrolleytool.daemon
+"""
+import sys
+
+from dicomtrolleytool.daemon import forward, should_forward
+
+
+def main():
+    argv = sys.argv[1:]
+    if should_forward(argv):
+        exit_code = forward(argv)
+        if exit_code is not None:
+            sys.exit(exit_code)
+
+    from dicomtrolleytool.cli.entrypoint import main as run_here
+
+    run_here()
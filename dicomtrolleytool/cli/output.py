@@ -1,20 +1,35 @@
 """Functions and classes for formatting output to console"""
-from collections import defaultdict
+import csv
 from enum import Enum
-from typing import Dict, Iterable, List, Optional
+from io import StringIO
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    TextIO,
+)
 
-from dicomtrolley.core import Study
 from dicomtrolley.exceptions import DICOMTrolleyError
 
-from pydicom import Dataset
-from tabulate import tabulate
-
 from dicomtrolleytool.exceptions import TrolleyToolError
 from dicomtrolleytool.logs import get_module_logger
 from dicomtrolleytool.query import QueryResult, QueryStudyResult, split_error_results
 
+if TYPE_CHECKING:
+    from dicomtrolley.core import Study
+    from pydicom import Dataset
+
 logger = get_module_logger("cli_output")
 
+# Column with the channel(s) a study was found on in a federated search. Not a
+# DICOM keyword. Stored as private element, see dicomtrolleytool.federation
+SOURCE_CHANNEL_FIELD = "SourceChannel"
+
 
 class ResultFormat(str, Enum):
     """How to display query results"""
@@ -23,6 +38,13 @@ class ResultFormat(str, Enum):
     TABLE = "TABLE"
     GITHUB = "GITHUB"  # github markup table
     CSV = "CSV"
+    JSONL = "JSONL"  # JSON Lines, one object per row
+    ARROW = "ARROW"  # Arrow IPC file. Binary, needs output file
+    PARQUET = "PARQUET"  # Binary, needs output file
+
+
+# Formats that can only be written to a file, not to console
+FILE_ONLY_FORMATS = (ResultFormat.ARROW, ResultFormat.PARQUET)
 
 
 class FormatLevel(str, Enum):
@@ -72,48 +94,131 @@ def format_query_results(
         )
     elif output_format == ResultFormat.CSV:
         return format_query_results_csv(results, output_field_filter)
+    elif output_format == ResultFormat.JSONL:
+        from dicomtrolleytool.cli.export import write_query_results_jsonl
+
+        stream = StringIO()
+        write_query_results_jsonl(results, stream, fields=output_field_filter)
+        return stream.getvalue().rstrip("\n")
+    elif output_format in FILE_ONLY_FORMATS:
+        raise TrolleyToolError(f"{output_format} output can only be written to file")
     else:
         raise TrolleyToolError(f"Unknown result format {output_format}")
 
 
+def write_query_results(
+    results: Iterable[QueryResult],
+    stream: TextIO,
+    output_format: ResultFormat = ResultFormat.RAW,
+    output_field_filter: Optional[List[str]] = None,
+    include_fields: Optional[List[str]] = None,
+    format_level: Optional[FormatLevel] = None,
+):
+    """Format query results and write them to stream.
+
+    Unlike format_query_results(), streaming formats write each result as soon as
+    it comes in. This keeps memory use flat and shows output early for long
+    query runs. Formats that need to see all results first, like TABLE, are
+    written in one go at the end. CSV streams only if its columns are known up
+    front from output_field_filter or include_fields.
+
+    Parameters
+    ----------
+    results:
+        For each query either the data sent by the server or the error that
+        occurred. Can be a generator
+    stream:
+        Write to this. Typically sys.stdout
+    output_format:
+        One of ResultFormat. How to display the results
+    output_field_filter:
+        Optionally only show these DICOM tag names in results. Defaults to None
+        which show all fields without filter
+    include_fields:
+        The DICOM tag names that were queried for. Used as CSV columns when
+        output_field_filter is not given. Defaults to None
+    format_level:
+        One of FormatLevel. Show a row per object of this level in CSV. Defaults
+        to None, meaning guess for each result
+    """
+    if output_format == ResultFormat.RAW:
+        for text in iter_format_query_results_raw(results, output_field_filter):
+            stream.write(text + "\n")
+            stream.flush()
+    elif output_format == ResultFormat.JSONL:
+        from dicomtrolleytool.cli.export import write_query_results_jsonl
+
+        write_query_results_jsonl(
+            results, stream, fields=output_field_filter, format_level=format_level
+        )
+    elif output_format == ResultFormat.CSV and (output_field_filter or include_fields):
+        write_query_results_csv(
+            results,
+            stream,
+            fields=output_field_filter or include_fields,
+            format_level=format_level,
+        )
+    else:
+        stream.write(
+            format_query_results(
+                results,
+                output_format=output_format,
+                output_field_filter=output_field_filter,
+            )
+            + "\n"
+        )
+
+
 def format_query_results_raw(
     results: Iterable[QueryResult], output_field_filter: Optional[List[str]] = None
 ) -> str:
     """Print each result as plainly as possible. Still use indentation for
     series and images to keep things remotely readable
     """
+    return "\n".join(iter_format_query_results_raw(results, output_field_filter))
+
+
+def iter_format_query_results_raw(
+    results: Iterable[QueryResult], output_field_filter: Optional[List[str]] = None
+) -> Iterator[str]:
+    """Raw output for each result. Each result is formatted only when needed"""
     if output_field_filter:
         raise NotImplementedError(
             "Raw output filtering not implemented."
             "Just use grep. Or implement it yourself if "
             "you are annoyed by this"
         )
+    for idx, result in enumerate(results, start=1):
+        yield "\n".join(format_query_result_raw(result, idx))
+
+
+def format_query_result_raw(result: QueryResult, idx: int) -> List[str]:
+    """Format a single query result as raw output lines"""
     output = []
     tab = "  "
-    for idx, result in enumerate(results, start=1):
-        output.append(f"= Query {idx} =")
-        output.append(result.query.to_short_string())
-        if result.is_error():
-            output.append(f"Error. No Results found. Error: {str(result.content)}")
-        else:
-            output.append(f"= Result for query {idx} =")
-            study: Study = result.content
-            output.append(f"Study: {study.uid}")
-            output = output + (format_dataset(study.data, prefix=tab))
+    output.append(f"= Query {idx} =")
+    output.append(result.query.to_short_string())
+    if result.is_error():
+        output.append(f"Error. No Results found. Error: {str(result.content)}")
+    else:
+        output.append(f"= Result for query {idx} =")
+        study: "Study" = result.content
+        output.append(f"Study: {study.uid}")
+        output = output + (format_dataset(study.data, prefix=tab))
 
-            for series in study.series:
-                output.append(f"{tab}Series: {series.uid}")
-                output = output + (format_dataset(series.data, prefix=tab + tab))
-                for instance in series.instances:
-                    output.append(f"{tab + tab} Instance: {instance.uid}")
-                    output = output + (
-                        format_dataset(instance.data, prefix=tab + tab + tab)
-                    )
+        for series in study.series:
+            output.append(f"{tab}Series: {series.uid}")
+            output = output + (format_dataset(series.data, prefix=tab + tab))
+            for instance in series.instances:
+                output.append(f"{tab + tab} Instance: {instance.uid}")
+                output = output + (
+                    format_dataset(instance.data, prefix=tab + tab + tab)
+                )
 
-    return "\n".join(output)
+    return output
 
 
-def format_dataset(ds: Dataset, prefix="") -> List[str]:
+def format_dataset(ds: "Dataset", prefix="") -> List[str]:
     """Extract all elements in dataset as separate lines, optionally prefixed"""
     return [f"{prefix}{line}" for line in str(ds).split("\n")]
 
@@ -168,7 +273,7 @@ def guess_format_level(results: List[QueryStudyResult]) -> str:
         return result
 
 
-def query_results_to_table(  # noqa: C901  - I feel its acceptably complex for now
+def query_results_to_table(
     results=Iterable[QueryStudyResult],
     output_field_filter: Optional[List[str]] = None,
     format_level: Optional[str] = None,
@@ -190,61 +295,113 @@ def query_results_to_table(  # noqa: C901  - I feel its acceptably complex for n
     The leading consideration is to make the output easy to grep so that a single
     line contains all information you need.
     """
+    results = list(results)
     if not format_level:
         format_level = guess_format_level(results)
 
-    # first extract all data elements at the right level
-    elements: List[Dict[str, str]] = []  # one dict per result
-    studies = [x.content for x in results]
-    if format_level == FormatLevel.STUDY:
-        for study in studies:
-            result_values = {"StudyInstanceUID": study.uid}
-            result_values.update(dataset_to_dict(study.data))
-            elements.append(result_values)
-
-    if format_level == FormatLevel.SERIES:
-        for study in studies:
-            study_level_values = dataset_to_dict(study.data)
-            for series in study.series:
-                result_values = study_level_values.copy()
-                result_values.update(dataset_to_dict(series.data))
-                elements.append(result_values)
-
-    if format_level == FormatLevel.INSTANCE:
-        for study in studies:
-            study_level_values = dataset_to_dict(study.data)
-            for series in study.series:
-                series_level_values = dataset_to_dict(series.data)
-                for instance in series.instances:
-                    result_values = study_level_values.copy()
-                    result_values.update(series_level_values)
-                    result_values.update(dataset_to_dict(instance.data))
-                    elements.append(result_values)
-
-    # then make sure that any missing data elements are filled in as empty
-    all_headers = set()
-    for x in elements:
-        all_headers.update(list(x.keys()))
-    table = defaultdict(list)
-    for result_values in elements:
-        all_items = {x: "" for x in all_headers}
-        all_items.update(result_values)
-        for key, value in all_items.items():
-            table[key].append(value)
-
     if output_field_filter:
         logger.debug(
-            f"Output field filter was given, filtering by " f"{output_field_filter}"
+            f"Output field filter was given, filtering by {output_field_filter}"
         )
-        filtered = {x: y for x, y in table.items() if x in output_field_filter}
-        return filtered
-    else:
-        return table
+    table = ColumnTable(fields=output_field_filter)
+    for study in (x.content for x in results):
+        study_values = table.extract(study.data)
+        study_values.update(source_channel_values(study))
+        if format_level == FormatLevel.STUDY:
+            table.add_row({"StudyInstanceUID": study.uid}, study_values)
+            continue
+        for series in study.series:
+            series_values = table.extract(series.data)
+            if format_level == FormatLevel.SERIES:
+                table.add_row(study_values, series_values)
+                continue
+            for instance in series.instances:
+                table.add_row(study_values, series_values, table.extract(instance.data))
+
+    return table.to_dict()
+
+
+class ColumnTable:
+    """Table that is built column by column, for turning many DICOM objects
+    into rows without building a dict for each row.
+
+    Each column is a list of values. Rows are added by appending to columns.
+    Columns that do not have a value for a row are padded with empty strings only
+    when they are next written to or when the table is finished.
+    """
+
+    def __init__(self, fields: Optional[List[str]] = None):
+        """
+
+        Parameters
+        ----------
+        fields:
+            If given, only keep these columns, in this order. Defaults to None,
+            meaning keep all columns in the order they are first encountered
+        """
+        self.fields = fields
+        self._field_set = set(fields) if fields else None
+        self.columns: Dict[str, List[Any]] = {}
+        self.row_count = 0
+
+    def extract(self, ds: "Dataset") -> Dict[str, Any]:
+        """All elements of ds as {Keyword: Value}, but only for fields in this table.
+
+        Extract once for values that are repeated on multiple rows, like study
+        values for each instance row.
+        """
+        if self._field_set is None:
+            return dataset_to_dict(ds)
+        return {x.keyword: x.value for x in ds if x.keyword in self._field_set}
+
+    def add_row(self, *values: Dict[str, Any]):
+        """Add a single row made up of all values. For keys occurring more than
+        once, the last value is used
+        """
+        row = self.row_count
+        field_set = self._field_set
+        columns = self.columns
+        for part in values:
+            for key, value in part.items():
+                column = columns.get(key)
+                if column is None:
+                    if field_set is not None and key not in field_set:
+                        continue
+                    column = columns[key] = []
+                missing = row - len(column)
+                if missing < 0:  # already written for this row. Overwrite
+                    column[row] = value
+                    continue
+                if missing:
+                    column.extend([""] * missing)
+                column.append(value)
+        self.row_count += 1
+
+    def to_dict(self) -> Dict[str, List[Any]]:
+        """Table as {header: [value, value, ..]} with all columns the same length"""
+        for column in self.columns.values():
+            if len(column) < self.row_count:
+                column.extend([""] * (self.row_count - len(column)))
+        if self.fields:
+            return {x: self.columns[x] for x in self.fields if x in self.columns}
+        return self.columns
+
+
+def dataset_to_dict(ds: "Dataset") -> Dict[str, str]:
+    """All elements of dataset as {Keyword: Value}. Private elements, which have no
+    keyword, are left out
+    """
+    return {x.keyword: x.value for x in ds if x.keyword}
 
 
-def dataset_to_dict(ds: Dataset) -> Dict[str, str]:
-    """All elements of dataset as {Keyword: Value}"""
-    return {x.keyword: x.value for x in ds}
+def source_channel_values(study: "Study") -> Dict[str, List[str]]:
+    """{SOURCE_CHANNEL_FIELD: [channel name, ..]} for a study found by a federated
+    search. Empty for other studies
+    """
+    from dicomtrolleytool.federation import get_source_channels  # slow import
+
+    sources = get_source_channels(study)
+    return {SOURCE_CHANNEL_FIELD: sources} if sources else {}
 
 
 def format_query_results_table(
@@ -254,6 +411,8 @@ def format_query_results_table(
     table_format: str = "simple",
 ) -> str:
     """Create"""
+    from tabulate import tabulate  # slow import. Only when needed
+
     study_results, error_results = split_error_results(results)
     table = query_results_to_table(
         study_results,
@@ -270,6 +429,122 @@ def format_query_results_table(
 
 
 def format_query_results_csv(
-    results: Iterable[QueryResult], output_field_filter
+    results: Iterable[QueryResult], output_field_filter: Optional[List[str]] = None
 ) -> str:
-    raise NotImplementedError()
+    """Comma separated values with a header line. If output_field_filter is not
+    given, columns are all fields found in results
+    """
+    stream = StringIO()
+    if output_field_filter:
+        write_query_results_csv(results, stream, fields=output_field_filter)
+    else:
+        study_results, _ = split_error_results(results)
+        table = query_results_to_table(study_results)
+        writer = csv.writer(stream, lineterminator="\n")
+        writer.writerow(table.keys())
+        writer.writerows(zip(*table.values()))
+    return stream.getvalue().rstrip("\n")
+
+
+def write_query_results_csv(
+    results: Iterable[QueryResult],
+    stream: TextIO,
+    fields: List[str],
+    format_level: Optional[FormatLevel] = None,
+):
+    """Write results as comma separated values, one result at a time.
+
+    The columns are fixed up front, so nothing needs to be kept in memory and
+    output can be piped into other tools while results are still coming in.
+    Error results are skipped with a warning.
+
+    Parameters
+    ----------
+    results:
+        For each query either the data sent by the server or the error that
+        occurred. Can be a generator
+    stream:
+        Write to this. Typically sys.stdout
+    fields:
+        DICOM tag names to use as columns, in this order. Values not in fields
+        are not written
+    format_level:
+        One of FormatLevel. Write a row per object of this level. Defaults to
+        None, meaning guess for each result
+    """
+    writer = csv.writer(stream, lineterminator="\n")
+    writer.writerow(fields)
+    error_count = 0
+    for result in results:
+        if result.is_error():
+            error_count += 1
+            continue
+        writer.writerows(
+            iter_result_rows(result, fields=fields, format_level=format_level)
+        )
+        stream.flush()
+    if error_count:
+        logger.warning(
+            f"{error_count} queries resulted in error. Excluding those from csv"
+        )
+
+
+def iter_result_rows(
+    result: QueryStudyResult,
+    fields: List[str],
+    format_level: Optional[FormatLevel] = None,
+) -> Iterator[List[Any]]:
+    """A row of values for each object at format level in result. Higher level
+    values are repeated on each row, like in query_results_to_table().
+    Missing values are empty strings
+    """
+    field_set = set(fields)
+
+    def extract(ds: "Dataset") -> Dict[str, Any]:
+        return {x.keyword: x.value for x in ds if x.keyword in field_set}
+
+    for values in iter_result_values(result, extract, format_level=format_level):
+        yield [values.get(x, "") for x in fields]
+
+
+def iter_result_values(
+    result: QueryStudyResult,
+    extract: Callable[["Dataset"], Dict[str, Any]],
+    format_level: Optional[FormatLevel] = None,
+) -> Iterator[Dict[str, Any]]:
+    """{Keyword: value} for each object at format level in result, with the values
+    of all higher levels merged in.
+
+    Parameters
+    ----------
+    result:
+        The result to flatten
+    extract:
+        Turns a dataset into {Keyword: value}. Called once per DICOM object.
+        Study values also get SOURCE_CHANNEL_FIELD if study was found by a
+        federated search
+    format_level:
+        One of FormatLevel. Defaults to None, meaning guess from result
+    """
+    if not format_level:
+        format_level = guess_format_level([result])
+
+    def merge(*values: Dict[str, Any]) -> Dict[str, Any]:
+        merged: Dict[str, Any] = {}
+        for part in values:
+            merged.update(part)
+        return merged
+
+    study = result.content
+    study_values = extract(study.data)
+    study_values.update(source_channel_values(study))
+    if format_level == FormatLevel.STUDY:
+        yield merge({"StudyInstanceUID": study.uid}, study_values)
+        return
+    for series in study.series:
+        series_values = extract(series.data)
+        if format_level == FormatLevel.SERIES:
+            yield merge(study_values, series_values)
+            continue
+        for instance in series.instances:
+            yield merge(study_values, series_values, extract(instance.data))
@@ -1,15 +1,40 @@
 """For executing queries from command line"""
-from typing import List, Set
+import sys
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Optional, Set, TextIO
 
 import click
 from click import Choice
-from dicomtrolley.core import Query, QueryLevels, Study
-from dicomtrolley.trolley import Trolley
 
 from dicomtrolleytool.cli.base import TrolleyToolContext, logger
 from dicomtrolleytool.cli.click_parameter_types import DICOMTagNameListParamType
-from dicomtrolleytool.cli.output import ResultFormat, format_query_results
-from dicomtrolleytool.query import collect_query_results
+from dicomtrolleytool.cli.identifiers import (
+    column_option,
+    input_file_option,
+    iter_identifiers,
+)
+from dicomtrolleytool.cli.output import (
+    FILE_ONLY_FORMATS,
+    SOURCE_CHANNEL_FIELD,
+    ResultFormat,
+    write_query_results,
+)
+from dicomtrolleytool.query import (
+    QueryResult,
+    iter_checkpointed_results,
+    iter_query_results,
+    retry_failed_queries,
+)
+
+if TYPE_CHECKING:
+    from dicomtrolley.core import Query, Study
+
+    from dicomtrolleytool.journal import QueryJournal
+
+
+# Values of dicomtrolley QueryLevels. Not imported from there because importing
+# dicomtrolley.core (and pydicom) slows down startup of every trolley command
+QUERY_LEVELS = ["STUDY", "SERIES", "INSTANCE"]
 
 
 @click.group()
@@ -45,21 +70,127 @@ DEFAULT_INCLUDE_FIELDS_INSTANCE = {
     "SoftwareVersions",
 }
 
+# Identify the objects of each level. Always queried and shown first, so that
+# each output row can be traced to the study, series or instance it describes
+LEVEL_UID_FIELDS = ["StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID"]
+
+
+def get_level_uid_fields(query_level) -> List[str]:
+    """UID fields of query level and all levels above it"""
+    return LEVEL_UID_FIELDS[: QUERY_LEVELS.index(query_level) + 1]
+
 
 def get_default_include_fields(query_level) -> Set[str]:
     """DICOM fields to include for different levels of queries"""
+    from dicomtrolley.core import QueryLevels
+
     if query_level == QueryLevels.STUDY:
-        return DEFAULT_INCLUDE_FIELDS_STUDY
+        fields = DEFAULT_INCLUDE_FIELDS_STUDY
     elif query_level == QueryLevels.SERIES:
-        return DEFAULT_INCLUDE_FIELDS_STUDY | DEFAULT_INCLUDE_FIELDS_SERIES
+        fields = DEFAULT_INCLUDE_FIELDS_STUDY | DEFAULT_INCLUDE_FIELDS_SERIES
     elif query_level == QueryLevels.INSTANCE:
-        return (
+        fields = (
             DEFAULT_INCLUDE_FIELDS_STUDY
             | DEFAULT_INCLUDE_FIELDS_SERIES
             | DEFAULT_INCLUDE_FIELDS_INSTANCE
         )
     else:
         raise ValueError(f"Unknown query level '{query_level}'")
+    return fields | set(get_level_uid_fields(query_level))
+
+
+parallel_option = click.option(
+    "--parallel",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Run this many queries at the same time. Capped by the maximum set for "
+    "the searcher channel",
+    show_default=True,
+)
+
+batch_size_option = click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Combine up to this many lookups into a single query to the server. Use 1 "
+    "to send each lookup separately. Defaults to the maximum set for the searcher "
+    "channel",
+)
+
+cache_option = click.option(
+    "--cache/--no-cache",
+    default=False,
+    help="Use results from local query cache if available. Store new results",
+    show_default=True,
+)
+max_age_option = click.option(
+    "--max-age",
+    type=click.IntRange(min=0),
+    default=None,
+    help="Only use cached results younger than this many seconds. Defaults to "
+    "query_cache_max_age setting",
+)
+local_option = click.option(
+    "--local",
+    is_flag=True,
+    default=False,
+    help="Answer from local metadata index only. Does not contact the server. See "
+    "'trolley index'",
+)
+retry_failed_option = click.option(
+    "--retry-failed",
+    is_flag=True,
+    default=False,
+    help="When done, run all failed queries once more. Their results come last",
+)
+
+expand_option = click.option(
+    "--expand",
+    is_flag=True,
+    default=False,
+    help="For SERIES and INSTANCE level: query study level first, then series and "
+    "instances with parallel sub-queries. Faster for large studies. Sub-queries are "
+    "capped by the maximum set for the searcher channel",
+)
+
+checkpoint_option = click.option(
+    "--checkpoint/--no-checkpoint",
+    default=None,
+    help="Store each result in a job journal, so that an interrupted run can be "
+    "resumed with --resume. Default is on with --input-file, off otherwise",
+)
+resume_option = click.option(
+    "--resume",
+    "resume_job",
+    type=str,
+    default=None,
+    metavar="JOB_ID",
+    help="Continue this query job. Queries that found a study before are not sent "
+    "again. Their stored results are output instead. See 'trolley job list'",
+)
+
+channels_option = click.option(
+    "--channels",
+    type=str,
+    default=None,
+    help="Send each query to these searcher channels at the same time, comma "
+    "separated. Used instead of the searcher channel from settings. See 'trolley "
+    "channel list'",
+)
+first_hit_option = click.option(
+    "--first-hit",
+    is_flag=True,
+    default=False,
+    help="With --channels: use the first channel that finds anything. Default is "
+    "to wait for all channels and merge results",
+)
+channel_timeout_option = click.option(
+    "--channel-timeout",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+    help="With --channels: stop waiting for a channel after this many seconds. "
+    "Channels can set their own with 'federated_timeout'. Default is no timeout",
+)
 
 
 @click.command(short_help="Query by StudyInstanceUID", name="suid")
@@ -67,28 +198,91 @@ def get_default_include_fields(query_level) -> Set[str]:
 @click.argument("suids", type=str, nargs=-1)
 @click.option(
     "--query-level",
-    type=Choice(choices=QueryLevels, case_sensitive=False),
-    default=QueryLevels.STUDY,
+    type=Choice(choices=QUERY_LEVELS, case_sensitive=False),
+    default="STUDY",
     help="Show information on study, series or instance level",
     show_default=True,
 )
-def query_suid(context: TrolleyToolContext, suids, query_level):
+@parallel_option
+@batch_size_option
+@cache_option
+@max_age_option
+@local_option
+@retry_failed_option
+@expand_option
+@channels_option
+@first_hit_option
+@channel_timeout_option
+@checkpoint_option
+@resume_option
+@input_file_option
+@column_option
+def query_suid(
+    context: TrolleyToolContext,
+    suids,
+    query_level,
+    parallel,
+    batch_size,
+    cache,
+    max_age,
+    local,
+    retry_failed,
+    expand,
+    channels,
+    first_hit,
+    channel_timeout,
+    checkpoint,
+    resume_job,
+    input_file,
+    column,
+):
     """Query StudyInstanceUID or space-separated list"""
-    trolley: Trolley = context.trolley
-    for suid in suids:
-        result = trolley.find_study(
-            Query(
-                StudyInstanceUID=suid,
-                include_fields=get_default_include_fields(query_level),
-                query_level=query_level,
-            )
-        )
+    from dicomtrolley.core import Query
 
-        logger.info(result.data)
-        if result.series:
-            logger.info("All series")
-            for x in result.series:
-                logger.info(x.data)
+    suids = iter_identifiers(suids, input_file=input_file, column=column)
+    use_federated_search(
+        context,
+        channels=channels,
+        first_hit=first_hit,
+        channel_timeout=channel_timeout,
+        local=local,
+    )
+    use_local_or_cache(context, local=local, cache=cache, max_age=max_age)
+    if expand and not local:
+        context.use_query_expansion()
+    queries = (
+        Query(
+            StudyInstanceUID=suid,
+            include_fields=get_default_include_fields(query_level),
+            query_level=query_level,
+        )
+        for suid in suids
+    )
+    journal = open_query_journal(
+        context,
+        checkpoint=checkpoint,
+        resume_job=resume_job,
+        local=local,
+        input_file=input_file,
+    )
+    with query_job(journal):
+        for query_result in run_queries(
+            context,
+            queries,
+            local=local,
+            parallel=parallel,
+            batch_size=batch_size,
+            retry_failed=retry_failed,
+            journal=journal,
+        ):
+            if query_result.is_error():
+                continue  # already logged as warning
+            result: "Study" = query_result.content
+            logger.info(result.data)
+            if result.series:
+                logger.info("All series")
+                for x in result.series:
+                    logger.info(x.data)
 
 
 @click.command(short_help="Query by Accession Number", name="acc")
@@ -96,8 +290,8 @@ def query_suid(context: TrolleyToolContext, suids, query_level):
 @click.argument("acc_nums", type=str, nargs=-1)
 @click.option(
     "--query-level",
-    type=Choice(choices=QueryLevels, case_sensitive=False),
-    default=QueryLevels.STUDY,
+    type=Choice(choices=QUERY_LEVELS, case_sensitive=False),
+    default="STUDY",
     help="Show information on study, series or instance level",
     show_default=True,
 )
@@ -116,10 +310,32 @@ def query_suid(context: TrolleyToolContext, suids, query_level):
 )
 @click.option(
     "--output-fields",
-    type=DICOMTagNameListParamType(),
-    help="Show only these DICOM tags in output. Default is to show all",
+    type=DICOMTagNameListParamType(extra_keywords=[SOURCE_CHANNEL_FIELD]),
+    help="Show only these DICOM tags in output. Default is to show all. "
+    "SourceChannel shows the channels each study was found on with --channels",
     default=[],
 )
+@click.option(
+    "--output-file",
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="Write results to this file instead of console. Required for ARROW and "
+    "PARQUET output formats",
+)
+@parallel_option
+@batch_size_option
+@cache_option
+@max_age_option
+@local_option
+@retry_failed_option
+@expand_option
+@channels_option
+@first_hit_option
+@channel_timeout_option
+@checkpoint_option
+@resume_option
+@input_file_option
+@column_option
 def query_accession_number(
     context: TrolleyToolContext,
     acc_nums,
@@ -127,39 +343,107 @@ def query_accession_number(
     output_format,
     include_fields,
     output_fields,
+    output_file,
+    parallel,
+    batch_size,
+    cache,
+    max_age,
+    local,
+    retry_failed,
+    expand,
+    channels,
+    first_hit,
+    channel_timeout,
+    checkpoint,
+    resume_job,
+    input_file,
+    column,
 ):
     """Query Accession number or space-separated list"""
+    from dicomtrolley.core import Query
+
+    acc_nums = iter_identifiers(acc_nums, input_file=input_file, column=column)
+    use_federated_search(
+        context,
+        channels=channels,
+        first_hit=first_hit,
+        channel_timeout=channel_timeout,
+        local=local,
+    )
+    use_local_or_cache(context, local=local, cache=cache, max_age=max_age)
+    if expand and not local:
+        context.use_query_expansion()
     output_format = output_format.upper()  # option is case-insensitive in cli
+    if output_format in FILE_ONLY_FORMATS and not output_file:
+        raise click.UsageError(f"{output_format} output needs --output-file")
 
     include_fields = list(get_default_include_fields(query_level) | set(include_fields))
 
-    queries = [
+    queries = (
         Query(
             AccessionNumber=acc_num,
             include_fields=include_fields,
             query_level=query_level,
         )
         for acc_num in acc_nums
-    ]
-
-    query_results = collect_query_results(trolley=context.trolley, queries=queries)
-    logger.info(f"Found {len(query_results)} results")
-    print(
-        format_query_results(
-            query_results,
-            output_format=output_format,
-            output_field_filter=output_fields,
-        )
     )
 
+    journal = open_query_journal(
+        context,
+        checkpoint=checkpoint,
+        resume_job=resume_job,
+        local=local,
+        input_file=input_file,
+    )
+    query_results = run_queries(
+        context,
+        queries,
+        local=local,
+        parallel=parallel,
+        batch_size=batch_size,
+        retry_failed=retry_failed,
+        journal=journal,
+    )
+    # columns when output fields are not given. Level UIDs first to identify rows
+    uid_fields = get_level_uid_fields(query_level)
+    columns = (
+        uid_fields
+        + sorted(set(include_fields) - set(uid_fields))
+        + ([SOURCE_CHANNEL_FIELD] if channels else [])
+    )
+    counter = ResultCounter(query_results)
+    with query_job(journal), profiled_output(context, counter) as results:
+        if output_format in FILE_ONLY_FORMATS:
+            from dicomtrolleytool.cli.export import write_query_results_arrow
+
+            write_query_results_arrow(
+                results,
+                path=output_file,
+                fields=output_fields or columns,
+                output_format=output_format,
+                format_level=query_level,
+            )
+        else:
+            with open_output(output_file) as stream:
+                write_query_results(
+                    results,
+                    stream=stream,
+                    output_format=output_format,
+                    output_field_filter=output_fields,
+                    include_fields=columns,
+                    format_level=query_level,
+                )
+    logger.info(f"Found {counter.count} results")
+
 
 @click.command(short_help="Query by PatientID", name="patient_id")
 @click.pass_obj
 @click.argument("patient_id", type=str)
 def query_patient_id(context: TrolleyToolContext, patient_id):
     """Query StudyInstanceUID"""
-    trolley: Trolley = context.trolley
-    results = trolley.find_studies(
+    from dicomtrolley.core import Query
+
+    results = context.trolley.find_studies(
         Query(
             PatientID=patient_id,
             include_fields=[
@@ -179,6 +463,177 @@ def query_patient_id(context: TrolleyToolContext, patient_id):
         logger.info(f'no results found for PatientID "{patient_id}"')
 
 
+class ResultCounter:
+    """Passes through query results while counting them. For reporting on
+    streamed results without keeping them in memory
+    """
+
+    def __init__(self, results: Iterable[QueryResult]):
+        self.results = results
+        self.count = 0
+
+    def __iter__(self) -> Iterator[QueryResult]:
+        for result in self.results:
+            self.count += 1
+            yield result
+
+
+def run_queries(
+    context: TrolleyToolContext,
+    queries: Iterable["Query"],
+    local: bool,
+    parallel: int,
+    batch_size: Optional[int],
+    retry_failed: bool,
+    journal: Optional["QueryJournal"] = None,
+) -> Iterator[QueryResult]:
+    """Run queries with the options given to a query command. Lazy"""
+    max_workers = 1 if local else context.max_parallel_queries(parallel)
+
+    def run_live(to_run: Iterable["Query"]) -> Iterator[QueryResult]:
+        results = iter_query_results(
+            trolley=context.trolley,
+            queries=to_run,
+            max_workers=max_workers,
+            planner=None if local else context.get_query_planner(batch_size),
+        )
+        if retry_failed:
+            results = retry_failed_queries(
+                context.trolley, results, max_workers=max_workers
+            )
+        return results
+
+    def run(to_run: Iterable["Query"]) -> Iterator[QueryResult]:
+        if not context.query_cache:
+            return run_live(to_run)
+        from dicomtrolleytool.cache import iter_cached_results
+
+        return iter_cached_results(
+            context.query_cache,
+            to_run,
+            run_queries=run_live,
+            channel_key=context.searcher_key,
+            max_age=context.query_cache_max_age,
+        )
+
+    if not journal:
+        return run(queries)
+    return iter_checkpointed_results(
+        journal, queries, run_queries=run, channel_key=context.searcher_key
+    )
+
+
+def open_query_journal(
+    context: TrolleyToolContext,
+    checkpoint: Optional[bool],
+    resume_job: Optional[str],
+    local: bool,
+    input_file: Optional[TextIO],
+) -> Optional["QueryJournal"]:
+    """Journal for storing the results of this query command, if any. Checkpointing
+    is on by default for queries from a file, as those tend to be long-running
+    """
+    if resume_job and checkpoint is False:
+        raise click.UsageError("--resume and --no-checkpoint cannot be used together")
+    if local:
+        if checkpoint or resume_job:
+            raise click.UsageError(
+                "--local queries do not contact the server and cannot be checkpointed"
+            )
+        return None
+    if not (checkpoint or resume_job or (checkpoint is None and input_file)):
+        return None
+    journal = context.get_query_journal(job_id=resume_job)
+    if resume_job:
+        logger.info(
+            f"Resuming query job '{journal.job_id}'. {len(journal.offsets)} queries "
+            f"already finished"
+        )
+    else:
+        logger.info(f"Storing results in query job '{journal.job_id}'")
+    return journal
+
+
+@contextmanager
+def query_job(journal: Optional["QueryJournal"]) -> Iterator[None]:
+    """Close journal when done. Tell how to resume if interrupted"""
+    if not journal:
+        yield
+        return
+    try:
+        yield
+    except (Exception, KeyboardInterrupt):
+        logger.warning(
+            f"Query job interrupted. Continue with the same command and "
+            f"--resume {journal.job_id}"
+        )
+        raise
+    finally:
+        journal.close()
+
+
+def use_federated_search(
+    context: TrolleyToolContext,
+    channels: Optional[str],
+    first_hit: bool,
+    channel_timeout: Optional[float],
+    local: bool,
+):
+    """Set up trolley to search several channels at the same time, if asked"""
+    if not channels:
+        if first_hit or channel_timeout:
+            raise click.UsageError(
+                "--first-hit and --channel-timeout only work with --channels"
+            )
+        return
+    if local:
+        raise click.UsageError("--local and --channels cannot be used together")
+    from dicomtrolleytool.federation import FederationMode
+
+    names = list(dict.fromkeys(x.strip() for x in channels.split(",") if x.strip()))
+    context.use_federated_search(
+        names,
+        mode=FederationMode.FIRST if first_hit else FederationMode.MERGE,
+        timeout=channel_timeout,
+    )
+
+
+def use_local_or_cache(
+    context: TrolleyToolContext, local: bool, cache: bool, max_age: Optional[int]
+):
+    """Set up trolley to answer queries from local index or query cache, if asked"""
+    if local and cache:
+        raise click.UsageError("--local and --cache cannot be used together")
+    if local:
+        context.use_local_index()
+    elif cache:
+        context.use_query_cache(max_age=max_age)
+
+
+@contextmanager
+def profiled_output(
+    context: TrolleyToolContext, results: Iterable[QueryResult]
+) -> Iterator[Iterable[QueryResult]]:
+    """Record time spent writing results in this context, if profiling"""
+    if not context.profiler:
+        yield results
+        return
+    from dicomtrolleytool.profiling import profile_formatting
+
+    with profile_formatting(context.profiler, results) as wrapped:
+        yield wrapped
+
+
+@contextmanager
+def open_output(path: Optional[str]) -> Iterator[TextIO]:
+    """Text stream to write output to. File at path if given, console otherwise"""
+    if not path:
+        yield sys.stdout
+        return
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        yield f
+
+
 def print_to_console(string_in):
     """Print string to console. Separate from logging to make multi-line
     output more manageable
@@ -186,11 +641,11 @@ def print_to_console(string_in):
     print(string_in)
 
 
-def study_to_string(study: Study) -> str:
+def study_to_string(study: "Study") -> str:
     return f"Study {study.uid}\n" + "\n".join(str(x) for x in study.data)
 
 
-def studies_to_string(studies: List[Study]) -> str:
+def studies_to_string(studies: List["Study"]) -> str:
     return "\n\n".join(list(study_to_string(x) for x in studies))
 
 
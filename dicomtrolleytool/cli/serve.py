@@ -0,0 +1,124 @@
+"""Commands for running trolley as a daemon that other commands forward to"""
+import pathlib
+import signal
+from typing import List, Optional
+
+import click
+
+from dicomtrolleytool.cli.base import TrolleyToolContext
+from dicomtrolleytool.daemon import (
+    DaemonError,
+    TrolleyDaemon,
+    send_request,
+)
+from dicomtrolleytool.logs import get_module_logger
+
+logger = get_module_logger("serve")
+
+socket_option = click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default=None,
+    help="Unix socket of the daemon. Defaults to ~/.trolleytool/daemon.sock, or "
+    "$TROLLEYTOOL_SOCKET if set",
+)
+
+
+@click.group(invoke_without_command=True)
+@socket_option
+@click.option(
+    "--idle-timeout",
+    type=int,
+    default=600,
+    show_default=True,
+    help="Stop after this many seconds without commands. 0 means never",
+)
+@click.pass_context
+def serve(ctx, socket_path: Optional[pathlib.Path], idle_timeout: int):
+    """Run a daemon that keeps settings, channels and logged-in sessions ready.
+
+    While it runs, other trolley commands are sent to it instead of starting up
+    and logging in themselves. Runs in the foreground until stopped with
+    'trolley serve stop', ctrl-c or SIGTERM, or until idle for --idle-timeout
+    """
+    if ctx.invoked_subcommand:
+        return
+    context: TrolleyToolContext = ctx.obj
+    warm_up(context)
+    daemon = TrolleyDaemon(
+        run_command=lambda argv: run_command(context, argv),
+        socket_path=socket_path,
+        idle_timeout=idle_timeout or None,
+    )
+    try:
+        daemon.bind()
+    except DaemonError as e:
+        raise click.UsageError(str(e)) from e
+    signal.signal(signal.SIGTERM, lambda *_: daemon.stop())
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        logger.info("Interrupted. Stopping")
+
+
+@click.command(short_help="Stop running daemon")
+@socket_option
+def stop(socket_path: Optional[pathlib.Path]):
+    """Stop the daemon after the command it is running, if any"""
+    if send_request({"action": "stop"}, socket_path=socket_path) is None:
+        print("No daemon running")
+
+
+@click.command(short_help="Show whether daemon is running")
+@socket_option
+def status(socket_path: Optional[pathlib.Path]):
+    """Show whether a daemon is running and how many commands it ran"""
+    if send_request({"action": "status"}, socket_path=socket_path) is None:
+        print("No daemon running")
+
+
+def warm_up(context: TrolleyToolContext):
+    """Do the slow parts of starting a command once: imports, reading settings and
+    loading channels from keyring
+    """
+    import dicomtrolley.trolley  # noqa: F401
+
+    import dicomtrolleytool.cli.entrypoint  # noqa: F401
+
+    context.settings
+    context.session_cache
+    for name in (context.settings.searcher_name, context.settings.downloader_name):
+        try:
+            context.load_channel(name)
+        except Exception as e:  # commands that need this channel will say so
+            logger.warning(f"Could not load channel '{name}': {e}")
+
+
+def run_command(context: TrolleyToolContext, argv: List[str]) -> int:
+    """Run trolley command with arguments argv in a fork of context. Reads settings
+    again first if the settings file changed since the last command
+
+    Returns
+    -------
+    int
+        Exit code
+    """
+    from dicomtrolleytool.cli.entrypoint import main
+
+    context.reload_if_settings_changed()
+    command_context = context.fork()
+    try:
+        main.main(args=argv, prog_name="trolley", obj=command_context)
+    except SystemExit as e:  # click always exits in standalone mode
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        click.echo(e.code, err=True)
+        return 1
+    finally:
+        command_context.close()
+    return 0
+
+
+serve.add_command(stop)
+serve.add_command(status)
@@ -0,0 +1,37 @@
+"""Commands for managing logged-in sessions kept between commands"""
+import click
+
+from dicomtrolleytool.cli.base import TrolleyToolContext
+
+
+@click.group()
+def session():
+    """Manage logged-in sessions that are reused between commands"""
+
+
+@click.command(short_help="Show session cache statistics")
+@click.pass_obj
+def stats(context: TrolleyToolContext):
+    """Show how many logins were done and how many were avoided"""
+    session_cache = context.session_cache
+    if not session_cache:
+        print("Session cache is disabled in settings")
+        return
+    cache_stats = session_cache.stats()
+    print(f"Session cache at '{session_cache.path}'")
+    print(f"logins        : {cache_stats.logins}")
+    print(f"logins avoided: {cache_stats.logins_avoided}")
+
+
+@click.command(short_help="Forget all sessions")
+@click.pass_obj
+def clear(context: TrolleyToolContext):
+    """Forget all cached sessions. Next command will log in again"""
+    session_cache = context.session_cache
+    if session_cache:
+        session_cache.clear()
+        print(f"Cleared session cache at '{session_cache.path}'")
+
+
+session.add_command(stats)
+session.add_command(clear)
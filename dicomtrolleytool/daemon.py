@@ -0,0 +1,370 @@
+"""Running trolley commands in a long-running process
+
+Each trolley command pays for python imports, reading settings and keyring and
+logging in to servers. A daemon started with 'trolley serve' pays this once.
+Commands forward their arguments to it over a unix socket and print what it
+sends back.
+
+Notes
+-----
+Imported by the trolley entrypoint before anything else. Keep module level
+imports light, so that forwarding a command takes milliseconds.
+
+Protocol: one json object per line. The client sends a single request, either
+{"argv": [...], "cwd": ..., "stdin": ...} or {"action": "stop" | "status"}. The
+daemon answers with any number of {"out": text} and {"err": text} messages and
+ends with {"exit": exit_code}. If it is running another command, it answers
+{"busy": true} instead and the client runs the command itself
+"""
+
+import json
+import os
+import pathlib
+import socket
+import sys
+import threading
+import time
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+from io import StringIO, TextIOBase
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+from dicomtrolleytool.exceptions import TrolleyToolError
+from dicomtrolleytool.logs import get_module_logger
+
+logger = get_module_logger("daemon")
+
+DEFAULT_SOCKET_PATH = pathlib.Path.home() / ".trolleytool" / "daemon.sock"
+SOCKET_PATH_ENV = "TROLLEYTOOL_SOCKET"  # use this socket instead of default
+NO_DAEMON_ENV = "TROLLEYTOOL_NO_DAEMON"  # set to never forward commands
+
+# Always run in the calling process. Interactive, or about the daemon itself
+LOCAL_COMMANDS = ("serve", "settings", "channel")
+
+
+def get_socket_path() -> pathlib.Path:
+    return pathlib.Path(os.environ.get(SOCKET_PATH_ENV) or DEFAULT_SOCKET_PATH)
+
+
+def should_forward(argv: Sequence[str]) -> bool:
+    """True if the command given by argv can be run by a daemon"""
+    if os.environ.get(NO_DAEMON_ENV):
+        return False
+    if any(x.startswith("--profile") for x in argv):
+        return False  # profile should time this process, not the daemon
+    command = next((x for x in argv if not x.startswith("-")), None)
+    if command is None or command in LOCAL_COMMANDS:
+        return False
+    if "-" in argv and sys.stdin.isatty():
+        return False  # reading stdin interactively
+    return True
+
+
+def write_message(stream: IO[bytes], message: Dict[str, Any]):
+    stream.write((json.dumps(message) + "\n").encode())
+    stream.flush()
+
+
+def read_messages(stream: IO[bytes]) -> Iterator[Dict[str, Any]]:
+    for line in stream:
+        yield json.loads(line)
+
+
+def connect(socket_path: pathlib.Path) -> Optional[socket.socket]:
+    """Connection to daemon at socket_path. None if no daemon is listening"""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(str(socket_path))
+    except OSError:
+        connection.close()
+        return None
+    return connection
+
+
+def send_request(
+    request: Dict[str, Any], socket_path: Optional[pathlib.Path] = None
+) -> Optional[int]:
+    """Send request to daemon and write what it sends back to stdout and stderr
+
+    Returns
+    -------
+    Optional[int]
+        Exit code of the command. None if no daemon is listening
+    """
+    connection = connect(socket_path or get_socket_path())
+    if not connection:
+        return None
+    return exchange(connection, request)
+
+
+def forward(argv: List[str], socket_path: Optional[pathlib.Path] = None):
+    """Run command on daemon, if it is running and not busy with another command
+
+    Returns
+    -------
+    Optional[int]
+        Exit code of the command. None if no daemon is listening or it is busy. Run
+        the command locally in that case
+    """
+    connection = connect(socket_path or get_socket_path())
+    if not connection:
+        return None  # before reading stdin, so a local command can still read it
+    stdin = sys.stdin.read() if "-" in argv else None
+    exit_code = exchange(connection, {"argv": argv, "cwd": os.getcwd(), "stdin": stdin})
+    if exit_code is None and stdin is not None:
+        sys.stdin = StringIO(stdin)  # already read. Keep it for the local command
+    return exit_code
+
+
+def exchange(connection: socket.socket, request: Dict[str, Any]) -> Optional[int]:
+    """Send request over connection and write what comes back to stdout and stderr
+
+    Returns
+    -------
+    Optional[int]
+        Exit code sent by daemon. None if daemon is busy with another command
+    """
+    with connection, connection.makefile("rwb") as stream:
+        write_message(stream, request)
+        for message in read_messages(stream):
+            if message.get("busy"):
+                return None
+            if "out" in message:
+                sys.stdout.write(message["out"])
+                sys.stdout.flush()
+            elif "err" in message:
+                sys.stderr.write(message["err"])
+                sys.stderr.flush()
+            elif "exit" in message:
+                return int(message["exit"])
+    sys.stderr.write("trolley daemon stopped before the command finished\n")
+    return 1
+
+
+class MessageWriter(TextIOBase):
+    """Text stream that sends everything written to it as a message"""
+
+    def __init__(self, stream: IO[bytes], key: str):
+        self.stream = stream
+        self.key = key
+        self.lost = False  # True if client went away
+
+    @property
+    def encoding(self):
+        return "utf-8"
+
+    def writable(self):
+        return True
+
+    def write(self, text: str) -> int:
+        if not isinstance(text, str):  # click checks for binary streams like this
+            raise TypeError(f"write() argument must be str, not {type(text)}")
+        if text:
+            try:
+                write_message(self.stream, {self.key: text})
+            except OSError:
+                self.lost = True
+                raise
+        return len(text)
+
+
+class TrolleyDaemon:
+    """Runs commands sent to a unix socket in this process, one at a time.
+
+    Commands run in a worker thread, so that requests are still answered while a
+    command runs. Commands sent meanwhile are answered with 'busy', and clients
+    run them themselves. A long download or query in the daemon then does not
+    hold up other commands, and commands started in parallel still run in
+    parallel
+    """
+
+    def __init__(
+        self,
+        run_command: Callable[[List[str]], int],
+        socket_path: Optional[pathlib.Path] = None,
+        idle_timeout: Optional[float] = 600,
+        poll_interval: float = 1.0,
+    ):
+        """
+
+        Parameters
+        ----------
+        run_command:
+            Runs a trolley command given its arguments and returns the exit code.
+            Writes output to sys.stdout and sys.stderr
+        socket_path:
+            Listen on this socket. Defaults to None, meaning use get_socket_path()
+        idle_timeout:
+            Stop after this many seconds without commands. None means never.
+            Defaults to 600
+        poll_interval:
+            Check for stop and idle timeout at least this often, in seconds
+        """
+        self.run_command = run_command
+        self.socket_path = socket_path or get_socket_path()
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self.commands_run = 0
+        self.started = time.monotonic()
+        self.last_active = self.started
+        self.stopped = False
+        self._socket: Optional[socket.socket] = None
+        self._worker: Optional[threading.Thread] = None
+
+    def bind(self):
+        """Start listening. Socket is only accessible by the current user
+
+        Raises
+        ------
+        DaemonError
+            If another daemon is already listening on socket_path
+        """
+        if self.socket_path.exists():
+            connection = connect(self.socket_path)
+            if connection:
+                connection.close()
+                raise DaemonError(
+                    f"A daemon is already listening on {self.socket_path}"
+                )
+            logger.debug(f"Removing stale socket {self.socket_path}")
+            self.socket_path.unlink()
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            self._socket.bind(str(self.socket_path))
+        finally:
+            os.umask(old_umask)
+        self._socket.listen()
+        self._socket.settimeout(self.poll_interval)
+
+    def serve(self):
+        """Run commands until stopped or idle for idle_timeout seconds"""
+        if not self._socket:
+            self.bind()
+        logger.info(f"Listening on {self.socket_path}")
+        try:
+            while not self.stopped:
+                try:
+                    connection, _ = self._socket.accept()
+                except socket.timeout:
+                    if self.is_idle():
+                        logger.info(f"No commands for {self.idle_timeout}s. Stopping")
+                        break
+                    continue
+                self.handle(connection)
+                self.last_active = time.monotonic()
+        finally:
+            if self._worker:
+                self._worker.join()
+            self.close()
+
+    def is_busy(self) -> bool:
+        """True if a command is running"""
+        return self._worker is not None and self._worker.is_alive()
+
+    def is_idle(self) -> bool:
+        if self.idle_timeout is None or self.is_busy():
+            return False
+        return time.monotonic() - self.last_active > self.idle_timeout
+
+    def stop(self):
+        """Stop after the current command. Safe to call from a signal handler"""
+        self.stopped = True
+
+    def close(self):
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+            self.socket_path.unlink(missing_ok=True)
+        logger.info(f"Stopped after {self.commands_run} commands")
+
+    def status(self) -> str:
+        return (
+            f"pid           : {os.getpid()}\n"
+            f"socket        : {self.socket_path}\n"
+            f"uptime        : {time.monotonic() - self.started:.0f}s\n"
+            f"commands run  : {self.commands_run}\n"
+            f"busy          : {'yes' if self.is_busy() else 'no'}\n"
+            f"idle timeout  : {self.idle_timeout}\n"
+        )
+
+    def handle(self, connection: socket.socket):
+        """Read one request from connection and answer it. Start a command in a
+        worker thread, or answer 'busy' if one is running already
+        """
+        stream = connection.makefile("rwb")
+        try:
+            request = next(read_messages(stream))
+        except (StopIteration, ValueError):
+            logger.debug("Ignoring empty or unreadable request")
+            request = {}
+        if "argv" in request and not self.is_busy():
+            self._worker = threading.Thread(
+                target=self.run_request,
+                args=(connection, stream, request),
+                name="trolley-command",
+                daemon=True,
+            )
+            self._worker.start()
+            return
+        with connection, stream:
+            try:
+                if request.get("action") == "stop":
+                    self.stop()
+                    write_message(stream, {"exit": 0})
+                elif request.get("action") == "status":
+                    write_message(stream, {"out": self.status()})
+                    write_message(stream, {"exit": 0})
+                elif "argv" in request:
+                    logger.debug(f"Busy. Not running {request['argv']}")
+                    write_message(stream, {"busy": True})
+            except OSError as e:
+                logger.warning(f"Lost connection to client: {e}")
+
+    def run_request(
+        self, connection: socket.socket, stream: IO[bytes], request: Dict[str, Any]
+    ):
+        """Run the command in request and send its exit code. Closes connection"""
+        with connection, stream:
+            try:
+                exit_code = self.run(
+                    request["argv"],
+                    cwd=request["cwd"],
+                    stdin=request.get("stdin"),
+                    stream=stream,
+                )
+                write_message(stream, {"exit": exit_code})
+            except OSError as e:
+                logger.warning(f"Lost connection to client: {e}")
+            finally:
+                self.last_active = time.monotonic()
+
+    def run(
+        self, argv: List[str], cwd: str, stdin: Optional[str], stream: IO[bytes]
+    ) -> int:
+        """Run command in the working directory of the client, sending output to
+        stream
+        """
+        logger.debug(f"Running {argv}")
+        self.commands_run += 1
+        own_cwd, own_stdin = os.getcwd(), sys.stdin
+        out, err = MessageWriter(stream, "out"), MessageWriter(stream, "err")
+        try:
+            os.chdir(cwd)
+            sys.stdin = StringIO(stdin or "")
+            with redirect_stdout(out), redirect_stderr(err):
+                try:
+                    return self.run_command(argv)
+                except Exception:
+                    if out.lost or err.lost:
+                        raise  # nobody to report to
+                    traceback.print_exc()
+                    return 1
+        finally:
+            os.chdir(own_cwd)
+            sys.stdin = own_stdin
+
+
+class DaemonError(TrolleyToolError):
+    pass
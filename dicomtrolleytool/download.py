@@ -0,0 +1,244 @@
+"""Downloading many studies at once"""
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+)
+
+from pydantic.main import BaseModel
+
+from dicomtrolleytool.journal import DownloadJournal
+from dicomtrolleytool.logs import get_module_logger
+from dicomtrolleytool.query import QueryPlanner, iter_query_results
+
+if TYPE_CHECKING:
+    from dicomtrolley.core import DICOMDownloadable, Query, Study
+    from dicomtrolley.trolley import Trolley
+    from pydicom import Dataset
+
+logger = get_module_logger("download")
+
+
+class DownloadReport(BaseModel):
+    """What happened during a batch download"""
+
+    requested: int = 0  # number of studies asked for
+    skipped: int = 0  # already downloaded according to journal
+    not_found: int = 0
+    downloaded: int = 0
+    failed: int = 0
+    instances: int = 0
+    size: int = 0  # in bytes
+    elapsed: float = 0  # in seconds
+    errors: Dict[str, str] = {}  # error text per failed StudyInstanceUID
+
+    @property
+    def studies_per_minute(self) -> float:
+        return self.downloaded / self.elapsed * 60 if self.elapsed else 0.0
+
+    @property
+    def megabytes_per_second(self) -> float:
+        return self.size / 1024 / 1024 / self.elapsed if self.elapsed else 0.0
+
+    def summary(self) -> str:
+        """Multi-line human-readable summary"""
+        return "\n".join(
+            [
+                f"Studies requested : {self.requested}",
+                f"Downloaded        : {self.downloaded}",
+                f"Already on disk   : {self.skipped}",
+                f"Not found         : {self.not_found}",
+                f"Failed            : {self.failed}",
+                f"Instances         : {self.instances}",
+                f"Size              : {self.size / 1024 / 1024:.1f} MB",
+                f"Time              : {self.elapsed:.1f} s",
+                f"Throughput        : {self.studies_per_minute:.1f} studies/min, "
+                f"{self.megabytes_per_second:.2f} MB/s",
+            ]
+            + [f"Failed {uid}: {error}" for uid, error in self.errors.items()]
+        )
+
+
+class BatchDownloader:
+    """Looks up and downloads many studies, with several searches and downloads
+    running at the same time.
+
+    Searching and downloading are pipelined: studies are downloaded as soon as they
+    have been found, while searches for the next studies continue. Only a limited
+    number of studies is kept in memory at any time.
+
+    If a journal is given, every downloaded instance and every finished study is
+    recorded. Running the same download again skips finished studies and, for
+    studies that were interrupted halfway, instances that are already on disk.
+    """
+
+    def __init__(
+        self,
+        trolley: "Trolley",
+        output_dir: Path,
+        journal: Optional[DownloadJournal] = None,
+        search_workers: int = 1,
+        download_workers: int = 4,
+        planner: Optional[QueryPlanner] = None,
+    ):
+        """
+
+        Parameters
+        ----------
+        trolley:
+            Search and download with this
+        output_dir:
+            Save downloaded studies here
+        journal:
+            Record progress here, and skip anything already recorded. Defaults to
+            None, meaning studies are always downloaded completely
+        search_workers:
+            Run at most this many searches at the same time. Defaults to 1
+        download_workers:
+            Download at most this many studies at the same time. Defaults to 4
+        planner:
+            If given, use this to combine searches. Defaults to None
+        """
+        self.trolley = trolley
+        self.output_dir = Path(output_dir)
+        self.journal = journal
+        self.search_workers = search_workers
+        self.download_workers = download_workers
+        self.planner = planner
+
+    def download(self, study_uids: Iterable[str]) -> DownloadReport:
+        """Find and download all studies
+
+        Studies that cannot be found or fail to download are logged and counted in
+        the report. They do not stop the download of other studies.
+        """
+        report = DownloadReport()
+        start = time.perf_counter()
+        found = iter_query_results(
+            self.trolley,
+            self.queries_to_run(study_uids, report),
+            max_workers=self.search_workers,
+            planner=self.planner,
+        )
+
+        in_flight: "Dict[Future[Tuple[int, int]], str]" = {}  # with study uid
+        with ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+            for result in found:
+                if result.is_error():
+                    report.not_found += 1  # already logged as warning
+                    continue
+                if len(in_flight) >= self.download_workers * 2:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    self.collect({x: in_flight.pop(x) for x in done}, report)
+                study = result.content
+                in_flight[executor.submit(self.download_study, study)] = study.uid
+            wait(in_flight)
+            self.collect(in_flight, report)
+
+        report.elapsed = time.perf_counter() - start
+        return report
+
+    def queries_to_run(
+        self, study_uids: Iterable[str], report: DownloadReport
+    ) -> Iterator["Query"]:
+        """Queries for all studies that have not been downloaded yet"""
+        from dicomtrolley.core import Query
+
+        for uid in study_uids:
+            report.requested += 1
+            if self.journal and self.journal.is_study_finished(uid):
+                logger.debug(f"Skipping {uid}. Already downloaded")
+                report.skipped += 1
+                continue
+            yield Query(StudyInstanceUID=uid)
+
+    @staticmethod
+    def collect(
+        futures: Mapping["Future[Tuple[int, int]]", str], report: DownloadReport
+    ):
+        """Add outcome of finished study downloads to report
+
+        Parameters
+        ----------
+        futures:
+            {finished download: StudyInstanceUID}
+        report:
+            Add to this
+        """
+        for future, study_uid in futures.items():
+            try:
+                instances, size = future.result()
+            except Exception as e:  # connection, disk, server. Keep going
+                logger.warning(f"Download of {study_uid} failed: {e}")
+                report.failed += 1
+                report.errors[study_uid] = str(e) or type(e).__name__
+            else:
+                report.downloaded += 1
+                report.instances += instances
+                report.size += size
+
+    def download_study(self, study: "Study") -> Tuple[int, int]:
+        """Download all instances of study that are not in journal yet
+
+        Returns
+        -------
+        Tuple[int, int]
+            Number of instances downloaded, total size in bytes
+
+        Raises
+        ------
+        Exception
+            If download fails, for example DICOMTrolleyError, a requests
+            ConnectionError or an OSError when saving
+        """
+        from dicomtrolley.core import DICOMObjectLevels
+
+        objects: List["DICOMDownloadable"] = [study]
+        finished = (
+            self.journal.get_finished_instances(study.uid) if self.journal else set()
+        )
+        if finished:
+            references = self.trolley.obtain_references(
+                objects=[study], max_level=DICOMObjectLevels.INSTANCE
+            )
+            objects = [x for x in references if x.instance_uid not in finished]
+            logger.info(
+                f"Resuming {study.uid}. {len(finished)} instances already "
+                f"downloaded, {len(objects)} to go"
+            )
+
+        instances, size = 0, 0
+        if objects:
+            for dataset in self.trolley.fetch_all_datasets(objects=objects):
+                self.trolley.storage.save(dataset=dataset, path=str(self.output_dir))
+                saved = self.saved_size(dataset)
+                instances += 1
+                size += saved
+                if self.journal:
+                    self.journal.mark_instance(
+                        study.uid, dataset.SOPInstanceUID, size=saved
+                    )
+        if self.journal:
+            self.journal.mark_study(study.uid)
+        return instances, size
+
+    def saved_size(self, dataset: "Dataset") -> int:
+        """Size on disk of saved dataset in bytes. 0 if this cannot be determined"""
+        from dicomtrolley.storage import StorageDir
+
+        storage = self.trolley.storage
+        if not isinstance(storage, StorageDir):
+            return 0
+        try:
+            path: Path = self.output_dir / storage.generate_path(dataset)
+            return path.stat().st_size
+        except OSError:
+            return 0
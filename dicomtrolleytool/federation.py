@@ -0,0 +1,281 @@
+"""Searching several archives at once and combining what they find"""
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from enum import Enum
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+from dicomtrolley.core import Query, Searcher, Series, Study
+from dicomtrolley.exceptions import DICOMTrolleyError
+from pydicom.datadict import add_private_dict_entry
+
+from dicomtrolleytool.logs import get_module_logger
+
+logger = get_module_logger("federation")
+
+# Name of the channel(s) a study was found on is stored in the study dataset, so
+# that it survives caching, journals and output. As (0009,xx01) in this block
+SOURCE_PRIVATE_CREATOR = "dicomtrolleytool"
+SOURCE_GROUP = 0x0009
+SOURCE_ELEMENT = 0x01
+# Channels that failed or timed out while a study was merged from the others. The
+# study might be missing series or instances held by those channels
+UNANSWERED_ELEMENT = 0x02
+
+add_private_dict_entry(
+    SOURCE_PRIVATE_CREATOR, 0x00090001, "LO", "Source Channel", "1-n"
+)
+add_private_dict_entry(
+    SOURCE_PRIVATE_CREATOR, 0x00090002, "LO", "Unanswered Channels", "1-n"
+)
+
+
+# Parallel queries per channel, for channels not given an executor
+DEFAULT_MAX_WORKERS = 4
+
+
+class FederationMode(str, Enum):
+    """How to combine results from several channels"""
+
+    MERGE = "MERGE"  # wait for all channels. Combine studies found on several
+    FIRST = "FIRST"  # use the first channel that finds anything. Ignore the rest
+
+
+class FederatedSearcher(Searcher):
+    """Sends each query to several searchers at the same time.
+
+    Queries for each channel run on that channel's executor, which limits the
+    number of parallel queries on the channel. A channel that fails or does not
+    answer within its timeout is skipped with a warning. If its query has not
+    started yet, it is cancelled. Otherwise it keeps running in the background on
+    one of the channel's workers, but is not waited for. Each study found is
+    tagged with the channel(s) it was found on, see get_source_channels(). In
+    MERGE mode, studies found while other channels were skipped are tagged as
+    partial, see is_partial()
+    """
+
+    def __init__(
+        self,
+        searchers: Mapping[str, Searcher],
+        mode: FederationMode = FederationMode.MERGE,
+        timeouts: Optional[Mapping[str, Optional[float]]] = None,
+        executors: Optional[Mapping[str, Executor]] = None,
+    ):
+        """
+
+        Parameters
+        ----------
+        searchers:
+            {channel name: searcher}. In MERGE mode, when several channels return
+            the same study, information from channels earlier in this mapping
+            takes precedence
+        mode:
+            How to combine results. Defaults to MERGE
+        timeouts:
+            {channel name: seconds}. Stop waiting for a channel after this long.
+            Channels not in timeouts, or with None, are waited for as long as
+            they take. Defaults to None, meaning no timeouts
+        executors:
+            {channel name: executor}. Run queries for each channel on this. Can be
+            shared between searchers. Channels not in executors get a thread pool
+            with DEFAULT_MAX_WORKERS threads. Defaults to None
+        """
+        if not searchers:
+            raise ValueError("A federated search needs at least one searcher")
+        self.searchers = dict(searchers)
+        self.mode = FederationMode(mode)
+        self.timeouts = dict(timeouts or {})
+        self.executors: Dict[str, Executor] = dict(executors or {})
+        for name in self.searchers:
+            if name not in self.executors:
+                self.executors[name] = ThreadPoolExecutor(
+                    max_workers=DEFAULT_MAX_WORKERS,
+                    thread_name_prefix=f"federated-{name}",
+                )
+
+    def __str__(self):
+        return f"FederatedSearcher ({', '.join(self.searchers)}, {self.mode.value})"
+
+    def find_studies(self, query: Query) -> Sequence[Study]:
+        """Run query on all searchers. Combine results according to mode
+
+        Raises
+        ------
+        FederatedSearchError
+            If nothing was found and at least one channel failed or timed out.
+            'Nothing found' cannot be trusted in that case
+        """
+        futures = {
+            self.executors[name].submit(searcher.find_studies, query): name
+            for name, searcher in self.searchers.items()
+        }
+        try:
+            found, failures = self.collect(futures)
+        finally:
+            for future in futures:  # not waited for. Do not run if not started
+                future.cancel()
+
+        studies = merge_results(found)
+        if not studies and failures:
+            raise FederatedSearchError(
+                f"Nothing found for query '{query.to_short_string()}', but not all "
+                f"channels answered: {'; '.join(failures.values())}"
+            )
+        if self.mode == FederationMode.MERGE:
+            for study in studies:  # a skipped channel might have had more
+                add_channels(study, UNANSWERED_ELEMENT, list(failures))
+        return studies
+
+    def collect(
+        self, futures: Dict["Future[Sequence[Study]]", str]
+    ) -> Tuple[Dict[str, Sequence[Study]], Dict[str, str]]:
+        """Wait for futures until all are done or timed out. In FIRST mode, stop as
+        soon as one channel found something
+
+        Returns
+        -------
+        Dict[str, Sequence[Study]]
+            {channel name: studies found} for each channel whose results should be
+            used, in the order of self.searchers
+        Dict[str, str]
+            {channel name: description} for each channel that failed or timed out
+        """
+        start = time.monotonic()
+        deadlines = {
+            x: start + self.timeouts[name]
+            for x, name in futures.items()
+            if self.timeouts.get(name) is not None
+        }
+        answers: Dict[str, Sequence[Study]] = {}  # in order of answering
+        failures: Dict[str, str] = {}
+        pending = set(futures)
+        while pending:
+            now = time.monotonic()
+            for future in [x for x in pending if deadlines.get(x, now + 1) <= now]:
+                name = futures[future]
+                logger.warning(
+                    f"Channel '{name}' did not answer within {self.timeouts[name]}s"
+                )
+                failures[name] = f"'{name}' timed out"
+                pending.discard(future)
+            if not pending:
+                break
+            next_deadline = min(
+                (deadlines[x] for x in pending if x in deadlines), default=None
+            )
+            done, pending = wait(
+                pending,
+                timeout=None if next_deadline is None else next_deadline - now,
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                name = futures[future]
+                try:
+                    answers[name] = future.result()
+                except Exception as e:
+                    logger.warning(f"Channel '{name}' failed: {e}")
+                    failures[name] = f"'{name}' failed: {e}"
+            if self.mode == FederationMode.FIRST and any(answers.values()):
+                first = next(x for x in answers if answers[x])
+                return {first: answers[first]}, failures
+        return {x: answers[x] for x in self.searchers if x in answers}, failures
+
+
+def merge_results(found: Mapping[str, Sequence[Study]]) -> List[Study]:
+    """Combine studies found on several channels. Studies with the same
+    StudyInstanceUID are merged: series and instances missing from the first
+    are added from the others. Each study is tagged with its channels
+
+    Parameters
+    ----------
+    found:
+        {channel name: studies found on that channel}
+    """
+    merged: Dict[str, Study] = {}
+    for channel, studies in found.items():
+        for study in studies:
+            if study.uid in merged:
+                merge_study(merged[study.uid], study)
+            else:
+                merged[study.uid] = study
+            add_source_channel(merged[study.uid], channel)
+    return list(merged.values())
+
+
+def merge_study(study: Study, other: Study):
+    """Add series and instances from other that are not in study yet"""
+    series_by_uid = {x.uid: x for x in study.series}
+    for series in other.series:
+        if series.uid in series_by_uid:
+            merge_series(series_by_uid[series.uid], series)
+        else:
+            series.parent = study
+            study.series = list(study.series) + [series]
+
+
+def merge_series(series: Series, other: Series):
+    known = {x.uid for x in series.instances}
+    new = [x for x in other.instances if x.uid not in known]
+    for instance in new:
+        instance.parent = series
+    series.instances = list(series.instances) + new
+
+
+def get_source_channels(study: Study) -> List[str]:
+    """Names of the channels study was found on. Empty if not from a federated
+    search
+    """
+    return get_channels(study, SOURCE_ELEMENT)
+
+
+def add_source_channel(study: Study, channel: str):
+    add_channels(study, SOURCE_ELEMENT, [channel])
+
+
+def get_unanswered_channels(study: Study) -> List[str]:
+    """Names of the channels that failed or timed out while study was merged from
+    the others. Empty if all channels answered
+    """
+    return get_channels(study, UNANSWERED_ELEMENT)
+
+
+def is_partial(study: Study) -> bool:
+    """True if study was merged while some channels failed or timed out. It might
+    be missing what those channels hold. Do not cache or checkpoint it as complete
+    """
+    return bool(get_unanswered_channels(study))
+
+
+def get_channels(study: Study, element: int) -> List[str]:
+    """Channel names stored in private element of study"""
+    try:
+        block = study.data.private_block(SOURCE_GROUP, SOURCE_PRIVATE_CREATOR)
+    except KeyError:
+        return []
+    if element not in block:
+        return []
+    value = block[element].value
+    return [value] if isinstance(value, str) else list(value)
+
+
+def add_channels(study: Study, element: int, channels: Sequence[str]):
+    """Add channel names to private element of study, if not there yet"""
+    existing = get_channels(study, element)
+    new = [x for x in channels if x not in existing]
+    if not new:
+        return
+    block = study.data.private_block(SOURCE_GROUP, SOURCE_PRIVATE_CREATOR, create=True)
+    block.add_new(element, "LO", existing + new)
+
+
+class FederatedSearchError(DICOMTrolleyError):
+    """Not all channels in a federated search answered.
+
+    Subclass of DICOMTrolleyError so that it ends up in a QueryErrorResult like any
+    other failed query
+    """
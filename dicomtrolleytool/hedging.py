@@ -0,0 +1,394 @@
+"""Sending requests to several equivalent servers (replicas) and using the fastest
+answer. Configured with channels.ReplicatedChannel
+
+Each request goes to the replica with the lowest recent latency. If it has not
+answered within the usual (95th percentile) latency of that replica, the same
+request is sent to the next replica as well, and whichever answers first is used.
+This cuts off the slow tail of latencies. Hedged requests are capped at a fraction
+of all requests, so a slow period does not double the load on the servers.
+"""
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    TypeVar,
+)
+
+from dicomtrolley.core import (
+    DICOMDownloadable,
+    Downloader,
+    InstanceReference,
+    NonInstanceParameterError,
+    NonSeriesParameterError,
+    Query,
+    Searcher,
+    Study,
+)
+
+from dicomtrolleytool.channels import HedgePolicy
+from dicomtrolleytool.logs import get_module_logger
+from dicomtrolleytool.retry import RetryPolicy
+
+logger = get_module_logger("hedging")
+
+# Raised by downloaders to ask trolley for more detailed objects. Not a failure of
+# the replica. Any other replica would raise the same
+QUERY_LEVEL_ERRORS = (NonInstanceParameterError, NonSeriesParameterError)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class LatencyTracker:
+    """Keeps recent latencies and a running score per replica. Safe to use from
+    several threads
+    """
+
+    def __init__(
+        self,
+        window: int = 200,
+        smoothing: float = 0.2,
+        failure_penalty: float = 2.0,
+        stale_after: float = 60.0,
+    ):
+        """
+
+        Parameters
+        ----------
+        window:
+            Keep this many latencies per replica for percentiles
+        smoothing:
+            Weight of the newest latency in the running score. Higher reacts
+            faster, lower is more stable
+        failure_penalty:
+            Multiply score by this for each failed request. A failed replica
+            ranks at least this much slower than the slowest other replica
+        stale_after:
+            Seconds. A replica not heard from this long is tried again as if new,
+            so that a replica that was slow once can win back traffic
+        """
+        self.window = window
+        self.smoothing = smoothing
+        self.failure_penalty = failure_penalty
+        self.stale_after = stale_after
+        self.samples: Dict[str, Deque[float]] = {}
+        self.scores: Dict[str, float] = {}
+        self._updated: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def record(self, replica: str, latency: float, failed: bool = False):
+        """Record a finished request to replica that took latency seconds"""
+        with self._lock:
+            score = self.scores.get(replica)
+            if failed:
+                # a quick failure such as a refused connection is not fast
+                slowest = max(self.scores.values(), default=0.0)
+                score = max(score or 0.0, latency, slowest) * self.failure_penalty
+            else:
+                self.samples.setdefault(replica, deque(maxlen=self.window)).append(
+                    latency
+                )
+                if score is None:
+                    score = latency
+                else:
+                    score += self.smoothing * (latency - score)
+            self.scores[replica] = score
+            self._updated[replica] = time.monotonic()
+
+    def record_slow(self, replica: str, waited: float):
+        """Replica has not answered after waited seconds. Rank it as at least that
+        slow until the answer comes in
+        """
+        with self._lock:
+            self.scores[replica] = max(self.scores.get(replica, 0.0), waited)
+            self._updated[replica] = time.monotonic()
+
+    def ranked(self, replicas: Sequence[str]) -> List[str]:
+        """replicas, fastest first. Replicas without a recent score come first, to
+        measure them
+        """
+        now = time.monotonic()
+        with self._lock:
+
+            def rank(replica: str) -> float:
+                updated = self._updated.get(replica)
+                if updated is None or now - updated > self.stale_after:
+                    return -1.0
+                return self.scores[replica]
+
+            return sorted(replicas, key=rank)
+
+    def percentile(self, replica: str, percent: float) -> Optional[float]:
+        """Latency below which percent of recent requests to replica finished. None
+        if there are no latencies for replica
+        """
+        with self._lock:
+            samples = sorted(self.samples.get(replica, ()))
+        if not samples:
+            return None
+        index = max(math.ceil(percent / 100 * len(samples)) - 1, 0)
+        return samples[index]
+
+    def sample_count(self, replica: str) -> int:
+        with self._lock:
+            return len(self.samples.get(replica, ()))
+
+
+class HedgeBudget:
+    """Allows hedged requests for at most a fraction of requests. Every request
+    adds ratio tokens, every hedge takes one. Unused tokens are kept up to a
+    maximum, so short bursts of hedging are possible
+    """
+
+    def __init__(self, ratio: float, max_tokens: float = 10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self._tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self) -> bool:
+        """Take a token for a hedged request. False if none are left"""
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class CallStart:
+    """The moment a call started running, which can be later than when it was
+    submitted if all workers were busy
+    """
+
+    def __init__(self):
+        self.time: Optional[float] = None  # time.monotonic()
+        self._event = threading.Event()
+
+    def set(self):
+        self.time = time.monotonic()
+        self._event.set()
+
+    def wait(self) -> float:
+        """Wait until the call started. Returns the moment it did"""
+        self._event.wait()
+        return self.time  # type: ignore[return-value]
+
+
+class Hedger:
+    """Runs a call on the fastest replica, hedging to the next replica when the
+    call takes unusually long and failing over to the next replica on errors that
+    might not happen there. Other errors are raised right away
+    """
+
+    def __init__(
+        self,
+        policy: HedgePolicy,
+        tracker: Optional[LatencyTracker] = None,
+        max_workers: int = 16,
+        is_retryable: Optional[Callable[[Exception], bool]] = None,
+    ):
+        """
+
+        Parameters
+        ----------
+        policy:
+            When and how much to hedge
+        tracker:
+            Record latencies here and route according to it. Defaults to None,
+            meaning create a new one
+        max_workers:
+            Run at most this many calls at the same time, hedged ones included
+        is_retryable:
+            Returns True if an error means the replica is down or overloaded. Only
+            these errors are failed over and count against the replica. Defaults
+            to None, meaning RetryPolicy().is_retryable
+        """
+        self.policy = policy
+        self.tracker = tracker or LatencyTracker()
+        self.is_retryable = is_retryable or RetryPolicy().is_retryable
+        self.budget = HedgeBudget(ratio=policy.max_hedge_ratio)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="hedged"
+        )
+        self.hedged = 0  # number of hedged requests sent
+
+    def hedge_delay(self, replica: str) -> float:
+        """Seconds to wait for replica before sending a hedged request"""
+        if self.tracker.sample_count(replica) < self.policy.min_samples:
+            return self.policy.initial_delay
+        delay = self.tracker.percentile(replica, self.policy.percentile)
+        return max(delay or 0.0, self.policy.min_delay)
+
+    def call(self, replicas: Mapping[str, T], function: Callable[[T], R]) -> R:
+        """function(replica) on the fastest replica, hedged if slow
+
+        Raises
+        ------
+        Exception
+            Any error that is not retryable right away. Otherwise the error of the
+            last replica tried, if all replicas failed
+        """
+        order = self.tracker.ranked(list(replicas))
+        self.budget.deposit()
+        pending: Dict["Future[R]", str] = {}
+        errors: List[Exception] = []
+        may_hedge = self.policy.enabled
+
+        def submit(name: str) -> CallStart:
+            start = CallStart()
+            future = self.executor.submit(
+                self.timed, name, replicas[name], function, start
+            )
+            pending[future] = name
+            return start
+
+        primary = order.pop(0)
+        primary_start = submit(primary)
+        while pending:
+            hedge_delay = None
+            if may_hedge and order:  # not counting time waiting for a worker
+                started_at = primary_start.wait()
+                hedge_delay = max(
+                    started_at + self.hedge_delay(primary) - time.monotonic(), 0.0
+                )
+            done, _ = wait(pending, timeout=hedge_delay, return_when=FIRST_COMPLETED)
+            if not done:  # slow. Hedge once, if budget allows
+                may_hedge = False
+                waited = time.monotonic() - primary_start.wait()
+                self.tracker.record_slow(primary, waited)
+                if self.budget.withdraw():
+                    logger.debug(
+                        f"No answer within {waited:.3f}s. Also asking '{order[0]}'"
+                    )
+                    self.hedged += 1
+                    submit(order.pop(0))
+                continue
+            for future in done:
+                name = pending.pop(future)
+                error = future.exception()
+                if error is None:
+                    return future.result()
+                if not self.should_fail_over(error):
+                    raise error
+                logger.debug(f"Replica '{name}' failed: {error}")
+                errors.append(error)
+            if not pending and order:
+                logger.info(f"Replica failed: {errors[-1]}. Trying '{order[0]}'")
+                primary = order.pop(0)
+                primary_start = submit(primary)
+        raise errors[-1]
+
+    def should_fail_over(self, error: BaseException) -> bool:
+        """True if error might not happen on another replica. Only such errors
+        count against a replica
+        """
+        if isinstance(error, QUERY_LEVEL_ERRORS) or not isinstance(error, Exception):
+            return False
+        return self.is_retryable(error)
+
+    def timed(
+        self,
+        name: str,
+        replica: T,
+        function: Callable[[T], R],
+        start: Optional["CallStart"] = None,
+    ) -> R:
+        """function(replica), recording latency. Also for calls nobody waits for
+        anymore, so that slow replicas are known to be slow. Errors that are not
+        retryable say nothing about the replica and are not recorded
+
+        Parameters
+        ----------
+        start:
+            Record the moment the call starts in this. Defaults to None
+        """
+        if start:
+            start.set()
+        began = time.perf_counter()
+        try:
+            result = function(replica)
+        except Exception as e:
+            if self.should_fail_over(e):
+                self.tracker.record(name, time.perf_counter() - began, failed=True)
+            raise
+        self.tracker.record(name, time.perf_counter() - began)
+        return result
+
+
+class HedgedSearcher(Searcher):
+    """Sends each query to the fastest of several equivalent searchers. See
+    Hedger
+    """
+
+    def __init__(self, replicas: Mapping[str, Searcher], hedger: Hedger):
+        """
+
+        Parameters
+        ----------
+        replicas:
+            {name: searcher} for servers that hold the same data
+        hedger:
+            Routes and hedges queries
+        """
+        self.replicas = dict(replicas)
+        self.hedger = hedger
+
+    def __str__(self):
+        return f"HedgedSearcher ({', '.join(self.replicas)})"
+
+    def find_studies(self, query: Query) -> Sequence[Study]:
+        return self.hedger.call(self.replicas, lambda x: x.find_studies(query))
+
+
+class HedgedDownloader(Downloader):
+    """Downloads from the fastest of several equivalent downloaders.
+
+    Single instances are hedged like queries. Streamed downloads are not, as
+    that would download everything twice. They go to the fastest replica, and
+    to the next one if a replica fails with a retryable error before sending
+    anything. Time to the first dataset counts as latency
+    """
+
+    def __init__(self, replicas: Mapping[str, Downloader], hedger: Hedger):
+        self.replicas = dict(replicas)
+        self.hedger = hedger
+
+    def __str__(self):
+        return f"HedgedDownloader ({', '.join(self.replicas)})"
+
+    def get_dataset(self, instance: InstanceReference):
+        return self.hedger.call(self.replicas, lambda x: x.get_dataset(instance))
+
+    def datasets(self, objects: Sequence[DICOMDownloadable]):
+        tracker = self.hedger.tracker
+        order = tracker.ranked(list(self.replicas))
+        for name in order:
+            start = time.perf_counter()
+            started = False
+            try:
+                for dataset in self.replicas[name].datasets(objects):
+                    if not started:
+                        tracker.record(name, time.perf_counter() - start)
+                        started = True
+                    yield dataset
+                return
+            except Exception as e:
+                if not self.hedger.should_fail_over(e):
+                    raise
+                tracker.record(name, time.perf_counter() - start, failed=True)
+                if started or name == order[-1]:
+                    raise
+                logger.info(f"Replica '{name}' failed: {e}. Trying next replica")
@@ -0,0 +1,58 @@
+"""Reading lists of identifiers like AccessionNumbers or StudyInstanceUIDs"""
+import csv
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, TextIO, TypeVar
+
+from dicomtrolleytool.exceptions import TrolleyToolError
+
+T = TypeVar("T")
+
+
+def read_identifiers(stream: TextIO, column: Optional[str] = None) -> Iterator[str]:
+    """Read identifiers from a newline-separated or CSV file, one at a time.
+
+    Parameters
+    ----------
+    stream:
+        Read from this. Can be an open file or stdin
+    column:
+        If given, stream is read as CSV with a header line and identifiers are
+        taken from this column. If not given, the first value on each line is
+        taken. This means plain newline-separated files work as well.
+
+    Returns
+    -------
+    Iterator[str]
+        Identifiers in the order they are found. Empty values are skipped
+
+    Raises
+    ------
+    IdentifierReadError
+        If column is given but not found in the CSV header
+    """
+    if column:
+        reader = csv.DictReader(stream)
+        if reader.fieldnames is None or column not in reader.fieldnames:
+            raise IdentifierReadError(
+                f"Column '{column}' not found. Found columns {reader.fieldnames}"
+            )
+        values: Iterable[Optional[str]] = (row[column] for row in reader)
+    else:
+        values = (row[0] if row else None for row in csv.reader(stream))
+
+    # not a generator function itself, so that errors are raised on calling
+    return (x.strip() for x in values if x and x.strip())
+
+
+def chunks(iterable: Iterable[T], size: int) -> Iterator[List[T]]:
+    """Split iterable into lists of at most size items without reading it all"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class IdentifierReadError(TrolleyToolError):
+    pass
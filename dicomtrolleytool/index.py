@@ -0,0 +1,506 @@
+"""Local index of DICOM metadata returned by queries, for answering queries offline"""
+import json
+import pathlib
+import re
+import sqlite3
+import time
+from contextlib import closing
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from dicomtrolley.core import Query, QueryLevels, Searcher, Study
+from pydantic.main import BaseModel
+
+from dicomtrolleytool.exceptions import TrolleyToolError
+from dicomtrolleytool.logs import get_module_logger
+from dicomtrolleytool.serialization import (
+    SerializationError,
+    dataset_to_json_dict,
+    study_from_dict,
+)
+from dicomtrolleytool.wrappers import SearcherWrapper
+
+logger = get_module_logger("index")
+
+DEFAULT_INDEX_PATH = pathlib.Path.home() / ".trolleytool" / "metadata_index.sqlite"
+
+# Query fields that the index can answer, with the column they are matched on
+STUDY_MATCH_COLUMNS = {
+    "StudyInstanceUID": "study_uid",
+    "AccessionNumber": "accession_number",
+    "PatientID": "patient_id",
+    "PatientName": "patient_name",
+}
+# Query fields that do not restrict results
+IGNORED_QUERY_FIELDS = {"query_level", "include_fields"}
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS studies (channel TEXT, study_uid TEXT, "
+    "patient_id TEXT, patient_name TEXT, accession_number TEXT, study_date TEXT, "
+    "modalities TEXT, indexed REAL, data TEXT, PRIMARY KEY (channel, study_uid))",
+    "CREATE INDEX IF NOT EXISTS studies_patient_id ON studies(channel, patient_id)",
+    "CREATE INDEX IF NOT EXISTS studies_accession_number ON studies(channel, "
+    "accession_number)",
+    "CREATE INDEX IF NOT EXISTS studies_study_date ON studies(channel, study_date)",
+    "CREATE TABLE IF NOT EXISTS series (channel TEXT, study_uid TEXT, "
+    "series_uid TEXT, modality TEXT, data TEXT, "
+    "PRIMARY KEY (channel, study_uid, series_uid))",
+    "CREATE INDEX IF NOT EXISTS series_series_uid ON series(channel, series_uid)",
+    "CREATE INDEX IF NOT EXISTS series_modality ON series(channel, modality)",
+    "CREATE TABLE IF NOT EXISTS instances (channel TEXT, study_uid TEXT, "
+    "series_uid TEXT, instance_uid TEXT, data TEXT, "
+    "PRIMARY KEY (channel, study_uid, series_uid, instance_uid))",
+    "CREATE TABLE IF NOT EXISTS syncs (channel TEXT PRIMARY KEY, last_sync TEXT)",
+]
+
+
+class IndexStats(BaseModel):
+    """Number of objects in a metadata index"""
+
+    studies: int
+    series: int
+    instances: int
+    size: int  # in bytes
+
+
+class MetadataIndex:
+    """Stores studies, series and instances in a sqlite database on disk and
+    answers queries from it.
+
+    Objects are stored per channel. Storing an object that is already in the
+    index merges the new DICOM elements into the stored ones, so results of
+    queries with different include_fields add up.
+
+    Notes
+    -----
+    Each operation opens its own connection. This makes the index safe to use
+    from several threads and processes at the same time.
+    """
+
+    def __init__(self, path: pathlib.Path = DEFAULT_INDEX_PATH):
+        """
+
+        Parameters
+        ----------
+        path:
+            Path to sqlite database file. Created if it does not exist
+        """
+        self.path = pathlib.Path(path)
+        self._initialized = False
+
+    def __str__(self):
+        return f"MetadataIndex at '{self.path}'"
+
+    def connect(self) -> sqlite3.Connection:
+        if not self._initialized:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(str(self.path), timeout=30)
+        if not self._initialized:
+            with connection:
+                for statement in SCHEMA:
+                    connection.execute(statement)
+            self._initialized = True
+        return connection
+
+    def add(self, studies: Sequence[Study], channel_key: str):
+        """Store studies, including any series and instances they contain"""
+        try:
+            study_rows, series_rows, instance_rows = self._to_rows(studies, channel_key)
+        except SerializationError as e:
+            logger.warning(f"Could not index query result: {e}")
+            return
+        with closing(self.connect()) as connection, connection:
+            connection.executemany(
+                "INSERT INTO studies VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(channel, study_uid) DO UPDATE SET "
+                "patient_id=COALESCE(excluded.patient_id, patient_id), "
+                "patient_name=COALESCE(excluded.patient_name, patient_name), "
+                "accession_number=COALESCE(excluded.accession_number, "
+                "accession_number), "
+                "study_date=COALESCE(excluded.study_date, study_date), "
+                "modalities=COALESCE(excluded.modalities, modalities), "
+                "indexed=excluded.indexed, data=json_patch(data, excluded.data)",
+                study_rows,
+            )
+            connection.executemany(
+                "INSERT INTO series VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(channel, study_uid, series_uid) DO UPDATE SET "
+                "modality=COALESCE(excluded.modality, modality), "
+                "data=json_patch(data, excluded.data)",
+                series_rows,
+            )
+            connection.executemany(
+                "INSERT INTO instances VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(channel, study_uid, series_uid, instance_uid) "
+                "DO UPDATE SET data=json_patch(data, excluded.data)",
+                instance_rows,
+            )
+        logger.debug(
+            f"Indexed {len(study_rows)} studies, {len(series_rows)} series and "
+            f"{len(instance_rows)} instances"
+        )
+
+    @staticmethod
+    def _to_rows(
+        studies: Sequence[Study], channel_key: str
+    ) -> Tuple[List[Tuple[Any, ...]], List[Tuple[Any, ...]], List[Tuple[Any, ...]]]:
+        """Rows for studies, series and instances tables"""
+        now = time.time()
+        study_rows, series_rows, instance_rows = [], [], []
+        for study in studies:
+            data = study.data
+            modalities = data.get("ModalitiesInStudy")
+            if modalities is not None:
+                values = modalities
+                if isinstance(values, str):
+                    values = [values] if values else []
+                modalities = "\\" + "\\".join(values) + "\\"  # for LIKE matching
+            study_rows.append(
+                (
+                    channel_key,
+                    study.uid,
+                    element_string(data, "PatientID"),
+                    element_string(data, "PatientName"),
+                    element_string(data, "AccessionNumber"),
+                    element_string(data, "StudyDate"),
+                    modalities,
+                    now,
+                    json.dumps(dataset_to_json_dict(data)),
+                )
+            )
+            for series in study.series:
+                series_rows.append(
+                    (
+                        channel_key,
+                        study.uid,
+                        series.uid,
+                        element_string(series.data, "Modality"),
+                        json.dumps(dataset_to_json_dict(series.data)),
+                    )
+                )
+                for instance in series.instances:
+                    instance_rows.append(
+                        (
+                            channel_key,
+                            study.uid,
+                            series.uid,
+                            instance.uid,
+                            json.dumps(dataset_to_json_dict(instance.data)),
+                        )
+                    )
+        return study_rows, series_rows, instance_rows
+
+    def find_studies(self, query: Query, channel_key: str) -> List[Study]:
+        """Studies in index matching query, with series and instances down to the
+        query level. All stored elements are returned, regardless of
+        include_fields
+
+        Raises
+        ------
+        IndexQueryError
+            If query uses a field that the index cannot match on
+        """
+        where, params = self._study_conditions(query, channel_key)
+        series_where, series_params = "", []
+        if query.SeriesInstanceUID:
+            series_sql, series_params = match_condition(
+                "series_uid", query.SeriesInstanceUID
+            )
+            series_where = f" AND {series_sql}"
+
+        studies: Dict[str, Dict[str, Any]] = {}
+        with closing(self.connect()) as connection:
+            for study_uid, data in connection.execute(
+                f"SELECT study_uid, data FROM studies WHERE {where} "
+                f"ORDER BY study_date, study_uid",
+                params,
+            ):
+                studies[study_uid] = {
+                    "uid": study_uid,
+                    "data": json.loads(data),
+                    "series": [],
+                }
+            if query.query_level != QueryLevels.STUDY and studies:
+                series: Dict[Tuple[str, str], Dict[str, Any]] = {}
+                for study_uid, series_uid, data in connection.execute(
+                    f"SELECT study_uid, series_uid, data FROM series WHERE "
+                    f"channel=? AND study_uid IN (SELECT study_uid FROM studies "
+                    f"WHERE {where}){series_where} ORDER BY series_uid",
+                    [channel_key] + params + series_params,
+                ):
+                    series[(study_uid, series_uid)] = {
+                        "uid": series_uid,
+                        "data": json.loads(data),
+                        "instances": [],
+                    }
+                    studies[study_uid]["series"].append(series[(study_uid, series_uid)])
+                if query.query_level == QueryLevels.INSTANCE and series:
+                    for study_uid, series_uid, instance_uid, data in connection.execute(
+                        f"SELECT study_uid, series_uid, instance_uid, data FROM "
+                        f"instances WHERE channel=? AND study_uid IN (SELECT "
+                        f"study_uid FROM studies WHERE {where}){series_where} "
+                        f"ORDER BY instance_uid",
+                        [channel_key] + params + series_params,
+                    ):
+                        series[(study_uid, series_uid)]["instances"].append(
+                            {"uid": instance_uid, "data": json.loads(data)}
+                        )
+        if query.SeriesInstanceUID:  # only studies that have a matching series
+            studies = {x: y for x, y in studies.items() if y["series"]}
+        return [study_from_dict(x) for x in studies.values()]
+
+    @staticmethod
+    def _study_conditions(query: Query, channel_key: str) -> Tuple[str, List[Any]]:
+        """SQL WHERE clause and parameters selecting studies matching query"""
+        unsupported = [
+            x
+            for x in query.model_fields_set - IGNORED_QUERY_FIELDS
+            if getattr(query, x)
+            and x not in STUDY_MATCH_COLUMNS
+            and x
+            not in (
+                "ModalitiesInStudy",
+                "SeriesInstanceUID",
+                "min_study_date",
+                "max_study_date",
+            )
+        ]
+        if unsupported:
+            raise IndexQueryError(
+                f"Local index cannot match on {', '.join(sorted(unsupported))}"
+            )
+
+        conditions, params = ["channel=?"], [channel_key]
+        for field, column in STUDY_MATCH_COLUMNS.items():
+            value = getattr(query, field)
+            if value:
+                sql, values = match_condition(column, value)
+                conditions.append(sql)
+                params.extend(values)
+        if query.min_study_date:
+            conditions.append("study_date>=?")
+            params.append(query.min_study_date.strftime("%Y%m%d"))
+        if query.max_study_date:
+            conditions.append("study_date<=?")
+            params.append(query.max_study_date.strftime("%Y%m%d"))
+        if query.ModalitiesInStudy:
+            modality_conditions = []
+            for modality in split_values(query.ModalitiesInStudy):
+                modality_conditions.append(
+                    "(modalities LIKE ? OR study_uid IN (SELECT study_uid FROM "
+                    "series WHERE channel=? AND modality=?))"
+                )
+                params.extend([f"%\\{modality}\\%", channel_key, modality])
+            conditions.append("(" + " OR ".join(modality_conditions) + ")")
+        if query.SeriesInstanceUID:
+            sql, values = match_condition("series_uid", query.SeriesInstanceUID)
+            conditions.append(
+                f"study_uid IN (SELECT study_uid FROM series WHERE channel=? AND "
+                f"{sql})"
+            )
+            params.extend([channel_key] + values)
+        return " AND ".join(conditions), params
+
+    def get_last_sync(self, channel_key: str) -> Optional[date]:
+        """Date of the last completed sync for channel. None if never synced"""
+        with closing(self.connect()) as connection:
+            row = connection.execute(
+                "SELECT last_sync FROM syncs WHERE channel=?", (channel_key,)
+            ).fetchone()
+        return date.fromisoformat(row[0]) if row else None
+
+    def set_last_sync(self, channel_key: str, value: date):
+        with closing(self.connect()) as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO syncs VALUES (?, ?)",
+                (channel_key, value.isoformat()),
+            )
+
+    def stats(self) -> IndexStats:
+        with closing(self.connect()) as connection:
+            counts = [
+                connection.execute(f"SELECT COUNT(*) FROM {x}").fetchone()[0]
+                for x in ("studies", "series", "instances")
+            ]
+        return IndexStats(
+            studies=counts[0],
+            series=counts[1],
+            instances=counts[2],
+            size=self.path.stat().st_size,
+        )
+
+    def clear(self):
+        """Remove all objects and sync dates"""
+        with closing(self.connect()) as connection, connection:
+            for table in ("studies", "series", "instances", "syncs"):
+                connection.execute(f"DELETE FROM {table}")
+        with closing(self.connect()) as connection:
+            connection.execute("VACUUM")
+
+
+def element_string(ds, keyword: str) -> Optional[str]:
+    """Value of element as string. None if element is not in ds"""
+    value = ds.get(keyword)
+    return None if value is None else str(value)
+
+
+def split_values(value: str) -> List[str]:
+    r"""Separate values in a query field. Both DICOM-QR ('\') and QIDO-RS (',')
+    separators are accepted
+    """
+    return [x for x in re.split(r"[\\,]", value) if x]
+
+
+def match_condition(column: str, value: str) -> Tuple[str, List[str]]:
+    """SQL condition matching column to a query value. Value can be a list of
+    values and can contain DICOM wildcards '*' and '?'
+    """
+    conditions, params = [], []
+    for item in split_values(value):
+        if "*" in item or "?" in item:
+            conditions.append(f"{column} GLOB ?")
+        else:
+            conditions.append(f"{column}=?")
+        params.append(item)
+    return "(" + " OR ".join(conditions) + ")", params
+
+
+class IndexingSearcher(SearcherWrapper):
+    """Searcher that stores every result in a MetadataIndex"""
+
+    def __init__(self, searcher: Searcher, index: MetadataIndex, channel_key: str):
+        """
+
+        Parameters
+        ----------
+        searcher:
+            Search with this
+        index:
+            Store all results in this index
+        channel_key:
+            Key of the channel searcher belongs to
+        """
+        super().__init__(searcher)
+        self.index = index
+        self.channel_key = channel_key
+
+    def find_studies(self, query: Query) -> Sequence[Study]:
+        studies = list(self.searcher.find_studies(query))
+        self.index.add(studies, channel_key=self.channel_key)
+        return studies
+
+
+class LocalSearcher(Searcher):
+    """Answers queries from a MetadataIndex, without contacting any server"""
+
+    def __init__(self, index: MetadataIndex, channel_key: str):
+        """
+
+        Parameters
+        ----------
+        index:
+            Search in this index
+        channel_key:
+            Only return objects that were indexed for this channel
+        """
+        self.index = index
+        self.channel_key = channel_key
+
+    def __str__(self):
+        return f"{type(self).__name__} on {self.index}, channel '{self.channel_key}'"
+
+    def find_studies(self, query: Query) -> Sequence[Study]:
+        return self.index.find_studies(query, channel_key=self.channel_key)
+
+
+def sync_index(
+    index: MetadataIndex,
+    searcher: Searcher,
+    channel_key: str,
+    since: Optional[date] = None,
+    query_level: QueryLevels = QueryLevels.STUDY,
+    include_fields: Optional[Iterable[str]] = None,
+    result_limit: Optional[int] = None,
+) -> int:
+    """Query searcher for all studies on or after since and store them in index.
+
+    Queries one day at a time, as servers cap the number of results they return
+    for a single query. After each completed day the date of the last sync moves
+    past it, so a sync that fails halfway continues from there next time.
+
+    Parameters
+    ----------
+    index:
+        Store results in this index
+    searcher:
+        Query this
+    channel_key:
+        Key of the channel searcher belongs to
+    since:
+        Fetch studies with a study date on or after this date. Defaults to the
+        date of the last sync, so only new studies are fetched
+    query_level:
+        Fetch information down to this level. Defaults to study level
+    include_fields:
+        Ask for these DICOM fields. Defaults to None, meaning server default
+    result_limit:
+        The most results searcher returns for a single query. A day with this many
+        studies might be missing some, and is fetched again on the next sync.
+        Defaults to None, meaning no limit
+
+    Returns
+    -------
+    int
+        The number of studies fetched
+
+    Raises
+    ------
+    IndexSyncError
+        If since is not given and channel was never synced
+    """
+    if since is None:
+        since = index.get_last_sync(channel_key)
+        if since is None:
+            raise IndexSyncError(
+                f"Channel '{channel_key}' has never been synced. Give a start date"
+            )
+    today = date.today()
+    logger.info(f"Syncing index for '{channel_key}' from {since}")
+    count = 0
+    complete = True  # all days so far
+    day = since
+    while day <= today:
+        study_date = datetime.combine(day, datetime.min.time())
+        studies = list(
+            searcher.find_studies(
+                Query(
+                    min_study_date=study_date,
+                    max_study_date=study_date,
+                    query_level=query_level,
+                    include_fields=sorted(include_fields or []),
+                )
+            )
+        )
+        index.add(studies, channel_key=channel_key)
+        count += len(studies)
+        if result_limit is not None and len(studies) >= result_limit:
+            logger.warning(
+                f"Found {len(studies)} studies for {day}, the most the server "
+                f"returns. Some might be missing. Fetching {day} again next sync"
+            )
+            if complete:
+                index.set_last_sync(channel_key, day)
+            complete = False
+        elif complete:
+            # studies can still arrive for today. Start the next sync from today
+            index.set_last_sync(channel_key, min(day + timedelta(days=1), today))
+        day += timedelta(days=1)
+    return count
+
+
+class IndexQueryError(TrolleyToolError):
+    pass
+
+
+class IndexSyncError(TrolleyToolError):
+    pass
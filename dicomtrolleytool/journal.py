@@ -0,0 +1,349 @@
+"""Keeping track of finished work on disk, so that interrupted jobs can resume"""
+import json
+import os
+import pathlib
+import threading
+import time
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from dicomtrolleytool.exceptions import TrolleyToolError
+from dicomtrolleytool.logs import get_module_logger
+
+if TYPE_CHECKING:
+    from dicomtrolley.core import Query
+
+    from dicomtrolleytool.query import QueryResult
+
+logger = get_module_logger("journal")
+
+DEFAULT_JOBS_PATH = pathlib.Path.home() / ".trolleytool" / "jobs"
+
+
+class Journal:
+    """Append-only list of records in a file on disk, one json object per line
+
+    Each record is flushed to the OS as soon as it is written, so it survives the
+    process being killed. If a job is killed halfway through writing, the
+    incomplete last line is skipped when reading.
+
+    Notes
+    -----
+    Safe to write from several threads at the same time.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        sync_every: Optional[int] = None,
+        sync_interval: float = 1.0,
+    ):
+        """
+
+        Parameters
+        ----------
+        path:
+            Journal file
+        sync_every:
+            Also make sure records are on disk (fsync) after this many records, or
+            sync_interval seconds after the last sync, whichever comes first.
+            Protects against power loss and OS crashes. Defaults to None, meaning
+            leave writing to disk to the OS
+        sync_interval:
+            See sync_every. Defaults to 1 second
+        """
+        self.path = pathlib.Path(path)
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._file: Optional[IO[bytes]] = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f"{type(self).__name__} at {self.path}"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def records(self) -> Iterator[Dict[str, Any]]:
+        """All records in this journal, in the order they were written"""
+        if not self.path.exists():
+            return
+        with open(self.path) as f:
+            for idx, line in enumerate(f):
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logger.debug(f"Skipping unreadable line {idx} in {self}")
+
+    def append(self, record: Dict[str, Any]) -> int:
+        """Write record to journal and flush
+
+        Returns
+        -------
+        int
+            Position of record in file, in bytes
+
+        Raises
+        ------
+        JournalError
+            If record cannot be written
+        """
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        with self._lock:
+            try:
+                file = self._open()
+                offset = file.tell()
+                file.write(line)
+                file.flush()
+                self._unsynced += 1
+                if self.sync_every and (
+                    self._unsynced >= self.sync_every
+                    or time.monotonic() - self._last_sync >= self.sync_interval
+                ):
+                    self._sync()
+            except OSError as e:
+                raise JournalError(f"Could not write to {self}: {e}") from e
+        return offset
+
+    def _open(self) -> IO[bytes]:
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "ab")
+            if self._file.tell() and not self._ends_with_newline():
+                self._file.write(b"\n")  # end line left incomplete by a crash
+        return self._file
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _sync(self):
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+
+    def rewrite(self, records: Iterable[Dict[str, Any]]):
+        """Replace all records with records. Safe against crashes: the journal is
+        replaced only when all records have been written to disk
+        """
+        self.close()
+        temp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+        with open(temp_path, "wb") as f:
+            for record in records:
+                f.write((json.dumps(record) + "\n").encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    def clear(self):
+        """Remove all records"""
+        self.close()
+        self.path.unlink(missing_ok=True)
+
+
+class DownloadJournal(Journal):
+    """Records which studies and instances have been downloaded
+
+    Records look like {"study": <uid>, "instance": <uid>, "size": <bytes>} for a
+    single instance and {"study": <uid>} for a study that has been downloaded
+    completely.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        super().__init__(path)
+        self.finished_studies: Set[str] = set()
+        self.finished_instances: Dict[str, Set[str]] = {}
+        for record in self.records():
+            self._register(record)
+
+    def _register(self, record: Dict[str, Any]):
+        study_uid = record.get("study")
+        if not study_uid:
+            return
+        if "instance" in record:
+            self.finished_instances.setdefault(study_uid, set()).add(record["instance"])
+        else:
+            self.finished_studies.add(study_uid)
+
+    def append(self, record: Dict[str, Any]):
+        super().append(record)
+        with self._lock:
+            self._register(record)
+
+    def is_study_finished(self, study_uid: str) -> bool:
+        return study_uid in self.finished_studies
+
+    def get_finished_instances(self, study_uid: str) -> Set[str]:
+        """All downloaded instances of this study, by SOPInstanceUID"""
+        with self._lock:
+            return set(self.finished_instances.get(study_uid, set()))
+
+    def mark_instance(self, study_uid: str, instance_uid: str, size: int = 0):
+        self.append({"study": study_uid, "instance": instance_uid, "size": size})
+
+    def mark_study(self, study_uid: str):
+        self.append({"study": study_uid})
+
+
+class QueryJournal(Journal):
+    """Records the outcome of each query in a batch query job, so that a job can be
+    resumed without running finished queries again
+
+    Records look like {"key": <query key>, "ok": true, "study": <serialized study>}
+    for a query that found a study and {"key": <query key>, "ok": false, "error":
+    <message>} for a failed query. Failed queries are run again on resume. Only
+    the position of each stored study is kept in memory. Studies are read from
+    disk when needed.
+
+    Notes
+    -----
+    Writes are synced to disk every sync_every records instead of every record.
+    After a crash the last few results might be missing. Those queries are just
+    run again on resume.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        sync_every: Optional[int] = 100,
+        sync_interval: float = 1.0,
+    ):
+        super().__init__(path, sync_every=sync_every, sync_interval=sync_interval)
+        self.offsets: Dict[str, int] = {}  # position of latest result per key
+        self.failed: Set[str] = set()
+        self.record_count = 0
+        for offset, record in self._scan():
+            self._register(record, offset)
+
+    @property
+    def job_id(self) -> str:
+        return self.path.stem
+
+    def _scan(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """All readable records with their position in file"""
+        if not self.path.exists():
+            return
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                try:
+                    yield offset, json.loads(line)
+                except ValueError:
+                    logger.debug(f"Skipping unreadable line in {self.path}")
+                offset += len(line)
+
+    def _register(self, record: Dict[str, Any], offset: int):
+        key = record.get("key")
+        if not key:
+            return
+        self.record_count += 1
+        if record.get("ok"):
+            self.offsets[key] = offset
+            self.failed.discard(key)
+        elif key not in self.offsets:
+            self.failed.add(key)
+
+    def is_finished(self, key: str) -> bool:
+        """True if the query with this key found a study in an earlier run"""
+        return key in self.offsets
+
+    def get_result(self, key: str, query: "Query") -> "QueryResult":
+        """Stored result for query with key. Read from disk
+
+        Raises
+        ------
+        JournalError
+            If there is no stored result for key, or it cannot be read
+        """
+        from dicomtrolleytool.query import QueryStudyResult
+        from dicomtrolleytool.serialization import SerializationError, study_from_dict
+
+        try:
+            offset = self.offsets[key]
+        except KeyError as e:
+            raise JournalError(f"No result for query {key} in {self}") from e
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                study = study_from_dict(json.loads(f.readline())["study"])
+        except (OSError, ValueError, KeyError, SerializationError) as e:
+            raise JournalError(f"Could not read result {key} from {self}: {e}") from e
+        return QueryStudyResult(content=study, query=query)
+
+    def mark_result(self, key: str, result: "QueryResult"):
+        """Store outcome of the query with key. A study that cannot be stored, or
+        that is a partial result of a federated search, is recorded as failed, so
+        that its query is run again on resume
+        """
+        from dicomtrolleytool.federation import get_unanswered_channels
+        from dicomtrolleytool.serialization import SerializationError, study_to_dict
+
+        if result.is_error():
+            record = {"key": key, "ok": False, "error": str(result.content)}
+        elif get_unanswered_channels(result.content):
+            unanswered = ", ".join(get_unanswered_channels(result.content))
+            record = {
+                "key": key,
+                "ok": False,
+                "error": f"Partial result. Not answered by: {unanswered}",
+            }
+        else:
+            try:
+                study = study_to_dict(result.content)
+            except SerializationError as e:
+                logger.warning(f"Could not store result of query {key} in {self}: {e}")
+                record = {"key": key, "ok": False, "error": f"Not stored: {e}"}
+            else:
+                record = {"key": key, "ok": True, "study": study}
+        offset = self.append(record)
+        with self._lock:
+            self._register(record, offset)
+
+    def compact(self) -> Tuple[int, int]:
+        """Rewrite journal keeping only the latest record per query. Failed queries
+        that found a study later on are dropped
+
+        Returns
+        -------
+        Tuple[int, int]
+            Number of records before and after compacting
+        """
+        before = self.record_count
+        latest: Dict[str, Dict[str, Any]] = {}
+        for _, record in self._scan():
+            key = record.get("key")
+            if key and (record.get("ok") or key not in self.offsets):
+                latest[key] = record
+        self.rewrite(latest.values())
+
+        self.offsets, self.failed, self.record_count = {}, set(), 0
+        for offset, record in self._scan():
+            self._register(record, offset)
+        return before, self.record_count
+
+
+class JournalError(TrolleyToolError):
+    pass
@@ -1,7 +1,5 @@
 import logging
 
-import coloredlogs
-
 ROOT_LOGGER_NAME = "trolleytool"
 
 
@@ -14,4 +12,6 @@ def get_module_logger(name):
 
 def install_colouredlogs(level):
     """Use coloured logs"""
+    import coloredlogs  # not at top. Slow to import and not needed for --help
+
     coloredlogs.install(level=level)
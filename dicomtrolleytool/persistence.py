@@ -4,7 +4,6 @@ import pathlib
 from io import StringIO
 from typing import List, Optional
 
-import keyring
 from pydantic.main import BaseModel
 
 from .channels import Channel, ChannelFactory
@@ -29,10 +28,34 @@ class TrolleyToolSettings(BaseModel):
 
     query_missing: Optional[bool] = None
 
-    # specific to rad69 downloader
+    # download tuning, for rad69 and WADO-RS downloaders. Larger chunks mean fewer
+    # reads but more memory per download. None means downloader default (5MB).
+    # This is also the size of the buffer used for parsing multipart responses
     http_chunk_size: Optional[int] = None
+    # request each series separately instead of all instances of a study at once
     request_per_series: bool = True
 
+    # query result cache. Path defaults to file next to settings
+    query_cache_path: Optional[pathlib.Path] = None
+    query_cache_max_age: Optional[int] = 86400  # seconds. None means never expire
+    query_cache_max_size: int = 100 * 1024 * 1024  # bytes
+
+    # store all query results in a local index for answering queries offline.
+    # Path defaults to file next to settings
+    metadata_index: bool = False
+    metadata_index_path: Optional[pathlib.Path] = None
+
+    # reuse logged-in sessions between commands. Path defaults to file next to
+    # settings
+    session_cache: bool = True
+    session_cache_path: Optional[pathlib.Path] = None
+    session_max_age: int = 600  # seconds a server keeps an unused session
+    session_refresh_margin: int = 60  # log in again if expiring within this
+
+    # journals of batch query jobs, for resuming. Path defaults to folder next to
+    # settings
+    query_jobs_path: Optional[pathlib.Path] = None
+
     channels: List[str] = []
 
     def write_to(self, stream: StringIO):
@@ -122,12 +145,20 @@ class Storage:
 
 
 class KeyRingStorage(Storage):
+    """Stores in OS secret store. keyring is imported only when accessed, as
+    importing it is slow and it is not needed for all commands
+    """
+
     service_name = "dicomtrolleytool"
 
     def save_value(self, key, value):
+        import keyring
+
         keyring.set_password(self.service_name, key, value)
 
     def load_value(self, key):
+        import keyring
+
         value = keyring.get_password(self.service_name, key)
         if value is None:
             raise PersistenceError(
@@ -136,6 +167,8 @@ class KeyRingStorage(Storage):
         return value
 
     def delete(self, key):
+        import keyring
+
         return keyring.delete_password(self.service_name, key)
 
 
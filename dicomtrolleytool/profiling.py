@@ -0,0 +1,440 @@
+"""Recording where time goes: per-request timing for searchers, downloaders and
+http sessions, with summary and export for analysis.
+
+Only imported when profiling is switched on
+"""
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    TextIO,
+    TypeVar,
+)
+
+from dicomtrolley.core import DICOMDownloadable, InstanceReference, Query, Study
+from pydantic.main import BaseModel
+from requests.adapters import HTTPAdapter
+
+from dicomtrolleytool.logs import get_module_logger
+from dicomtrolleytool.sessions import TransportAdapter
+from dicomtrolleytool.wrappers import DownloaderWrapper, SearcherWrapper
+
+if TYPE_CHECKING:
+    from dicomtrolley.core import Downloader, Searcher
+    from requests import Session
+
+logger = get_module_logger("profiling")
+
+T = TypeVar("T")
+
+
+class Phase:
+    """What a span was spent on"""
+
+    QUERY = "query"  # searcher.find_studies()
+    DOWNLOAD = "download"  # downloader fetching datasets
+    HTTP = "http"  # a single http request, as part of query or download
+    LOGIN = "login"  # http request to log in
+    FORMAT = "format"  # formatting and writing output
+    RETRY = "retry"  # waiting before trying a failed query again
+
+
+class Span(BaseModel):
+    """A single timed operation"""
+
+    phase: str
+    name: str
+    start: float  # seconds since profiler start
+    duration: float  # seconds
+    thread: int
+    bytes: int = 0
+    retried: bool = False  # request was refused and sent again after login
+    status: Optional[int] = None  # http status code, if any
+
+
+class PhaseSummary(BaseModel):
+    """Statistics for all spans of one phase"""
+
+    phase: str
+    count: int
+    total: float  # seconds
+    p50: float  # seconds
+    p95: float
+    p99: float
+    bytes: int
+    retries: int
+
+
+class Profiler:
+    """Collects spans. Safe to use from several threads"""
+
+    def __init__(self):
+        self.spans: List[Span] = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._received = threading.local()  # bytes received, per thread
+
+    def count_received(self, size: int):
+        """Add size bytes to the bytes received by the current thread"""
+        self._received.bytes = self.received() + size
+
+    def received(self) -> int:
+        """Total bytes received by the current thread so far"""
+        return getattr(self._received, "bytes", 0)
+
+    def add(
+        self, phase: str, name: str, start: float, duration: float, **kwargs
+    ) -> Span:
+        """Record a span
+
+        Parameters
+        ----------
+        phase:
+            One of Phase
+        name:
+            What was done, for example an url
+        start:
+            time.perf_counter() value at start of operation
+        duration:
+            In seconds
+        kwargs:
+            Any other Span field
+        """
+        span = Span(
+            phase=phase,
+            name=name,
+            start=start - self._start,
+            duration=duration,
+            thread=threading.get_ident(),
+            **kwargs,
+        )
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, phase: str, name: str):
+        """Record the time spent in this context as a span"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, name, start, time.perf_counter() - start)
+
+    def summarize(self) -> List[PhaseSummary]:
+        """Statistics per phase, in order of first occurrence"""
+        per_phase: Dict[str, List[Span]] = {}
+        with self._lock:
+            for span in self.spans:
+                per_phase.setdefault(span.phase, []).append(span)
+        summaries = []
+        for phase, spans in per_phase.items():
+            durations = sorted(x.duration for x in spans)
+            summaries.append(
+                PhaseSummary(
+                    phase=phase,
+                    count=len(spans),
+                    total=sum(durations),
+                    p50=percentile(durations, 50),
+                    p95=percentile(durations, 95),
+                    p99=percentile(durations, 99),
+                    bytes=sum(x.bytes for x in spans),
+                    retries=sum(x.retried for x in spans),
+                )
+            )
+        return summaries
+
+    def format_summary(self) -> str:
+        """Summary as a table for printing. Times in milliseconds"""
+        from tabulate import tabulate  # slow import. Only when needed
+
+        rows = [
+            [
+                x.phase,
+                x.count,
+                f"{x.total * 1000:.0f}",
+                f"{x.p50 * 1000:.1f}",
+                f"{x.p95 * 1000:.1f}",
+                f"{x.p99 * 1000:.1f}",
+                x.bytes,
+                x.retries,
+            ]
+            for x in self.summarize()
+        ]
+        return tabulate(
+            rows,
+            headers=[
+                "phase",
+                "count",
+                "total ms",
+                "p50 ms",
+                "p95 ms",
+                "p99 ms",
+                "bytes",
+                "retries",
+            ],
+            disable_numparse=True,
+        )
+
+    def write_json(self, stream: TextIO):
+        """Summary and all spans as JSON"""
+        with self._lock:
+            spans = [x.model_dump() for x in self.spans]
+        json.dump(
+            {"summary": [x.model_dump() for x in self.summarize()], "spans": spans},
+            stream,
+            indent=2,
+        )
+
+    def write_trace(self, stream: TextIO):
+        """All spans in Chrome trace event format. Open with chrome://tracing or
+        https://ui.perfetto.dev
+        """
+        pid = os.getpid()
+        with self._lock:
+            events = [
+                {
+                    "name": x.name,
+                    "cat": x.phase,
+                    "ph": "X",  # complete event, with duration
+                    "ts": x.start * 1e6,  # microseconds
+                    "dur": x.duration * 1e6,
+                    "pid": pid,
+                    "tid": x.thread,
+                    "args": {"bytes": x.bytes, "status": x.status},
+                }
+                for x in self.spans
+            ]
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, stream)
+
+
+def percentile(sorted_values: Sequence[float], percent: float) -> float:
+    """Nearest-rank percentile of sorted values. 0 for empty input"""
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(percent / 100 * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
+
+
+class ProfilingSearcher(SearcherWrapper):
+    """Records the time of each query"""
+
+    def __init__(self, searcher: "Searcher", profiler: Profiler):
+        super().__init__(searcher)
+        self.profiler = profiler
+
+    def find_studies(self, query: Query) -> Sequence[Study]:
+        with self.profiler.span(Phase.QUERY, query.to_short_string()):
+            return self.searcher.find_studies(query)
+
+
+class ProfilingDownloader(DownloaderWrapper):
+    """Records the time of each download, and the bytes received for it over a
+    profiled session (see profile_session())
+    """
+
+    def __init__(self, downloader: "Downloader", profiler: Profiler):
+        super().__init__(downloader)
+        self.profiler = profiler
+
+    def get_dataset(self, instance: InstanceReference):
+        start = time.perf_counter()
+        received = self.profiler.received()
+        try:
+            return self.downloader.get_dataset(instance)
+        finally:
+            self.profiler.add(
+                Phase.DOWNLOAD,
+                str(instance),
+                start,
+                time.perf_counter() - start,
+                bytes=self.profiler.received() - received,
+            )
+
+    def datasets(self, objects: Sequence[DICOMDownloadable]):
+        """Each dataset is recorded separately, as the time it took to arrive.
+        Datasets are streamed in the thread that iterates, so bytes received by
+        this thread while waiting are the bytes of the dataset
+        """
+        iterator = iter(self.downloader.datasets(objects))
+        while True:
+            start = time.perf_counter()
+            received = self.profiler.received()
+            try:
+                dataset = next(iterator)
+            except StopIteration:
+                return
+            self.profiler.add(
+                Phase.DOWNLOAD,
+                str(getattr(dataset, "SOPInstanceUID", "dataset")),
+                start,
+                time.perf_counter() - start,
+                bytes=self.profiler.received() - received,
+            )
+            yield dataset
+
+
+class CountingStream:
+    """Wraps the raw stream of a response to count the bytes read from it. requests
+    reads content through read() or stream(), including streamed content that is
+    read long after the request was sent
+    """
+
+    def __init__(self, raw, span: Span, profiler: Profiler):
+        self._raw = raw
+        self._span = span
+        self._profiler = profiler
+
+    def __getattr__(self, item):
+        attribute = getattr(self._raw, item)
+        if item == "read":
+            return self._counting_read(attribute)
+        if item == "stream":
+            return self._counting_stream(attribute)
+        return attribute
+
+    def _count(self, size: int):
+        self._span.bytes += size
+        self._profiler.count_received(size)
+
+    def _counting_read(self, read):
+        def counting_read(*args, **kwargs):
+            data = read(*args, **kwargs)
+            self._count(len(data or b""))
+            return data
+
+        return counting_read
+
+    def _counting_stream(self, stream):
+        def counting_stream(*args, **kwargs):
+            for chunk in stream(*args, **kwargs):
+                self._count(len(chunk))
+                yield chunk
+
+        return counting_stream
+
+
+class ProfilingAdapter(TransportAdapter):
+    """HTTPAdapter that records each request it sends, including logins and
+    requests sent again after logging in
+    """
+
+    def __init__(self, profiler: Profiler, login_url: Optional[str] = None, **kwargs):
+        """
+
+        Parameters
+        ----------
+        profiler:
+            Record requests in this
+        login_url:
+            Requests to this url are recorded as logins. Defaults to None
+        kwargs:
+            Passed to TransportAdapter
+        """
+        super().__init__(**kwargs)
+        self.profiler = profiler
+        self.login_url = login_url
+
+    def send(self, request, *args, **kwargs):
+        """Send request. The span lasts until response headers arrive. Content is
+        counted in the span as it is read, see CountingStream
+        """
+        start = time.perf_counter()
+        response = super().send(request, *args, **kwargs)
+        span = self.profiler.add(
+            Phase.LOGIN if request.url == self.login_url else Phase.HTTP,
+            f"{request.method} {request.url}",
+            start,
+            time.perf_counter() - start,
+            # login auth logs in and sends again when refused
+            retried=response.status_code == 401 and self.login_url is not None,
+            status=response.status_code,
+        )
+        if response.raw is not None:
+            response.raw = CountingStream(response.raw, span, self.profiler)
+        return response
+
+
+def profile_session(session: "Session", profiler: Profiler):
+    """Record every http request sent by session.
+
+    Replaces the adapters of session with ProfilingAdapters that have the same
+    connection pool and timeout settings.
+    """
+    login_url = getattr(session.auth, "login_url", None)
+    for prefix, adapter in list(session.adapters.items()):
+        if not isinstance(adapter, HTTPAdapter):
+            continue
+        session.mount(
+            prefix,
+            ProfilingAdapter(
+                profiler,
+                login_url=login_url,
+                timeout=getattr(adapter, "timeout", None),
+                pool_connections=adapter._pool_connections,
+                pool_maxsize=adapter._pool_maxsize,
+                max_retries=adapter.max_retries,
+                pool_block=adapter._pool_block,
+            ),
+        )
+
+
+@contextmanager
+def profile_formatting(
+    profiler: Profiler, results: Iterable[T]
+) -> Iterator[Iterable[T]]:
+    """Record time spent formatting results in this context as a single span.
+
+    Yields results wrapped so that time spent waiting for the next result, for
+    example on a query, is not counted as formatting. Works for formatters that
+    write each result as it comes in as well as for those that collect all
+    results first.
+    """
+    waiting = 0.0
+
+    def iter_results() -> Iterator[T]:
+        nonlocal waiting
+        iterator = iter(results)
+        while True:
+            start = time.perf_counter()
+            try:
+                result = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                waiting += time.perf_counter() - start
+            yield result
+
+    start = time.perf_counter()
+    yield iter_results()
+    profiler.add(Phase.FORMAT, "output", start, time.perf_counter() - start - waiting)
+
+
+def write_profile(
+    profiler: Profiler, stream: TextIO, output_format: Optional[str] = None
+):
+    """Write profile as JSON or Chrome trace events
+
+    Parameters
+    ----------
+    profiler:
+        Write the spans of this profiler
+    stream:
+        Write to this
+    output_format:
+        'json' or 'trace'. Defaults to None, meaning json
+    """
+    if output_format == "trace":
+        profiler.write_trace(stream)
+    else:
+        profiler.write_json(stream)
@@ -1,18 +1,40 @@
 """Classes and functions for working with and displaying queries, query results"""
-from typing import Iterable, List, Tuple, Union
+import hashlib
+import json
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
-from dicomtrolley.core import Query, Study
 from dicomtrolley.exceptions import DICOMTrolleyError
-from dicomtrolley.trolley import Trolley
 
 from dicomtrolleytool.logs import get_module_logger
 
+if TYPE_CHECKING:
+    from dicomtrolley.core import Query, Searcher, Series, Study
+    from dicomtrolley.trolley import Trolley
+
+    from dicomtrolleytool.journal import QueryJournal
 
 logger = get_module_logger("query")
 
 
 class QueryResult:
-    def __init__(self, content: Union[Study, Exception], query: Query):
+    def __init__(self, content: Union["Study", Exception], query: "Query"):
         """The result of running a query. Can be error or data coming back from
         server
         """
@@ -28,37 +50,585 @@ class QueryResult:
 
 
 class QueryErrorResult(QueryResult):
-    def __init__(self, content: Exception, query: Query):
+    def __init__(self, content: Exception, query: "Query"):
         super().__init__(content=content, query=query)
 
 
 class QueryStudyResult(QueryResult):
-    def __init__(self, content: Study, query: Query):
+    def __init__(self, content: "Study", query: "Query"):
         # Typing needed to convince mypy content is not Union[Exception,Any]. Why?
-        self.content: Study
+        self.content: "Study"
         super().__init__(content=content, query=query)
 
 
 def split_error_results(
     results: Iterable[QueryResult],
 ) -> Tuple[List[QueryStudyResult], List[QueryErrorResult]]:
+    results = list(results)  # results might be a generator. Iterate only once
     study_results = [x for x in results if isinstance(x, QueryStudyResult)]
     error_results = [x for x in results if isinstance(x, QueryErrorResult)]
     return study_results, error_results
 
 
+def query_key(query: "Query", *extra: str) -> str:
+    """A key that is the same for all queries asking for the same thing.
+
+    Includes query type, all parameters and include fields in any order.
+
+    Parameters
+    ----------
+    query:
+        Create key for this query
+    extra:
+        Additional strings to make the key unique by, like a channel name
+    """
+    params = query.model_dump(mode="json")
+    params["include_fields"] = sorted(set(params.get("include_fields") or []))
+    normalized = json.dumps([type(query).__name__, params, list(extra)], sort_keys=True)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def run_query(trolley: "Trolley", query: "Query") -> QueryResult:
+    """Run a single query. Errors are caught and returned as QueryErrorResult"""
+    try:
+        return QueryStudyResult(content=trolley.find_study(query), query=query)
+    except DICOMTrolleyError as e:
+        logger.warning(e)
+        return QueryErrorResult(content=e, query=query)
+
+
+class QueryBatch:
+    """One or more queries that can be sent to server as a single query
+
+    All queries in a batch are identical except for the value of field. The
+    combined query asks for all values at once by joining them with separator.
+    """
+
+    def __init__(
+        self,
+        queries: List["Query"],
+        field: Optional[str] = None,
+        separator: str = ",",
+    ):
+        self.queries = queries
+        self.field = field
+        self.separator = separator
+
+    def __len__(self):
+        return len(self.queries)
+
+    def to_query(self) -> "Query":
+        """A single query asking for all values in this batch"""
+        if len(self.queries) == 1 or not self.field:
+            return self.queries[0]
+        first = self.queries[0]
+        update: Dict[str, Any] = {
+            self.field: self.separator.join(
+                getattr(x, self.field) for x in self.queries
+            )
+        }
+        if first.include_fields is not None:  # make sure field is returned
+            update["include_fields"] = sorted(set(first.include_fields) | {self.field})
+        return first.model_copy(update=update)
+
+    def match(self, study: "Study") -> Optional["Query"]:
+        """The query in this batch that study is an answer to. None if not found"""
+        if not self.field:
+            return None
+        if self.field == "StudyInstanceUID":
+            value = study.uid
+        else:
+            value = str(study.data.get(self.field, ""))
+        for query in self.queries:
+            if getattr(query, self.field) == value:
+                return query
+        return None
+
+
+class QueryPlanner:
+    """Combines queries into batches that can be sent to server as one query.
+
+    Some servers can answer a query for several identifiers at once, for example
+    'StudyInstanceUID=1.2.3,1.2.4' in QIDO-RS. Sending one query for many
+    identifiers saves a lot of requests for long lists.
+
+    Only consecutive queries are combined, so batches keep the order of queries.
+    """
+
+    def __init__(
+        self,
+        batch_fields: Sequence[str] = (),
+        max_batch_size: int = 1,
+        separator: str = ",",
+        query_levels: Optional[Sequence[str]] = None,
+    ):
+        r"""
+
+        Parameters
+        ----------
+        batch_fields:
+            Queries differing only in one of these fields can be combined.
+            Defaults to empty, meaning no queries are combined
+        max_batch_size:
+            Combine at most this many queries. Defaults to 1
+        separator:
+            Join values with this in the combined query. QIDO-RS uses ',',
+            DICOM-QR uses '\'
+        query_levels:
+            Only combine queries at these query levels. Defaults to None, meaning
+            queries at any level can be combined
+        """
+        self.batch_fields = batch_fields
+        self.max_batch_size = max_batch_size
+        self.separator = separator
+        self.query_levels = query_levels
+
+    def batch_field(self, query: "Query") -> Optional[str]:
+        """The field query could be batched on, if any"""
+        if self.max_batch_size <= 1:
+            return None
+        if self.query_levels is not None and query.query_level not in self.query_levels:
+            return None
+        filled = [x for x in self.batch_fields if getattr(query, x, None)]
+        if len(filled) != 1 or self.separator in getattr(query, filled[0]):
+            return None
+        return filled[0]
+
+    def batch_key(self, query: "Query", field: str) -> str:
+        """Queries with the same key can be combined"""
+        params = query.model_dump(mode="json", exclude={field})
+        params["include_fields"] = sorted(params.get("include_fields") or [])
+        return json.dumps([type(query).__name__, field, params], sort_keys=True)
+
+    def plan(self, queries: Iterable["Query"]) -> Iterator[QueryBatch]:
+        """Combine queries into batches. Reads queries only as needed"""
+        batch: List["Query"] = []
+        batch_field: Optional[str] = None
+        batch_key = None
+        for query in queries:
+            field = self.batch_field(query)
+            key = self.batch_key(query, field) if field else None
+            if batch and (
+                key is None or key != batch_key or len(batch) >= self.max_batch_size
+            ):
+                yield QueryBatch(batch, field=batch_field, separator=self.separator)
+                batch = []
+            batch.append(query)
+            batch_field, batch_key = field, key
+        if batch:
+            yield QueryBatch(batch, field=batch_field, separator=self.separator)
+
+
+def run_batch(trolley: "Trolley", batch: QueryBatch) -> List[QueryResult]:
+    """Run all queries in batch as a single query and assign each returned study
+    to the query it answers.
+
+    If the combined query fails or returns nothing, each query is run separately.
+    Some servers do not support combined queries and fail or silently return
+    nothing. Running separately makes sure results are always correct.
+
+    Returns
+    -------
+    List[QueryResult]
+        One result per query in batch, in the same order
+    """
+    if len(batch) == 1:
+        return [run_query(trolley, batch.queries[0])]
+
+    try:
+        studies = trolley.find_studies(batch.to_query())
+    except DICOMTrolleyError as e:
+        logger.debug(f"Combined query for {len(batch)} queries failed: {e}")
+        studies = []
+    if not studies:
+        logger.debug("No results for combined query. Running queries separately")
+        return [run_query(trolley, x) for x in batch.queries]
+
+    found: Dict[int, List["Study"]] = {id(x): [] for x in batch.queries}
+    for study in studies:
+        query = batch.match(study)
+        if query is not None:
+            found[id(query)].append(study)
+
+    results: List[QueryResult] = []
+    for query in batch.queries:
+        matches = found[id(query)]
+        if len(matches) == 1:
+            results.append(QueryStudyResult(content=matches[0], query=query))
+        else:
+            error = DICOMTrolleyError(
+                f"Expected exactly one study for query '{query.to_short_string()}',"
+                f" but found {len(matches)}"
+            )
+            logger.warning(error)
+            results.append(QueryErrorResult(content=error, query=query))
+    return results
+
+
 def collect_query_results(
-    trolley: Trolley, queries: Iterable[Query]
+    trolley: "Trolley",
+    queries: Iterable["Query"],
+    max_workers: int = 1,
+    planner: Optional[QueryPlanner] = None,
 ) -> List[QueryResult]:
-    """Run all queries and collect results"""
-    results: List[QueryResult] = []
-    for query in queries:
+    """Run all queries and collect results
+
+    Parameters
+    ----------
+    trolley:
+        Run queries with this trolley
+    queries:
+        The queries to run
+    max_workers:
+        Run at most this many queries at the same time. Defaults to 1, meaning
+        queries are run one after the other
+    planner:
+        If given, use this to combine queries into fewer server requests.
+        Defaults to None, meaning each query is sent separately
+
+    Returns
+    -------
+    List[QueryResult]
+        One result per query, in the same order as queries
+    """
+    return list(
+        iter_query_results(trolley, queries, max_workers=max_workers, planner=planner)
+    )
+
+
+def iter_query_results(
+    trolley: "Trolley",
+    queries: Iterable["Query"],
+    max_workers: int = 1,
+    planner: Optional[QueryPlanner] = None,
+) -> Iterator[QueryResult]:
+    """Run queries and yield each result as soon as it is available.
+
+    Like collect_query_results, but lazy. Queries are taken from queries only when
+    needed and results are not kept, so memory use does not grow with the number
+    of queries. Results are yielded in the same order as queries.
+
+    Parameters
+    ----------
+    trolley:
+        Run queries with this trolley
+    queries:
+        The queries to run. Can be a generator
+    max_workers:
+        Run at most this many queries (or batches of queries) at the same time.
+        Defaults to 1, meaning queries are run one after the other
+    planner:
+        If given, use this to combine queries into fewer server requests.
+        Defaults to None, meaning each query is sent separately
+
+    Returns
+    -------
+    Iterator[QueryResult]
+        One result per query, in the same order as queries
+    """
+    if planner:
+        batches: Iterable[QueryBatch] = planner.plan(queries)
+    else:
+        batches = (QueryBatch([x]) for x in queries)
+
+    if max_workers <= 1:
+        for batch in batches:
+            yield from run_batch(trolley, batch)
+        return
+
+    logger.debug(f"Running queries with {max_workers} threads")
+    # Keep a limited number of queries in flight. Executor.map() would consume
+    # all queries up front
+    in_flight: "Deque[Future[List[QueryResult]]]" = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for batch in batches:
+            in_flight.append(executor.submit(run_batch, trolley, batch))
+            if len(in_flight) >= max_workers * 2:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
+
+
+def retry_failed_queries(
+    trolley: "Trolley", results: Iterable[QueryResult], max_workers: int = 1
+) -> Iterator[QueryResult]:
+    """Pass on results as they come in, holding back errors. Then run each failed
+    query once more and yield the new results.
+
+    A final pass for queries that failed because of a temporary problem. Results
+    of queries that were run again come last, so results are not in query order.
+
+    Parameters
+    ----------
+    trolley:
+        Run failed queries again with this trolley
+    results:
+        Results of a first run. Can be a generator
+    max_workers:
+        Run at most this many failed queries at the same time. Defaults to 1
+    """
+    failed: List["Query"] = []
+    for result in results:
+        if result.is_error():
+            failed.append(result.query)
+        else:
+            yield result
+    if not failed:
+        return
+
+    logger.info(f"Running {len(failed)} failed queries again")
+    recovered = 0
+    for result in iter_query_results(trolley, failed, max_workers=max_workers):
+        if not result.is_error():
+            recovered += 1
+        yield result
+    logger.info(f"{recovered} of {len(failed)} failed queries succeeded when run again")
+
+
+def iter_stored_or_run(
+    queries: Iterable["Query"],
+    get_stored: Callable[["Query"], Optional[QueryResult]],
+    run_queries: Callable[[Iterable["Query"]], Iterable[QueryResult]],
+    on_result: Callable[[QueryResult], None],
+) -> Iterator[QueryResult]:
+    """Yield a result for each query. Use the stored result if there is one, run
+    the other queries.
+
+    Stored results are merged back in between the results of queries that were
+    run, in query order. If run_queries yields in query order, like
+    iter_query_results(), so does this. A stored result is held until a result of
+    a later query comes in, or until all queries are done.
+
+    Parameters
+    ----------
+    queries:
+        The queries to answer. Can be a generator
+    get_stored:
+        Returns the stored result for a query, or None if it has to be run
+    run_queries:
+        Runs the queries it is given and yields one result per query
+    on_result:
+        Called with each result of run_queries, before it is yielded
+    """
+    stored: Deque[Tuple[int, QueryResult]] = deque()  # in query order
+    # Positions in queries of queries being run, by id. Query kept to keep id unique
+    running: Dict[int, Deque[Tuple[int, "Query"]]] = {}
+
+    def to_run() -> Iterator["Query"]:
+        for position, query in enumerate(queries):
+            result = get_stored(query)
+            if result is not None:
+                stored.append((position, result))
+            else:
+                running.setdefault(id(query), deque()).append((position, query))
+                yield query
+
+    for result in run_queries(to_run()):
+        positions = running[id(result.query)]
+        position, _ = positions.popleft()
+        if not positions:
+            del running[id(result.query)]
+        while stored and stored[0][0] < position:
+            yield stored.popleft()[1]
+        on_result(result)
+        yield result
+    while stored:
+        yield stored.popleft()[1]
+
+
+def iter_checkpointed_results(
+    journal: "QueryJournal",
+    queries: Iterable["Query"],
+    run_queries: Callable[[Iterable["Query"]], Iterable[QueryResult]],
+    channel_key: str = "",
+) -> Iterator[QueryResult]:
+    """Run queries, storing each result in journal. Queries that found a study in
+    an earlier run with the same journal are not run again. Their stored result
+    is yielded instead, in query order. See iter_stored_or_run()
+
+    Parameters
+    ----------
+    journal:
+        Store results here and skip queries finished according to it
+    queries:
+        The queries to run. Can be a generator
+    run_queries:
+        Runs the queries it is given and yields one result per query. Like
+        iter_query_results(), with trolley and other arguments filled in
+    channel_key:
+        Key of the channel queries are sent to. Results from different channels
+        are kept apart in journal
+    """
+
+    def get_stored(query: "Query") -> Optional[QueryResult]:
+        key = query_key(query, channel_key)
+        return journal.get_result(key, query) if journal.is_finished(key) else None
+
+    return iter_stored_or_run(
+        queries,
+        get_stored=get_stored,
+        run_queries=run_queries,
+        on_result=lambda x: journal.mark_result(query_key(x.query, channel_key), x),
+    )
+
+
+class QueryExpander:
+    """Answers series and instance level queries level by level: First a study
+    level query, then one series level query per study, then one instance level
+    query per series. Sub-queries run in parallel. Results are merged into one
+    Study/Series/Instance tree per study.
+
+    Many small queries that run in parallel are often much faster than one
+    instance level query for a large study, which can mean a huge response or
+    many follow-up calls one after the other.
+
+    Notes
+    -----
+    Safe to use from several threads. max_in_flight is shared by all of them
+    """
+
+    def __init__(self, searcher: "Searcher", max_in_flight: int = 4):
+        """
+
+        Parameters
+        ----------
+        searcher:
+            Send sub-queries to this
+        max_in_flight:
+            Never run more than this many sub-queries at the same time, over all
+            expanded queries. Defaults to 4
+        """
+        self.searcher = searcher
+        self.max_in_flight = max(max_in_flight, 1)
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+
+    def find_studies(self, query: "Query") -> List["Study"]:
+        """Run query, expanding it level by level if below study level
+
+        Raises
+        ------
+        DICOMTrolleyError
+            If any sub-query fails
+        """
+        from dicomtrolley.core import QueryLevels
+
+        if query.query_level == QueryLevels.STUDY:
+            return list(self.searcher.find_studies(query))
+
+        studies = self.run(self.sub_query(query, QueryLevels.STUDY))
+        logger.debug(f"Expanding {len(studies)} studies to {query.query_level} level")
+        executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
         try:
-            results.append(
-                QueryStudyResult(content=trolley.find_study(query), query=query)
+            series_futures = [
+                (
+                    study,
+                    executor.submit(
+                        self.run,
+                        self.sub_query(
+                            query, QueryLevels.SERIES, StudyInstanceUID=study.uid
+                        ),
+                    ),
+                )
+                for study in studies
+            ]
+            instance_futures = []
+            for study, future in series_futures:
+                attach_series(study, future.result())
+                if query.query_level != QueryLevels.INSTANCE:
+                    continue
+                for series in study.series:
+                    instance_query = self.sub_query(
+                        query,
+                        QueryLevels.INSTANCE,
+                        StudyInstanceUID=study.uid,
+                        SeriesInstanceUID=series.uid,
+                    )
+                    instance_futures.append(
+                        (series, executor.submit(self.run, instance_query))
+                    )
+            for series, future in instance_futures:
+                attach_instances(series, future.result())
+        finally:
+            executor.shutdown(cancel_futures=True)
+        return studies
+
+    def run(self, query: "Query") -> List["Study"]:
+        """Run a single sub-query, waiting for a free slot"""
+        with self._slots:
+            return list(self.searcher.find_studies(query))
+
+    @staticmethod
+    def sub_query(query: "Query", level: str, **uids: str) -> "Query":
+        """query at level, limited to the given uids, asking only for the include
+        fields of that level. Fields not known for any level are asked for at
+        the level of query
+        """
+        update: Dict[str, Any] = dict(query_level=level, **uids)
+        if query.include_fields:
+            update["include_fields"] = sorted(
+                split_include_fields(query.include_fields, query.query_level)[level]
             )
-        except DICOMTrolleyError as e:
-            logger.warning(e)
-            results.append(QueryErrorResult(content=e, query=query))
+        return query.model_copy(update=update)
 
-    return results
+
+def split_include_fields(
+    include_fields: Iterable[str], query_level: str
+) -> Dict[str, Set[str]]:
+    """Include fields per query level. Unknown fields go to query_level"""
+    from dicomtrolley.core import QueryLevels
+    from dicomtrolley.fields import (
+        InstanceLevel,
+        SeriesLevel,
+        SeriesLevelPromotable,
+        StudyLevel,
+    )
+
+    known = {
+        QueryLevels.STUDY: StudyLevel.fields,
+        QueryLevels.SERIES: SeriesLevel.fields | SeriesLevelPromotable.fields,
+        QueryLevels.INSTANCE: InstanceLevel.fields,
+    }
+    split: Dict[str, Set[str]] = {level: set() for level in known}
+    for field in include_fields:
+        level = next((x for x, y in known.items() if field in y), query_level)
+        split[level].add(field)
+    return split
+
+
+def attach_series(study: "Study", found: Sequence["Study"]):
+    """Give study the series of the study with the same uid in found"""
+    series = [x for y in found if y.uid == study.uid for x in y.series]
+    for item in series:
+        item.parent = study
+    study.series = series
+
+
+def attach_instances(series: "Series", found: Sequence["Study"]):
+    """Give series the instances of the series with the same uid in found"""
+    instances = [
+        x for y in found for z in y.series if z.uid == series.uid for x in z.instances
+    ]
+    for instance in instances:
+        instance.parent = series
+    series.instances = instances
+
+
+async def collect_query_results_async(
+    trolley: "Trolley", queries: Iterable["Query"], max_workers: int = 1
+) -> List[QueryResult]:
+    """Like collect_query_results, but awaitable. For use in asyncio code.
+
+    Searchers are blocking, so each query is run in a thread. At most
+    max_workers queries are in flight at the same time.
+    """
+    import asyncio  # not at top. Only needed here and slow to import
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max(max_workers, 1))
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+
+        async def run_limited(query: "Query") -> QueryResult:
+            async with semaphore:
+                return await loop.run_in_executor(executor, run_query, trolley, query)
+
+        return list(await asyncio.gather(*(run_limited(x) for x in queries)))
@@ -0,0 +1,189 @@
+"""Deciding when to try failed queries again, and pausing all queries when too
+many fail at once. See RetryingSearcher for applying this to queries.
+
+Notes
+-----
+requests is imported only when needed. This module is imported by channels,
+which should stay quick to import.
+"""
+
+import random
+import threading
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Callable, Deque, Iterator, List, Optional, Sequence
+
+from dicomtrolley.exceptions import DICOMTrolleyError
+from pydantic.main import BaseModel
+
+from dicomtrolleytool.logs import get_module_logger
+
+if TYPE_CHECKING:
+    from requests import Response, Session
+
+logger = get_module_logger("retry")
+
+# dicomtrolley DICOMQR raises these for connection problems. No status code or
+# exception type, so recognize by message. PooledDICOMQR raises AssociationError
+DICOM_QR_CONNECTION_ERRORS = (
+    "Association rejected, aborted or never connected",
+    "Connection timed out, was aborted or received invalid response",
+)
+
+
+class RetryPolicy(BaseModel):
+    """When and how often to try a failed query again. Part of channel settings
+
+    Only errors that might go away by themselves are retried: http status codes in
+    retry_status_codes, timeouts and connection errors. A query that is wrong will
+    be wrong the next time as well.
+    """
+
+    # Try each query at most this many times. 1 means never retry
+    max_attempts: int = 3
+    # Seconds to wait before the first retry. Doubles with each next retry
+    backoff: float = 1.0
+    # Never wait longer than this many seconds between attempts
+    max_backoff: float = 30.0
+    # Wait a random time between 0 and the backoff. Keeps parallel queries that
+    # failed together from retrying together
+    jitter: bool = True
+    retry_status_codes: List[int] = [429, 500, 502, 503, 504]
+
+    # Pause all queries when at least this fraction of the last
+    # breaker_window queries failed with a retryable error. 1.0 or more: never
+    breaker_threshold: float = 0.5
+    breaker_window: int = 20
+    # Seconds to pause all queries when the breaker trips
+    breaker_pause: float = 30.0
+
+    def delay(self, attempt: int) -> float:
+        """Seconds to wait after attempt number attempt (starting at 1) failed"""
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        if self.jitter:
+            return random.uniform(0, delay)
+        return delay
+
+    def is_retryable(self, error: Exception) -> bool:
+        """True if error might go away by trying again"""
+        from requests.exceptions import ChunkedEncodingError, ConnectionError, Timeout
+
+        for cause in iter_causes(error):
+            if isinstance(cause, RetryableStatusError):
+                return cause.status_code in self.retry_status_codes
+            if isinstance(
+                cause,
+                (ConnectionError, Timeout, ChunkedEncodingError, AssociationError),
+            ):
+                return True
+            if isinstance(cause, DICOMTrolleyError) and any(
+                x in str(cause) for x in DICOM_QR_CONNECTION_ERRORS
+            ):
+                return True
+        return False
+
+    def watch_session(self, session: "Session"):
+        """Make session raise RetryableStatusError for responses with a status in
+        retry_status_codes. Some dicomtrolley searchers do not check the status
+        of a response and would fail later on with a less clear error. Watching a
+        session again replaces the earlier hook
+        """
+        hooks = session.hooks["response"]
+        hooks[:] = [x for x in hooks if not hasattr(x, "status_codes")]
+        hooks.append(raise_for_status_hook(self.retry_status_codes))
+
+
+def iter_causes(error: BaseException) -> Iterator[BaseException]:
+    """error, then the error that caused it, and so on"""
+    seen = set()
+    current: Optional[BaseException] = error
+    while current is not None and id(current) not in seen:
+        seen.add(id(current))
+        yield current
+        current = current.__cause__ or current.__context__
+
+
+def raise_for_status_hook(status_codes: Sequence[int]) -> Callable:
+    """Requests response hook that raises RetryableStatusError for status_codes"""
+
+    def hook(response: "Response", *args, **kwargs):
+        if response.status_code in status_codes:
+            raise RetryableStatusError(
+                f"Calling {response.url} failed ({response.status_code} - "
+                f"{response.reason})",
+                status_code=response.status_code,
+            )
+        return response
+
+    hook.status_codes = status_codes  # type: ignore[attr-defined]
+    return hook
+
+
+class CircuitBreaker:
+    """Pauses all queries after too many recent queries failed. Gives an
+    overloaded server room to recover instead of piling on retries.
+
+    Keeps track of the outcome of the last window query attempts. When the fraction of
+    failures reaches threshold, every query waits until pause seconds have passed.
+    The outcomes are then forgotten and queries continue. Safe to use from
+    several threads
+    """
+
+    def __init__(self, threshold: float = 0.5, window: int = 20, pause: float = 30):
+        self.threshold = threshold
+        self.window = window
+        self.pause = pause
+        self.trip_count = 0
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block while the breaker is tripped"""
+        with self._lock:
+            remaining = self._paused_until - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def record(self, success: bool):
+        """Record the outcome of a query. Trips the breaker if too many failed"""
+        with self._lock:
+            self._outcomes.append(success)
+            if len(self._outcomes) < self.window or self.threshold >= 1:
+                return
+            failure_rate = self._outcomes.count(False) / len(self._outcomes)
+            if failure_rate >= self.threshold:
+                self.trip_count += 1
+                self._paused_until = time.monotonic() + self.pause
+                self._outcomes.clear()
+                logger.warning(
+                    f"{failure_rate:.0%} of the last {self.window} query attempts "
+                    f"failed. "
+                    f"Pausing all queries for {self.pause:.0f} seconds"
+                )
+
+
+class RetryableStatusError(DICOMTrolleyError):
+    """Server answered with a status that might be different next time"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class AssociationError(DICOMTrolleyError):
+    """A DICOM association could not be set up, or failed during a query. See
+    associations.AssociationPool
+    """
+
+
+class RetriesExhaustedError(DICOMTrolleyError):
+    """A query kept failing with retryable errors.
+
+    Subclass of DICOMTrolleyError so that it ends up in a QueryErrorResult like any
+    other failed query
+    """
+
+    def __init__(self, message: str, attempts: int):
+        super().__init__(message)
+        self.attempts = attempts
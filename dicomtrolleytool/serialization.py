@@ -0,0 +1,82 @@
+"""Converting dicomtrolley objects to and from plain dicts, for storing on disk"""
+from typing import Any, Dict, List, Sequence
+
+from dicomtrolley.core import Study
+from dicomtrolley.parsing import DICOMParseTree
+from pydicom import Dataset
+
+from dicomtrolleytool.exceptions import TrolleyToolError
+
+
+def study_to_dict(study: Study) -> Dict[str, Any]:
+    """Study, including any series and instances, as a json-serializable dict
+
+    Raises
+    ------
+    SerializationError
+        If any dataset in study cannot be serialized
+    """
+    return {
+        "uid": study.uid,
+        "data": dataset_to_json_dict(study.data),
+        "series": [
+            {
+                "uid": series.uid,
+                "data": dataset_to_json_dict(series.data),
+                "instances": [
+                    {"uid": x.uid, "data": dataset_to_json_dict(x.data)}
+                    for x in series.instances
+                ],
+            }
+            for series in study.series
+        ],
+    }
+
+
+def study_from_dict(dict_in: Dict[str, Any]) -> Study:
+    """Inverse of study_to_dict()
+
+    Raises
+    ------
+    SerializationError
+        If dict_in is not a valid serialized study
+    """
+    try:
+        tree = DICOMParseTree()
+        study_uid = dict_in["uid"]
+        tree.insert(Dataset.from_json(dict_in["data"]), study_uid=study_uid)
+        for series in dict_in["series"]:
+            tree.insert(
+                Dataset.from_json(series["data"]),
+                study_uid=study_uid,
+                series_uid=series["uid"],
+            )
+            for instance in series["instances"]:
+                tree.insert(
+                    Dataset.from_json(instance["data"]),
+                    study_uid=study_uid,
+                    series_uid=series["uid"],
+                    instance_uid=instance["uid"],
+                )
+        return tree.as_studies()[0]
+    except (KeyError, TypeError, ValueError) as e:
+        raise SerializationError(f"Could not read study from dict: {e}") from e
+
+
+def studies_to_list(studies: Sequence[Study]) -> List[Dict[str, Any]]:
+    return [study_to_dict(x) for x in studies]
+
+
+def studies_from_list(list_in: List[Dict[str, Any]]) -> List[Study]:
+    return [study_from_dict(x) for x in list_in]
+
+
+def dataset_to_json_dict(ds: Dataset) -> Dict[str, Any]:
+    try:
+        return ds.to_json_dict()
+    except (TypeError, ValueError) as e:
+        raise SerializationError(f"Could not serialize dataset: {e}") from e
+
+
+class SerializationError(TrolleyToolError):
+    pass
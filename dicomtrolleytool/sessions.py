@@ -0,0 +1,250 @@
+"""Setting up http sessions and keeping logged-in sessions between trolley
+invocations
+
+Logging in for each command is slow when running many commands from scripts.
+Session cookies are stored in a private file and reused by the next command as
+long as they are valid.
+"""
+import os
+import pathlib
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
+
+from dicomtrolley.auth import VitreaAuth
+from pydantic.main import BaseModel
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.cookies import create_cookie
+
+from dicomtrolleytool.logs import get_module_logger
+
+if TYPE_CHECKING:
+    from dicomtrolleytool.channels import HTTPTransport
+
+logger = get_module_logger("sessions")
+
+DEFAULT_SESSION_CACHE_PATH = pathlib.Path.home() / ".trolleytool" / "sessions.json"
+
+
+class TransportAdapter(HTTPAdapter):
+    """HTTPAdapter with a timeout for requests that do not set one themselves.
+    dicomtrolley never sets a timeout
+    """
+
+    def __init__(
+        self,
+        timeout: Optional[Tuple[Optional[float], Optional[float]]] = None,
+        **kwargs,
+    ):
+        """
+
+        Parameters
+        ----------
+        timeout:
+            (connect, read) timeout in seconds. Defaults to None, meaning wait
+            forever
+        kwargs:
+            Passed to HTTPAdapter
+        """
+        super().__init__(**kwargs)
+        self.timeout = timeout
+
+    def send(self, request, *args, **kwargs):
+        if not args and kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, *args, **kwargs)
+
+
+def configure_transport(session: Session, transport: "HTTPTransport"):
+    """Apply connection pool, keep-alive, compression and timeout settings to
+    session
+    """
+    timeout = None
+    if transport.connect_timeout is not None or transport.read_timeout is not None:
+        timeout = (transport.connect_timeout, transport.read_timeout)
+    for prefix in ("https://", "http://"):
+        session.mount(
+            prefix,
+            TransportAdapter(
+                timeout=timeout,
+                pool_connections=transport.pool_connections,
+                pool_maxsize=transport.pool_maxsize,
+                pool_block=transport.pool_block,
+            ),
+        )
+    if not transport.keep_alive:
+        session.headers["Connection"] = "close"
+    if not transport.compression:
+        session.headers["Accept-Encoding"] = "identity"
+
+
+class TrackingVitreaAuth(VitreaAuth):
+    """VitreaAuth that keeps track of logins and can log in before it is asked"""
+
+    def __init__(self, login_url, user, password, realm):
+        super().__init__(login_url=login_url, user=user, password=password, realm=realm)
+        self.logins = 0
+        self.login_time = 0.0  # total seconds spent logging in
+
+    def do_login_call(self, connection):
+        start = time.perf_counter()
+        response = super().do_login_call(connection)
+        self.logins += 1
+        self.login_time += time.perf_counter() - start
+        logger.debug(f"Logged in to {self.login_url}")
+        return response
+
+    def login(self, session: Session):
+        """Log in right away instead of waiting for the server to refuse a call"""
+        response = self.do_login_call(session.get_adapter(self.login_url))
+        session.cookies.update(response.cookies)
+
+
+class CachedSession(BaseModel):
+    """Cookies of a logged-in session"""
+
+    cookies: List[Dict]
+    expires: float  # unix timestamp
+
+    @classmethod
+    def init_from_session(cls, session: Session, expires: float):
+        return cls(
+            cookies=[
+                {
+                    "name": x.name,
+                    "value": x.value,
+                    "domain": x.domain,
+                    "path": x.path,
+                    "expires": x.expires,
+                    "secure": x.secure,
+                }
+                for x in session.cookies
+            ],
+            expires=expires,
+        )
+
+    def apply_to(self, session: Session):
+        for cookie in self.cookies:
+            session.cookies.set_cookie(create_cookie(**cookie))
+
+
+class SessionCacheStats(BaseModel):
+    logins: int = 0
+    logins_avoided: int = 0
+
+
+class SessionCacheContent(BaseModel):
+    sessions: Dict[str, CachedSession] = {}
+    stats: SessionCacheStats = SessionCacheStats()
+
+
+class SessionCache:
+    """Stores session cookies per channel in a file only readable by the user"""
+
+    def __init__(
+        self,
+        path: pathlib.Path = DEFAULT_SESSION_CACHE_PATH,
+        max_age: int = 600,
+        refresh_margin: int = 60,
+    ):
+        """
+
+        Parameters
+        ----------
+        path:
+            Store sessions in this file
+        max_age:
+            Assume a server forgets a session after this many seconds of not
+            being used. Defaults to 600 (10 minutes)
+        refresh_margin:
+            Log in again proactively if a cached session would expire within
+            this many seconds. Defaults to 60
+        """
+        self.path = pathlib.Path(path)
+        self.max_age = max_age
+        self.refresh_margin = refresh_margin
+        self._restored: Dict[str, Session] = {}  # sessions restored from cache
+        self._tracked: Dict[str, Session] = {}  # all sessions to store on save()
+        # logins per session already added to stats. Sessions can be saved more
+        # than once, for example by each command in daemon mode
+        self._counted_logins: Dict[str, int] = {}
+        self._counted_avoided: Set[str] = set()
+
+    def load(self) -> SessionCacheContent:
+        if not self.path.exists():
+            return SessionCacheContent()
+        try:
+            return SessionCacheContent.model_validate_json(self.path.read_text())
+        except ValueError as e:
+            logger.warning(f"Could not read session cache {self.path}: {e}. Ignoring")
+            return SessionCacheContent()
+
+    def write(self, content: SessionCacheContent):
+        """Write to a temp file only readable by user, then replace"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+        descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, "w") as f:
+            f.write(content.model_dump_json(indent=2))
+        os.replace(temp_path, self.path)
+
+    def attach(self, key: str, session: Session) -> Session:
+        """Restore cookies stored under key into session, if still valid.
+        session will be stored under key on save()
+
+        Returns
+        -------
+        Session
+            The input session, for convenience
+        """
+        self._tracked[key] = session
+        cached = self.load().sessions.get(key)
+        if not cached:
+            logger.debug(f"No cached session for '{key}'")
+            return session
+
+        remaining = cached.expires - time.time()
+        if remaining <= 0:
+            logger.debug(f"Cached session for '{key}' has expired")
+        elif remaining < self.refresh_margin and isinstance(
+            session.auth, TrackingVitreaAuth
+        ):
+            logger.debug(f"Cached session for '{key}' about to expire. Refreshing")
+            session.auth.login(session)
+        else:
+            logger.debug(f"Using cached session for '{key}'")
+            cached.apply_to(session)
+            self._restored[key] = session
+        return session
+
+    def save(self):
+        """Store cookies of all attached sessions and update statistics"""
+        if not self._tracked:
+            return
+        content = self.load()
+        expires = time.time() + self.max_age
+        for key, session in self._tracked.items():
+            if not session.cookies:
+                continue  # nothing to reuse
+            content.sessions[key] = CachedSession.init_from_session(
+                session, expires=expires
+            )
+            logins = getattr(session.auth, "logins", 0)
+            content.stats.logins += logins - self._counted_logins.get(key, 0)
+            self._counted_logins[key] = logins
+            if key in self._restored and not logins:
+                if key not in self._counted_avoided:
+                    content.stats.logins_avoided += 1
+                    self._counted_avoided.add(key)
+        self.write(content)
+
+    def stats(self) -> SessionCacheStats:
+        return self.load().stats
+
+    def clear(self):
+        """Forget all sessions and reset statistics"""
+        if self.path.exists():
+            self.path.unlink()
+        self._restored = {}
+        self._counted_logins = {}
+        self._counted_avoided = set()
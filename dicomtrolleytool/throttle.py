@@ -0,0 +1,268 @@
+"""Limiting how hard a server is used: requests and bytes per second, and the
+number of requests in flight. Configured per channel with channels.Throttle
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, Iterator, Optional
+
+from requests.adapters import BaseAdapter
+
+from dicomtrolleytool.logs import get_module_logger
+
+if TYPE_CHECKING:
+    from requests import Session
+
+    from dicomtrolleytool.channels import Throttle
+
+logger = get_module_logger("throttle")
+
+
+class TokenBucket:
+    """Hands out tokens at a fixed rate, with bursts up to capacity. Safe to use
+    from several threads
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        """
+
+        Parameters
+        ----------
+        rate:
+            Tokens per second
+        capacity:
+            Allow bursts of up to this many tokens. Defaults to None, meaning one
+            second worth of tokens
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, amount: float = 1):
+        """Take tokens, waiting until they are available.
+
+        Tokens are reserved right away, so callers are served in order. amount may
+        be more than capacity. The wait is then the time needed to refill
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RateLimiter:
+    """Requests per second and bytes per second for one channel"""
+
+    def __init__(
+        self,
+        requests_per_second: Optional[float] = None,
+        bytes_per_second: Optional[float] = None,
+    ):
+        self.requests = (
+            TokenBucket(requests_per_second) if requests_per_second else None
+        )
+        self.bytes = TokenBucket(bytes_per_second) if bytes_per_second else None
+
+    @classmethod
+    def init_from_throttle(cls, throttle: "Throttle") -> "RateLimiter":
+        return cls(
+            requests_per_second=throttle.requests_per_second,
+            bytes_per_second=throttle.bytes_per_second,
+        )
+
+    def wait_for_request(self):
+        if self.requests:
+            self.requests.take()
+
+    def wait_for_bytes(self, amount: int):
+        """Account for amount bytes received. Waits if receiving too fast"""
+        if self.bytes:
+            self.bytes.take(amount)
+
+
+def limit_session(session: "Session", limiter: RateLimiter):
+    """Make every request sent by session wait for limiter, and throttle reading
+    response content to limiter's bytes per second.
+
+    Wraps the adapters of session instead of replacing them, so that connection
+    pool settings and profiling are kept.
+    """
+    for prefix, adapter in list(session.adapters.items()):
+        session.mount(prefix, RateLimitingAdapter(adapter, limiter))
+
+
+class RateLimitingAdapter(BaseAdapter):
+    """Sends requests through another adapter, within the limits of a
+    RateLimiter
+    """
+
+    def __init__(self, adapter: BaseAdapter, limiter: RateLimiter):
+        super().__init__()
+        self.adapter = adapter
+        self.limiter = limiter
+
+    def send(self, request, *args, **kwargs):
+        self.limiter.wait_for_request()
+        response = self.adapter.send(request, *args, **kwargs)
+        if self.limiter.bytes:
+            throttle_content(response, self.limiter)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+def throttle_content(response, limiter: RateLimiter):
+    """Make reading the content of response wait for limiter.
+
+    requests reads all content, streamed or not, through response.raw.stream()
+    """
+    stream = response.raw.stream
+
+    def throttled_stream(*args, **kwargs):
+        for chunk in stream(*args, **kwargs):
+            limiter.wait_for_bytes(len(chunk))
+            yield chunk
+
+    response.raw.stream = throttled_stream
+
+
+class AdaptiveConcurrencyLimit:
+    """Limits the number of requests in flight, adjusting the limit to what the
+    server handles well. Safe to use from several threads.
+
+    Additive increase, multiplicative decrease (AIMD): The limit grows by about one
+    for each round of requests that completes while recent latency stays within
+    latency_tolerance times the baseline latency. It is halved when recent latency
+    rises above that or when the server signals overload. At most one halving per
+    round of requests, as requests already in flight were sent under the old limit.
+
+    Recent latency and baseline are moving averages over a few and over many
+    requests. Queries differ in cost, so single slow requests are normal. The
+    baseline follows a lasting change in the mix of requests.
+    """
+
+    # Weight of the latest request in the moving averages of recent and baseline
+    # latency
+    RECENT_WEIGHT = 0.5
+    BASELINE_WEIGHT = 0.02
+
+    def __init__(
+        self,
+        max_limit: Optional[int] = None,
+        min_limit: int = 1,
+        initial_limit: int = 1,
+        latency_tolerance: float = 2.0,
+    ):
+        """
+
+        Parameters
+        ----------
+        max_limit:
+            Never allow more than this many requests in flight. Defaults to None,
+            meaning no maximum. The limit only grows while fully used, so the number
+            of threads sending requests acts as maximum as well
+        min_limit:
+            Always allow at least this many requests in flight
+        initial_limit:
+            Start with this limit
+        latency_tolerance:
+            Recent latency above this many times the baseline latency means the
+            server is overloaded
+        """
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.latency_tolerance = latency_tolerance
+        self._limit = float(initial_limit)
+        self.in_flight = 0
+        self.recent_latency: Optional[float] = None
+        self.baseline_latency: Optional[float] = None
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def acquire(self):
+        """Wait until a request may be sent"""
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+
+    @contextmanager
+    def request(self, is_overload: Callable[[Exception], bool]) -> Iterator[None]:
+        """Hold a slot for the duration of this context and report its latency
+
+        Parameters
+        ----------
+        is_overload:
+            Returns True if an error raised in this context means the server is
+            overloaded
+        """
+        self.acquire()
+        start = time.perf_counter()
+        overloaded = False
+        try:
+            yield
+        except Exception as e:
+            overloaded = is_overload(e)
+            raise
+        finally:
+            self.release(time.perf_counter() - start, overloaded)
+
+    def release(self, latency: float, overloaded: bool = False):
+        """Record a finished request and adjust the limit
+
+        Parameters
+        ----------
+        latency:
+            Seconds the request took
+        overloaded:
+            True if the server signalled it is too busy, like http 503
+        """
+        with self._condition:
+            was_saturated = self.in_flight >= self.limit
+            self.in_flight -= 1
+            if overloaded:
+                self._decrease(latency)
+            else:
+                self._record_latency(latency)
+                if self.recent_latency > self.baseline_latency * self.latency_tolerance:
+                    self._decrease(latency)
+                elif was_saturated:
+                    self._increase()
+            self._condition.notify_all()
+
+    def _record_latency(self, latency: float):
+        if self.recent_latency is None or self.baseline_latency is None:
+            self.recent_latency = self.baseline_latency = latency
+            return
+        self.recent_latency += self.RECENT_WEIGHT * (latency - self.recent_latency)
+        self.baseline_latency += self.BASELINE_WEIGHT * (
+            latency - self.baseline_latency
+        )
+
+    def _increase(self):
+        self._limit += 1 / self._limit  # about one per round of requests
+        if self.max_limit is not None:
+            self._limit = min(self._limit, self.max_limit)
+
+    def _decrease(self, latency: float):
+        now = time.monotonic()
+        if now - self._last_decrease < latency:
+            return  # already decreased for requests in flight
+        self._last_decrease = now
+        old_limit = self.limit
+        self._limit = max(self._limit / 2, self.min_limit)
+        if self.limit < old_limit:
+            logger.debug(f"Server overloaded. Lowering concurrency to {self.limit}")
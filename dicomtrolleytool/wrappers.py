@@ -0,0 +1,319 @@
+"""Searchers and downloaders that add behaviour to other searchers and downloaders"""
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Optional, Sequence
+
+from dicomtrolley.core import (
+    DICOMDownloadable,
+    Downloader,
+    InstanceReference,
+    Query,
+    QueryLevels,
+    Searcher,
+    Study,
+)
+
+from dicomtrolleytool.logs import get_module_logger
+from dicomtrolleytool.retry import CircuitBreaker, RetriesExhaustedError, RetryPolicy
+
+if TYPE_CHECKING:
+    from dicomtrolleytool.profiling import Profiler
+    from dicomtrolleytool.throttle import AdaptiveConcurrencyLimit, RateLimiter
+
+logger = get_module_logger("wrappers")
+
+
+class SearcherWrapper(Searcher):
+    """Passes all searches on to a wrapped searcher. Base class.
+
+    Override find_studies() to add behaviour. find_study() and
+    find_study_by_id() end up calling find_studies() as well.
+    """
+
+    def __init__(self, searcher: Searcher):
+        self.searcher = searcher
+
+    def __str__(self):
+        return f"{type(self).__name__} around {self.searcher}"
+
+    def __getattr__(self, item):
+        # Only called for attributes not found on this object. Pass on.
+        if item.startswith("_"):  # avoid recursion on missing private attributes
+            raise AttributeError(item)
+        return getattr(self.searcher, item)
+
+    def find_studies(self, query: Query) -> Sequence[Study]:
+        return self.searcher.find_studies(query)
+
+
+class DownloaderWrapper(Downloader):
+    """Passes all downloads on to a wrapped downloader. Base class."""
+
+    def __init__(self, downloader: Downloader):
+        self.downloader = downloader
+
+    def __str__(self):
+        return f"{type(self).__name__} around {self.downloader}"
+
+    def __getattr__(self, item):
+        if item.startswith("_"):
+            raise AttributeError(item)
+        return getattr(self.downloader, item)
+
+    def get_dataset(self, instance: InstanceReference):
+        return self.downloader.get_dataset(instance)
+
+    def datasets(self, objects: Sequence[DICOMDownloadable]):
+        return self.downloader.datasets(objects)
+
+
+class LazySearcher(SearcherWrapper):
+    """Creates the actual searcher only when it is first used.
+
+    Creating a searcher can mean reading credentials and logging in. No need to
+    do that for commands that never search.
+    """
+
+    def __init__(self, create: Callable[[], Searcher]):
+        self._create = create
+        self._searcher: Optional[Searcher] = None
+        self._lock = threading.Lock()  # avoid creating twice from parallel threads
+
+    def __str__(self):
+        if self._searcher is None:
+            return f"{type(self).__name__} (not created yet)"
+        return super().__str__()
+
+    @property
+    def searcher(self) -> Searcher:
+        with self._lock:
+            if self._searcher is None:
+                self._searcher = self._create()
+        return self._searcher
+
+    def find_study(self, query: Query) -> Study:
+        return self.searcher.find_study(query)
+
+    def find_study_by_id(
+        self, study_uid: str, query_level: QueryLevels = QueryLevels.STUDY
+    ) -> Study:
+        return self.searcher.find_study_by_id(study_uid, query_level=query_level)
+
+
+class LazyDownloader(DownloaderWrapper):
+    """Creates the actual downloader only when it is first used"""
+
+    def __init__(self, create: Callable[[], Downloader]):
+        self._create = create
+        self._downloader: Optional[Downloader] = None
+        self._lock = threading.Lock()  # avoid creating twice from parallel threads
+
+    def __str__(self):
+        if self._downloader is None:
+            return f"{type(self).__name__} (not created yet)"
+        return super().__str__()
+
+    @property
+    def downloader(self) -> Downloader:
+        with self._lock:
+            if self._downloader is None:
+                self._downloader = self._create()
+        return self._downloader
+
+
+class RetryingSearcher(SearcherWrapper):
+    """Tries failed queries again according to a RetryPolicy. Queries wait while
+    the circuit breaker is tripped
+    """
+
+    def __init__(
+        self,
+        searcher: Searcher,
+        policy: RetryPolicy,
+        breaker: Optional[CircuitBreaker] = None,
+        profiler: Optional["Profiler"] = None,
+    ):
+        """
+
+        Parameters
+        ----------
+        searcher:
+            Pass queries on to this searcher
+        policy:
+            Retry according to this
+        breaker:
+            Share this circuit breaker. Defaults to None, meaning create one from
+            policy
+        profiler:
+            Record each retry and the time waited before it in this. Defaults to
+            None, meaning do not record
+        """
+        super().__init__(searcher)
+        self.policy = policy
+        self.profiler = profiler
+        if breaker is None:
+            breaker = CircuitBreaker(
+                threshold=policy.breaker_threshold,
+                window=policy.breaker_window,
+                pause=policy.breaker_pause,
+            )
+        self.breaker = breaker
+
+    def find_studies(self, query: Query) -> Sequence[Study]:
+        """Like Searcher.find_studies(), retrying on retryable errors
+
+        Raises
+        ------
+        RetriesExhaustedError
+            If the query still failed with a retryable error after
+            policy.max_attempts attempts
+        """
+        attempt = 1
+        while True:
+            self.breaker.wait()
+            try:
+                studies = self.searcher.find_studies(query)
+            except Exception as e:
+                if not self.policy.is_retryable(e):
+                    self.breaker.record(success=True)  # server did answer
+                    raise
+                self.breaker.record(success=False)
+                if attempt >= self.policy.max_attempts:
+                    raise RetriesExhaustedError(
+                        f"Query '{query.to_short_string()}' failed after {attempt} "
+                        f"attempt(s): {e}",
+                        attempts=attempt,
+                    ) from e
+                delay = self.policy.delay(attempt)
+                logger.info(
+                    f"Attempt {attempt} of {self.policy.max_attempts} failed: {e}. "
+                    f"Retrying in {delay:.1f}s"
+                )
+                start = time.perf_counter()
+                time.sleep(delay)
+                if self.profiler:
+                    from dicomtrolleytool.profiling import Phase
+
+                    self.profiler.add(
+                        Phase.RETRY,
+                        f"{query.to_short_string()} attempt {attempt + 1}: {e}",
+                        start,
+                        time.perf_counter() - start,
+                        retried=True,
+                    )
+                attempt += 1
+                continue
+            self.breaker.record(success=True)
+            return studies
+
+
+class ExpandingSearcher(SearcherWrapper):
+    """Runs series and instance level queries level by level, with parallel
+    sub-queries. See query.QueryExpander
+    """
+
+    def __init__(self, searcher: Searcher, max_in_flight: int = 4):
+        """
+
+        Parameters
+        ----------
+        searcher:
+            Send sub-queries to this searcher
+        max_in_flight:
+            Never run more than this many sub-queries at the same time. Defaults
+            to 4
+        """
+        from dicomtrolleytool.query import QueryExpander
+
+        super().__init__(searcher)
+        self.expander = QueryExpander(searcher, max_in_flight=max_in_flight)
+
+    def find_studies(self, query: Query) -> Sequence[Study]:
+        return self.expander.find_studies(query)
+
+
+def never_overloaded(error: Exception) -> bool:
+    return False
+
+
+class ThrottlingSearcher(SearcherWrapper):
+    """Keeps queries within the limits of a channel. Waits for rate limiter before
+    each query and for a free slot in concurrency limit.
+
+    Searchers that use http are better rate limited per request, see
+    throttle.limit_session()
+    """
+
+    def __init__(
+        self,
+        searcher: Searcher,
+        rate_limiter: Optional["RateLimiter"] = None,
+        concurrency: Optional["AdaptiveConcurrencyLimit"] = None,
+        is_overload: Callable[[Exception], bool] = never_overloaded,
+    ):
+        """
+
+        Parameters
+        ----------
+        searcher:
+            Pass queries on to this searcher
+        rate_limiter:
+            Take one request from this for each query. Defaults to None, meaning
+            no rate limit
+        concurrency:
+            Take a slot from this for each query and report its latency. Defaults
+            to None, meaning no limit
+        is_overload:
+            Returns True if error means the server is overloaded. Defaults to
+            never
+        """
+        super().__init__(searcher)
+        self.rate_limiter = rate_limiter
+        self.concurrency = concurrency
+        self.is_overload = is_overload
+
+    def find_studies(self, query: Query) -> Sequence[Study]:
+        if self.rate_limiter:
+            self.rate_limiter.wait_for_request()
+        if not self.concurrency:
+            return self.searcher.find_studies(query)
+        with self.concurrency.request(self.is_overload):
+            return self.searcher.find_studies(query)
+
+
+class ThrottlingDownloader(DownloaderWrapper):
+    """Takes a slot from concurrency limit for each download. The time until the
+    first dataset arrives counts as latency
+    """
+
+    def __init__(
+        self,
+        downloader: Downloader,
+        concurrency: "AdaptiveConcurrencyLimit",
+        is_overload: Callable[[Exception], bool] = never_overloaded,
+    ):
+        super().__init__(downloader)
+        self.concurrency = concurrency
+        self.is_overload = is_overload
+
+    def get_dataset(self, instance: InstanceReference):
+        with self.concurrency.request(self.is_overload):
+            return self.downloader.get_dataset(instance)
+
+    def datasets(self, objects: Sequence[DICOMDownloadable]):
+        self.concurrency.acquire()
+        start = time.perf_counter()
+        latency: Optional[float] = None
+        overloaded = False
+        try:
+            for dataset in self.downloader.datasets(objects):
+                if latency is None:
+                    latency = time.perf_counter() - start
+                yield dataset
+        except Exception as e:
+            overloaded = self.is_overload(e)
+            raise
+        finally:
+            if latency is None:
+                latency = time.perf_counter() - start
+            self.concurrency.release(latency, overloaded)
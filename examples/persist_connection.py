@@ -5,6 +5,8 @@ from dicomtrolleytool.channels import (
     DICOMWebChannel,
     MintChannel,
     Rad69Channel,
+    ReplicatedChannel,
+    VitreaChannel,
 )
 from dicomtrolleytool.persistence import KeyRingStorage
 
@@ -51,4 +53,24 @@ storage.save_channel(
     ),
 )
 
+# Searches with MINT and downloads with rad69, logging in once
+storage.save_channel(
+    key="Vitrea",
+    channel=VitreaChannel(
+        key="Vitrea",
+        login_url="login_url",
+        mint_url="mint_url",
+        rad69_url="rad69_url",
+        user="user",
+        password=SecretStr("specialpass"),
+        realm="realm",
+    ),
+)
+
+# Two servers with the same data. Queries and downloads go to the fastest
+storage.save_channel(
+    key="Mirrored",
+    channel=ReplicatedChannel(key="Mirrored", replicas=["DICOM_WEB", "Vitrea"]),
+)
+
 print("Wrote connections to storage")
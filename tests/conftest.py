@@ -10,8 +10,8 @@ from pydicom import Dataset
 from pydicom.tag import Tag
 
 from dicomtrolleytool.cli.base import TrolleyToolContext
-from dicomtrolleytool.persistence import TrolleyToolSettings
 from dicomtrolleytool.query import QueryStudyResult
+from tests.factories import MintChannelFactory, TrolleyToolSettingsFactory
 
 
 @pytest.fixture
@@ -20,7 +20,7 @@ def some_channels():
 
 
 @pytest.fixture
-def context_runner(some_channels, a_study_level_study):
+def context_runner(some_channels, a_study_level_study, tmp_path):
     """Click test runner that injects mock context"""
     a_trolley = Mock(spec_set=Trolley)
     a_trolley.find_study = Mock(
@@ -28,7 +28,9 @@ def context_runner(some_channels, a_study_level_study):
     )  # return single study
     return MockContextCliRunner(
         mock_context=TrolleyToolContext(
-            settings=Mock(spec_set=TrolleyToolSettings), trolley=a_trolley
+            settings=TrolleyToolSettingsFactory(query_jobs_path=tmp_path / "jobs"),
+            trolley=a_trolley,
+            searcher_channel=MintChannelFactory(),
         )
     )
 
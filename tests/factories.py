@@ -3,6 +3,7 @@ from pathlib import Path
 
 import factory
 
+from dicomtrolleytool.channels import DICOMWebChannel, MintChannel
 from dicomtrolleytool.persistence import SettingsFromFile, TrolleyToolSettings
 
 
@@ -29,3 +30,25 @@ class SettingsFromFileFactory(factory.Factory):
     channels = factory.List(
         ["a_searcher", "a_downloader", factory.Sequence(lambda n: f"other_channel_{n}")]
     )
+
+
+class MintChannelFactory(factory.Factory):
+    class Meta:
+        model = MintChannel
+
+    key = "a_searcher"
+    login_url = "https://server/login"
+    mint_url = "https://server/mint"
+    user = "user"
+    password = "password"
+    realm = "realm"
+
+
+class DICOMWebChannelFactory(factory.Factory):
+    class Meta:
+        model = DICOMWebChannel
+
+    key = "a_searcher"
+    dicom_web_url = "https://server/dicomweb"
+    user = "user"
+    password = "password"
@@ -0,0 +1,196 @@
+import threading
+import time
+
+import pytest
+from dicomtrolley.core import Query
+from pydicom.uid import ImplicitVRLittleEndian
+from pynetdicom import AE, evt
+from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind
+
+from dicomtrolleytool.associations import AssociationPool, PooledDICOMQR
+from dicomtrolleytool.channels import DICOMQRChannel
+from dicomtrolleytool.cli.base import TrolleyToolContext
+from dicomtrolleytool.retry import AssociationError, RetryPolicy
+from dicomtrolleytool.wrappers import RetryingSearcher
+from tests.conftest import create_c_find_study_response
+
+
+class QRServer:
+    """Local DICOM QR server that answers each C-FIND with one study and counts
+    associations
+    """
+
+    def __init__(self, find_delay: float = 0.0):
+        self.find_delay = find_delay
+        self.associations = 0
+        self.finds_running = 0
+        self.max_finds_running = 0
+        self._lock = threading.Lock()
+        ae = AE(ae_title="SERVER")
+        ae.add_supported_context(
+            StudyRootQueryRetrieveInformationModelFind, ImplicitVRLittleEndian
+        )
+        self.server = ae.start_server(
+            ("localhost", 0),
+            block=False,
+            evt_handlers=[
+                (evt.EVT_ESTABLISHED, self.on_established),
+                (evt.EVT_C_FIND, self.on_c_find),
+            ],
+        )
+        self.port = self.server.server_address[1]
+
+    def on_established(self, event):
+        with self._lock:
+            self.associations += 1
+
+    def on_c_find(self, event):
+        with self._lock:
+            self.finds_running += 1
+            self.max_finds_running = max(self.max_finds_running, self.finds_running)
+        time.sleep(self.find_delay)
+        with self._lock:
+            self.finds_running -= 1
+        for dataset in create_c_find_study_response(["Study1"]):
+            yield 0xFF00, dataset
+        yield 0x0000, None
+
+    def abort_all(self):
+        for association in self.server.active_associations:
+            association.abort()
+
+    def shutdown(self):
+        self.server.shutdown()
+
+
+@pytest.fixture
+def a_server():
+    server = QRServer()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def a_pool(a_server):
+    pool = AssociationPool("localhost", a_server.port, aet="CLIENT", aec="SERVER")
+    yield pool
+    pool.close()
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        time.sleep(0.01)
+
+
+def test_reuse_association(a_server, a_pool):
+    """Queries after the first run on the same association"""
+    searcher = PooledDICOMQR(a_pool)
+    for _ in range(3):
+        assert [x.uid for x in searcher.find_studies(Query())] == ["Study1"]
+    assert a_server.associations == 1
+    assert a_pool.associations_opened == 1
+
+
+def test_parallel_associations(a_server):
+    """Parallel queries use several associations, never more than max_size"""
+    a_server.find_delay = 0.1
+    pool = AssociationPool(
+        "localhost", a_server.port, aet="CLIENT", aec="SERVER", max_size=2
+    )
+    searcher = PooledDICOMQR(pool)
+    threads = [
+        threading.Thread(target=searcher.find_studies, args=(Query(),))
+        for _ in range(6)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pool.close()
+
+    assert a_server.max_finds_running == 2
+    assert a_server.associations == 2
+
+
+def test_idle_timeout(a_server):
+    """Associations are released after not being used for a while"""
+    pool = AssociationPool(
+        "localhost", a_server.port, aet="CLIENT", aec="SERVER", idle_timeout=0.05
+    )
+    searcher = PooledDICOMQR(pool)
+    searcher.find_studies(Query())
+    wait_for(lambda: not a_server.server.active_associations)
+
+    searcher.find_studies(Query())
+    assert a_server.associations == 2
+    pool.close()
+
+
+def test_reassociate_after_abort(a_server, a_pool):
+    """Associations aborted by the server are replaced"""
+    searcher = PooledDICOMQR(a_pool)
+    searcher.find_studies(Query())
+    a_server.abort_all()
+    wait_for(lambda: not a_server.server.active_associations)
+
+    assert [x.uid for x in searcher.find_studies(Query())] == ["Study1"]
+    assert a_server.associations == 2
+
+
+def test_retry_dropped_association(a_server, a_pool, monkeypatch):
+    """A reused association that fails without notice is retried on a new one"""
+    searcher = PooledDICOMQR(a_pool)
+    searcher.find_studies(Query())
+    original = PooledDICOMQR.c_find
+    calls = []
+
+    def c_find_fails_once(*args):
+        calls.append(args)
+        return None if len(calls) == 1 else original(*args)
+
+    monkeypatch.setattr(PooledDICOMQR, "c_find", staticmethod(c_find_fails_once))
+    assert [x.uid for x in searcher.find_studies(Query())] == ["Study1"]
+    assert a_server.associations == 2
+
+
+def test_association_rejected(a_server):
+    pool = AssociationPool("localhost", a_server.port, aet="CLIENT", aec="SERVER")
+    pool.ae.requested_contexts = []
+    pool.ae.add_requested_context("1.2.3.4")  # not supported by server
+    with pytest.raises(AssociationError):
+        PooledDICOMQR(pool).find_studies(Query())
+    pool.close()
+
+
+def test_association_failure_retried(a_server, a_pool, monkeypatch):
+    """A failed association is retryable, so a retrying searcher tries again"""
+    associate = a_pool._associate
+    failures = []
+
+    def associate_fail_once():
+        if not failures:
+            failures.append(1)
+            raise AssociationError("rejected, aborted or never connected")
+        return associate()
+
+    monkeypatch.setattr(a_pool, "_associate", associate_fail_once)
+    searcher = RetryingSearcher(
+        PooledDICOMQR(a_pool), RetryPolicy(max_attempts=3, backoff=0)
+    )
+    assert [x.uid for x in searcher.find_studies(Query())] == ["Study1"]
+    assert failures == [1]
+
+
+def test_context_shares_pool():
+    """Searchers for a channel share one pool. Only if the channel asks for it"""
+    channel = DICOMQRChannel(key="pacs", host="localhost", port="104", aet="A", aec="B")
+    context = TrolleyToolContext()
+    assert context.get_association_pool(channel) is None
+
+    channel.reuse_associations = True
+    pool = context.get_association_pool(channel)
+    assert context.get_association_pool(channel) is pool
+    assert context.fork().get_association_pool(channel) is pool
+    assert isinstance(channel.init_searcher(pool=pool), PooledDICOMQR)
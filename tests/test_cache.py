@@ -0,0 +1,126 @@
+from unittest.mock import Mock
+
+from dicomtrolley.dicom_qr import DICOMQR
+
+import pytest
+from dicomtrolley.core import Query, Searcher
+
+from dicomtrolleytool.cache import CachedSearcher, QueryCache, iter_cached_results
+from dicomtrolleytool.federation import UNANSWERED_ELEMENT, add_channels
+from dicomtrolleytool.query import QueryPlanner, iter_query_results
+from tests.conftest import create_c_find_study_response
+
+
+@pytest.fixture
+def a_cache(tmp_path):
+    return QueryCache(path=tmp_path / "cache.sqlite")
+
+
+def test_cache_put_get(a_cache, an_image_level_study):
+    assert a_cache.get("key1") is None
+    a_cache.put("key1", an_image_level_study)
+
+    loaded = a_cache.get("key1")
+    assert loaded[0].uid == an_image_level_study[0].uid
+    assert len(loaded[0].all_instances()) == 18
+
+    stats = a_cache.stats()
+    assert stats.entries == 1
+    assert stats.hits == 1
+    assert stats.misses == 1
+
+
+def test_cache_max_age(a_cache, an_image_level_study):
+    a_cache.put("key1", an_image_level_study)
+    assert a_cache.get("key1", max_age=0) is None
+    assert a_cache.get("key1", max_age=100)
+
+
+def test_cache_lru_eviction(tmp_path, an_image_level_study, a_study_level_study):
+    """When full, least recently accessed entries should go first"""
+    cache = QueryCache(path=tmp_path / "cache.sqlite")
+    cache.put("key1", a_study_level_study)
+    cache.put("key2", a_study_level_study)
+    cache.get("key1")  # key2 is now least recently used
+    cache.max_size = cache.stats().size + 1  # room for not much more
+    cache.put("key3", a_study_level_study)
+
+    assert cache.get("key1")
+    assert cache.get("key2") is None
+    assert cache.get("key3")
+
+
+def test_cache_clear(a_cache, a_study_level_study):
+    a_cache.put("key1", a_study_level_study)
+    a_cache.clear()
+    assert a_cache.stats().entries == 0
+
+
+def test_cached_searcher(a_cache, a_study_level_study):
+    """Second identical query should not reach server"""
+    searcher = Mock(spec=Searcher)
+    searcher.find_studies = Mock(return_value=a_study_level_study)
+    cached = CachedSearcher(searcher, cache=a_cache, channel_key="channel1")
+
+    cached.find_study(Query(AccessionNumber="1", include_fields=["Modality"]))
+    study = cached.find_study(Query(AccessionNumber="1", include_fields=["Modality"]))
+    assert study.uid == a_study_level_study[0].uid
+    assert searcher.find_studies.call_count == 1
+
+    # results from another channel are cached separately
+    CachedSearcher(searcher, cache=a_cache, channel_key="channel2").find_study(
+        Query(AccessionNumber="1", include_fields=["Modality"])
+    )
+    assert searcher.find_studies.call_count == 2
+
+
+def test_iter_cached_results(a_cache):
+    """Queries are looked up before they are combined into batches, so changing
+    the list of queries, and with it the batches, still hits the cache
+    """
+    trolley = Mock()
+    trolley.find_studies = Mock(
+        side_effect=lambda query: DICOMQR.parse_c_find_response(
+            create_c_find_study_response(query.StudyInstanceUID.split(","))
+        )
+    )
+    planner = QueryPlanner(batch_fields=["StudyInstanceUID"], max_batch_size=10)
+
+    def run(uids):
+        return list(
+            iter_cached_results(
+                a_cache,
+                (Query(StudyInstanceUID=x) for x in uids),
+                run_queries=lambda x: iter_query_results(trolley, x, planner=planner),
+                channel_key="channel1",
+            )
+        )
+
+    run(["1", "2", "3"])
+    results = run(["0", "1", "2", "3", "4"])
+    assert [x.content.uid for x in results] == ["0", "1", "2", "3", "4"]
+    batched = trolley.find_studies.call_args_list[-1].args[0]
+    assert batched.StudyInstanceUID == "0,4"  # only the misses
+
+
+def test_iter_cached_results_partial(a_cache, a_study_level_study):
+    """Federated results missing a channel are not cached, so that next time the
+    channel is asked again
+    """
+    add_channels(a_study_level_study[0], UNANSWERED_ELEMENT, ["pacs"])
+    trolley = Mock()
+    trolley.find_study = Mock(return_value=a_study_level_study[0])
+
+    def run():
+        return list(
+            iter_cached_results(
+                a_cache,
+                [Query(AccessionNumber="1")],
+                run_queries=lambda x: iter_query_results(trolley, x),
+                channel_key="federated",
+            )
+        )
+
+    run()
+    run()
+    assert trolley.find_study.call_count == 2
@@ -1,6 +1,26 @@
+from unittest.mock import Mock
+
 import pytest as pytest
-from dicomtrolleytool.channels import MintChannel
+from dicomtrolley.core import Query
+from requests import Response
+from requests.adapters import HTTPAdapter
+
+from dicomtrolleytool.channels import (
+    DICOMQRChannel,
+    HTTPTransport,
+    MintChannel,
+    Rad69Channel,
+    ReplicatedChannel,
+    Throttle,
+    VitreaChannel,
+)
+from dicomtrolleytool.cli.base import TrolleyToolContext
+from dicomtrolleytool.hedging import HedgedDownloader, HedgedSearcher
 from dicomtrolleytool.persistence import MemoryStorage
+from dicomtrolleytool.profiling import Profiler, profile_session
+from dicomtrolleytool.retry import RetryPolicy
+from dicomtrolleytool.sessions import TrackingVitreaAuth, TransportAdapter
+from tests.factories import DICOMWebChannelFactory, TrolleyToolSettingsFactory
 
 
 @pytest.fixture
@@ -25,3 +45,222 @@ def test_write_to_storage(a_mint_connection):
         == a_mint_connection.password.get_secret_value()
     )
     assert loaded.json() == a_mint_connection.json()
+
+
+def test_context_session_cache(a_mint_connection, tmp_path):
+    """Sessions created through context should be stored for the next command"""
+    settings = TrolleyToolSettingsFactory(session_cache_path=tmp_path / "s.json")
+    context = TrolleyToolContext(settings=settings)
+    session = context.get_session(a_mint_connection)
+    assert isinstance(session.auth, TrackingVitreaAuth)
+
+    session.cookies.set("JSESSIONID", "an_id")
+    context.close()
+
+    next_context = TrolleyToolContext(settings=settings)
+    assert next_context.get_session(a_mint_connection).cookies.get("JSESSIONID")
+
+
+@pytest.mark.parametrize(
+    "a_channel",
+    [
+        Rad69Channel(
+            key="rad69",
+            login_url="https://server/login",
+            rad69_url="https://server/rad69",
+            user="user",
+            password="password",
+            realm="realm",
+        ),
+        DICOMWebChannelFactory(),
+    ],
+)
+def test_download_settings(a_channel):
+    """Download tuning settings should end up in the downloader"""
+    context = TrolleyToolContext(
+        settings=TrolleyToolSettingsFactory(
+            http_chunk_size=1024, request_per_series=False, session_cache=False
+        ),
+        downloader_channel=a_channel,
+    )
+    downloader = context.create_downloader()
+    assert downloader.http_chunk_size == 1024
+    assert not downloader.request_per_series
+
+    context.override_settings(http_chunk_size=2048, request_per_series=None)
+    downloader = context.create_downloader()
+    assert downloader.http_chunk_size == 2048
+    assert not downloader.request_per_series
+
+
+def test_transport_settings(a_mint_connection):
+    """Pool size, keep-alive, compression and timeouts should end up in session"""
+    a_mint_connection.transport = HTTPTransport(
+        pool_maxsize=32, keep_alive=False, compression=False, read_timeout=None
+    )
+    session = a_mint_connection.get_session()
+    adapter = session.get_adapter("https://server")
+    assert isinstance(adapter, TransportAdapter)
+    assert adapter._pool_maxsize == 32
+    assert adapter.timeout == (10, None)
+    assert session.headers["Connection"] == "close"
+    assert session.headers["Accept-Encoding"] == "identity"
+
+    default_session = DICOMWebChannelFactory().get_session()
+    assert "gzip" in default_session.headers["Accept-Encoding"]
+    assert default_session.headers["Connection"] == "keep-alive"
+
+
+def test_transport_timeout(monkeypatch):
+    """Timeout applies only when the caller does not set one. Also when profiling"""
+    response = Response()
+    response.status_code = 200
+    send = Mock(return_value=response)
+    monkeypatch.setattr(HTTPAdapter, "send", send)
+    session = DICOMWebChannelFactory(
+        transport=HTTPTransport(connect_timeout=1, read_timeout=2)
+    ).get_session()
+    profile_session(session, Profiler())
+
+    session.get("https://server/dicomweb/studies")
+    assert send.call_args[1]["timeout"] == (1, 2)
+    session.get("https://server/dicomweb/studies", timeout=5)
+    assert send.call_args[1]["timeout"] == 5
+
+
+def test_context_shares_session():
+    """Searcher and downloader on the same channel should share one session"""
+    channel = DICOMWebChannelFactory()
+    context = TrolleyToolContext(
+        settings=TrolleyToolSettingsFactory(session_cache=False),
+        searcher_channel=channel,
+        downloader_channel=channel,
+    )
+    assert context.get_session(channel) is context.get_session(channel)
+    assert context.create_searcher().searcher.session is (
+        context.create_downloader().session
+    )
+
+
+def test_context_concurrency_per_purpose():
+    """Searches and downloads on a channel should not share a concurrency limit,
+    as slow downloads would lower it for queries
+    """
+    channel = DICOMWebChannelFactory(
+        throttle=Throttle(adaptive_concurrency=True, download_latency_tolerance=5.0),
+        retry=RetryPolicy(max_attempts=1),  # no retrying wrapper around searcher
+    )
+    context = TrolleyToolContext(
+        settings=TrolleyToolSettingsFactory(session_cache=False),
+        searcher_channel=channel,
+        downloader_channel=channel,
+    )
+    search_limit = context.create_searcher().concurrency
+    download_limit = context.create_downloader().concurrency
+    assert search_limit is not download_limit
+    assert search_limit is context.create_searcher().concurrency
+    assert search_limit.max_limit == channel.max_parallel_queries
+    assert search_limit.latency_tolerance == 2.0
+    assert download_limit.max_limit is None
+    assert download_limit.latency_tolerance == 5.0
+
+
+def test_context_shares_session_between_channels(a_mint_connection):
+    """Different channels on the same server and credentials share a session"""
+    rad69 = Rad69Channel(
+        key="rad69",
+        login_url="login_url",
+        rad69_url="rad69_url",
+        user="user",
+        password="specialpass",
+        realm="realm",
+    )
+    context = TrolleyToolContext(
+        settings=TrolleyToolSettingsFactory(session_cache=False)
+    )
+    assert context.get_session(a_mint_connection) is context.get_session(rad69)
+
+    rad69.user = "other_user"
+    assert context.get_session(a_mint_connection) is not context.get_session(rad69)
+
+
+def test_context_loads_channel_once():
+    """A channel used as both searcher and downloader is loaded once"""
+    storage = MemoryStorage()
+    storage.save_channel("dicomweb", DICOMWebChannelFactory(key="dicomweb"))
+    storage.load_channel = Mock(wraps=storage.load_channel)
+    context = TrolleyToolContext(
+        settings=TrolleyToolSettingsFactory(
+            searcher_name="dicomweb", downloader_name="dicomweb"
+        ),
+        storage=storage,
+    )
+    assert context.searcher_channel is context.downloader_channel
+    storage.load_channel.assert_called_once_with("dicomweb")
+
+
+def test_vitrea_channel():
+    """Combined channel searches with MINT and downloads with rad69"""
+    channel = VitreaChannel(
+        key="vitrea",
+        login_url="https://server/login",
+        mint_url="https://server/mint",
+        rad69_url="https://server/rad69",
+        user="user",
+        password="password",
+        realm="realm",
+    )
+    storage = MemoryStorage()
+    storage.save_channel("vitrea", channel)
+    assert storage.load_channel("vitrea") == channel
+
+    context = TrolleyToolContext(
+        settings=TrolleyToolSettingsFactory(session_cache=False),
+        searcher_channel=channel,
+        downloader_channel=channel,
+    )
+    assert context.create_searcher().searcher.session is (
+        context.create_downloader().session
+    )
+
+
+def test_replicated_channel():
+    """Replicated channel searches and downloads with each of its replicas. Latency
+    scores are kept per channel
+    """
+    storage = MemoryStorage()
+    for name in ("node1", "node2"):
+        storage.save_channel(
+            name,
+            DICOMWebChannelFactory(key=name, dicom_web_url=f"https://{name}/dicomweb"),
+        )
+    channel = ReplicatedChannel(key="mirrored", replicas=["node1", "node2"])
+    storage.save_channel("mirrored", channel)
+    assert storage.load_channel("mirrored") == channel
+
+    context = TrolleyToolContext(
+        settings=TrolleyToolSettingsFactory(
+            searcher_name="mirrored", downloader_name="mirrored", session_cache=False
+        ),
+        storage=storage,
+    )
+    searcher = context.create_searcher()
+    assert isinstance(searcher, HedgedSearcher)
+    assert list(searcher.replicas) == ["node1", "node2"]
+    assert isinstance(context.create_downloader(), HedgedDownloader)
+    assert context.create_searcher().hedger is searcher.hedger
+
+
+@pytest.mark.parametrize(
+    "query_level, expected_batches", [("STUDY", 1), ("SERIES", 3), ("INSTANCE", 3)]
+)
+def test_dicom_qr_query_planner(query_level, expected_batches):
+    """Below study level, StudyInstanceUID is a unique key above the query level.
+    It must hold a single value, so queries are not combined there
+    """
+    channel = DICOMQRChannel(key="pacs", host="localhost", port="104", aet="A", aec="B")
+    queries = [
+        Query(StudyInstanceUID=f"1.2.{i}", query_level=query_level) for i in range(3)
+    ]
+    batches = list(channel.get_query_planner().plan(queries))
+    assert len(batches) == expected_batches
@@ -1,5 +1,16 @@
+import json
+from unittest.mock import Mock
+
+import pytest
+from dicomtrolley.core import Query, Searcher
+
+from dicomtrolleytool.channels import SearcherChannel, Throttle
 from dicomtrolleytool.cli.entrypoint import main
-from dicomtrolleytool.cli.base import status
+from dicomtrolleytool.cli.base import TrolleyToolContext, status
+from dicomtrolleytool.persistence import Storage
+from dicomtrolleytool.retry import RetryPolicy
+from tests.conftest import MockContextCliRunner
+from tests.factories import TrolleyToolSettingsFactory
 
 
 def test_cli_base(context_runner):
@@ -11,3 +22,66 @@ def test_cli_status(context_runner):
     """Just invoking root cli command should not crash"""
     result = context_runner.invoke(status, catch_exceptions=False)
     assert "Settings file" in result.output
+
+
+@pytest.fixture
+def a_lazy_context(an_image_level_study):
+    """A context that will load a mocked searcher channel from mock storage"""
+    storage = Mock(spec=Storage)
+    searcher = Mock(spec=Searcher)
+    searcher.find_study = Mock(return_value=an_image_level_study[0])
+    storage.load_channel = Mock(
+        return_value=Mock(
+            spec=SearcherChannel,
+            init_searcher=lambda: searcher,
+            retry=RetryPolicy(max_attempts=1),  # no retrying wrapper around searcher
+            throttle=Throttle(),
+        )
+    )
+    return TrolleyToolContext(settings=TrolleyToolSettingsFactory(), storage=storage)
+
+
+def test_cli_channel_list_lazy(a_lazy_context):
+    """Commands that do not search or download should not touch storage"""
+    runner = MockContextCliRunner(mock_context=a_lazy_context)
+    result = runner.invoke(main, ["channel", "list"], catch_exceptions=False)
+    assert result.exit_code == 0
+    result = runner.invoke(main, ["status"], catch_exceptions=False)
+    assert result.exit_code == 0
+    a_lazy_context.storage.load_channel.assert_not_called()
+
+
+def test_context_lazy_trolley(a_lazy_context):
+    """Searcher should be created on first search, and only once"""
+    trolley = a_lazy_context.trolley
+    a_lazy_context.storage.load_channel.assert_not_called()
+
+    trolley.find_study(Query(AccessionNumber="1"))
+    trolley.find_study(Query(AccessionNumber="2"))
+    a_lazy_context.storage.load_channel.assert_called_once_with("a_searcher")
+
+
+def test_cli_profile(a_lazy_context, an_image_level_study, tmp_path):
+    """--profile prints a summary and can write a trace file"""
+    channel = a_lazy_context.storage.load_channel()
+    channel.get_query_planner = Mock(return_value=None)
+    channel.init_searcher().find_studies = Mock(return_value=an_image_level_study)
+    runner = MockContextCliRunner(mock_context=a_lazy_context)
+    trace_file = tmp_path / "trace.json"
+    result = runner.invoke(
+        main,
+        [
+            "--profile-output",
+            str(trace_file),
+            "--profile-format",
+            "trace",
+            "query",
+            "acc",
+            "1",
+        ],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    assert "p95 ms" in result.output
+    events = json.loads(trace_file.read_text())["traceEvents"]
+    assert {x["cat"] for x in events} == {"query", "format"}
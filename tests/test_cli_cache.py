@@ -0,0 +1,13 @@
+from dicomtrolleytool.cli.cache import clear, stats
+from tests.factories import TrolleyToolSettingsFactory
+
+
+def test_cli_cache_stats_clear(context_runner, tmp_path):
+    context_runner.mock_context.settings = TrolleyToolSettingsFactory(
+        query_cache_path=tmp_path / "cache.sqlite"
+    )
+    result = context_runner.invoke(stats, catch_exceptions=False)
+    assert "entries : 0" in result.output
+
+    result = context_runner.invoke(clear, catch_exceptions=False)
+    assert result.exit_code == 0
@@ -1,7 +1,53 @@
-from dicomtrolleytool.cli.download import download_suid
+from unittest.mock import Mock
+
+from dicomtrolleytool.cli.download import (
+    DEFAULT_JOURNAL_NAME,
+    download,
+    download_batch,
+    download_suid,
+)
+from dicomtrolleytool.journal import DownloadJournal
 
 
 def test_cli_download(context_runner):
     """Just invoking root cli command should not crash"""
     result = context_runner.invoke(download_suid, args=["123"], catch_exceptions=False)
     assert result.exit_code == 0
+
+
+def test_cli_download_input_file(context_runner, tmp_path):
+    """Studies from file should be looked up and downloaded in chunks"""
+    input_file = tmp_path / "suids.txt"
+    input_file.write_text("1\n2\n3\n")
+    result = context_runner.invoke(
+        download_suid,
+        args=["--input-file", str(input_file), "--chunk-size", "2"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    trolley = context_runner.mock_context.trolley
+    assert trolley.find_study.call_count == 3
+    assert trolley.download.call_count == 2
+
+
+def test_cli_download_batch(context_runner, tmp_path):
+    """Batch download should report and keep a journal in output dir"""
+    context_runner.mock_context.trolley.fetch_all_datasets = Mock(return_value=[])
+    result = context_runner.invoke(
+        download_batch,
+        args=["1", "2", "--output-dir", str(tmp_path)],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    journal = DownloadJournal(tmp_path / DEFAULT_JOURNAL_NAME)
+    assert journal.finished_studies == {"Study2"}  # mock returns same study twice
+
+
+def test_cli_download_overrides(context_runner):
+    """Download options should override settings for this command only"""
+    result = context_runner.invoke(
+        download, args=["--http-chunk-size", "1024", "suid", "1"]
+    )
+    assert result.exit_code == 0
+    assert context_runner.mock_context.settings.http_chunk_size == 1024
+    assert context_runner.mock_context.settings.request_per_series
@@ -0,0 +1,90 @@
+import json
+from datetime import date
+from io import StringIO
+
+import pytest
+from pydicom.dataelem import DataElement
+
+from dicomtrolleytool.cli.export import (
+    typed_value,
+    write_query_results_arrow,
+    write_query_results_jsonl,
+)
+from dicomtrolleytool.cli.output import FormatLevel, ResultFormat
+from dicomtrolleytool.federation import add_source_channel
+
+
+@pytest.mark.parametrize(
+    "element, expected",
+    [
+        (DataElement("StudyDate", "DA", "20230102"), date(2023, 1, 2)),
+        (DataElement("StudyDate", "DA", ""), None),
+        (DataElement("StudyDate", "DA", "not a date"), None),
+        (DataElement("NumberOfStudyRelatedInstances", "IS", "12"), 12),
+        (DataElement("SliceThickness", "DS", "1.5"), 1.5),
+        (DataElement("Rows", "US", 512), 512),
+        (DataElement("ModalitiesInStudy", "CS", "CT"), ["CT"]),
+        (DataElement("ModalitiesInStudy", "CS", ["CT", "MR"]), ["CT", "MR"]),
+        (DataElement("ModalitiesInStudy", "CS", ""), []),
+        (DataElement("PatientID", "LO", "123"), "123"),
+    ],
+)
+def test_typed_value(element, expected):
+    assert typed_value(element) == expected
+
+
+def test_write_query_results_jsonl(some_query_results):
+    stream = StringIO()
+    write_query_results_jsonl(
+        iter(some_query_results), stream, format_level=FormatLevel.INSTANCE
+    )
+    records = [json.loads(x) for x in stream.getvalue().splitlines()]
+    assert len(records) == 54
+    assert records[0]["SeriesInstanceUID"] == "Series1"
+
+    stream = StringIO()
+    write_query_results_jsonl(
+        iter(some_query_results), stream, fields=["SOPInstanceUID"]
+    )
+    assert json.loads(stream.getvalue().splitlines()[0]) == {
+        "SOPInstanceUID": "Instance1"
+    }
+
+
+@pytest.mark.parametrize("output_format", [ResultFormat.ARROW, ResultFormat.PARQUET])
+def test_write_query_results_arrow(some_query_results, tmp_path, output_format):
+    """Rows are written in batches, columns have DICOM types"""
+    pa = pytest.importorskip("pyarrow")
+    path = tmp_path / "results"
+    write_query_results_arrow(
+        iter(some_query_results),
+        path=path,
+        fields=["SOPInstanceUID", "StudyDate", "ModalitiesInStudy"],
+        output_format=output_format,
+        batch_size=10,
+    )
+    if output_format == ResultFormat.PARQUET:
+        table = pytest.importorskip("pyarrow.parquet").read_table(path)
+    else:
+        table = pytest.importorskip("pyarrow.ipc").open_file(path).read_all()
+    assert table.num_rows == 54
+    assert table.schema.field("StudyDate").type == pa.date32()
+    assert table.schema.field("ModalitiesInStudy").type == pa.list_(pa.string())
+
+
+def test_write_query_results_arrow_source_channel(some_query_results, tmp_path):
+    """Channels of a federated search should be a list column"""
+    pa = pytest.importorskip("pyarrow")
+    for result in some_query_results:
+        add_source_channel(result.content, "vna")
+    path = tmp_path / "results"
+    write_query_results_arrow(
+        iter(some_query_results),
+        path=path,
+        fields=["StudyInstanceUID", "SourceChannel"],
+        output_format=ResultFormat.ARROW,
+        format_level=FormatLevel.STUDY,
+    )
+    table = pytest.importorskip("pyarrow.ipc").open_file(path).read_all()
+    assert table.schema.field("SourceChannel").type == pa.list_(pa.string())
+    assert table.column("SourceChannel").to_pylist() == [["vna"]] * 3
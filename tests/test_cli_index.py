@@ -0,0 +1,50 @@
+from datetime import date
+from unittest.mock import Mock
+
+from dicomtrolley.core import Searcher
+from dicomtrolley.dicom_qr import DICOMQR
+from dicomtrolley.trolley import Trolley
+
+from dicomtrolleytool.cli.index import clear, stats, sync
+from dicomtrolleytool.cli.query import query_accession_number
+from tests.conftest import quick_dataset
+from tests.factories import TrolleyToolSettingsFactory
+
+
+def test_cli_index_sync_and_local_query(context_runner, tmp_path):
+    """Synced studies can be queried with --local without contacting server"""
+    context = context_runner.mock_context
+    context.settings = TrolleyToolSettingsFactory(
+        metadata_index_path=tmp_path / "index.sqlite"
+    )
+    searcher = Mock(spec=Searcher)
+    searcher.find_studies = Mock(
+        return_value=DICOMQR.parse_c_find_response(
+            [quick_dataset(StudyInstanceUID="Study1", AccessionNumber="acc1")]
+        )
+    )
+    context.create_searcher = Mock(return_value=searcher)
+    context.trolley = Trolley(searcher=searcher, downloader=Mock())
+
+    result = context_runner.invoke(sync)
+    assert result.exit_code == 2  # never synced, needs --since
+
+    result = context_runner.invoke(
+        sync, args=["--since", date.today().isoformat()], catch_exceptions=False
+    )
+    assert "Indexed 1 studies" in result.output
+    assert searcher.find_studies.call_count == 1
+
+    result = context_runner.invoke(
+        query_accession_number,
+        args=["acc1", "--local", "--output-format", "JSONL"],
+        catch_exceptions=False,
+    )
+    assert '"StudyInstanceUID": "Study1"' in result.output
+    assert searcher.find_studies.call_count == 1  # answered locally
+
+    result = context_runner.invoke(stats, catch_exceptions=False)
+    assert "studies  : 1" in result.output
+
+    result = context_runner.invoke(clear, catch_exceptions=False)
+    assert result.exit_code == 0
@@ -1,13 +1,21 @@
+from io import StringIO
+
 import pytest
 from dicomtrolley.core import Query
 from dicomtrolley.exceptions import DICOMTrolleyError
 
 from dicomtrolleytool.cli.output import (
+    ColumnTable,
     FormatLevel,
     ResultFormat,
     format_query_results,
+    format_query_results_csv,
     format_query_results_table,
+    query_results_to_table,
+    write_query_results,
+    write_query_results_csv,
 )
+from dicomtrolleytool.federation import add_source_channel
 from dicomtrolleytool.query import QueryErrorResult
 
 
@@ -39,3 +47,132 @@ def test_format_query_results_table(some_query_results_with_error):
     )
 
     assert table_text
+
+
+def test_write_query_results_raw(some_query_results_with_error):
+    """Streaming raw output should be the same as formatting in one go"""
+    stream = StringIO()
+    write_query_results(
+        iter(some_query_results_with_error), stream, output_format=ResultFormat.RAW
+    )
+    assert stream.getvalue() == (
+        format_query_results(
+            some_query_results_with_error, output_format=ResultFormat.RAW
+        )
+        + "\n"
+    )
+
+
+def test_write_query_results_table(some_query_results_with_error):
+    """Non-streaming formats should accept a generator as well"""
+    stream = StringIO()
+    write_query_results(
+        iter(some_query_results_with_error), stream, output_format=ResultFormat.TABLE
+    )
+    assert "Instance1" in stream.getvalue()
+
+
+def test_format_query_results_csv(some_query_results_with_error):
+    """Without a field filter, columns are discovered from results"""
+    text = format_query_results_csv(some_query_results_with_error)
+    lines = text.split("\n")
+    assert len(lines) == 55  # header and 54 instances
+    assert "SOPInstanceUID" in lines[0]
+
+    text = format_query_results_csv(
+        some_query_results_with_error, output_field_filter=["SeriesInstanceUID"]
+    )
+    assert text.split("\n")[:2] == ["SeriesInstanceUID", "Series1"]
+
+
+@pytest.mark.parametrize(
+    "format_level, expected_lines",
+    [(FormatLevel.STUDY, 4), (FormatLevel.SERIES, 7), (FormatLevel.INSTANCE, 55)],
+)
+def test_write_query_results_csv(
+    some_query_results_with_error, format_level, expected_lines
+):
+    """Columns are fixed up front, missing values are empty"""
+    stream = StringIO()
+    write_query_results_csv(
+        iter(some_query_results_with_error),
+        stream,
+        fields=["StudyInstanceUID", "PatientID"],
+        format_level=format_level,
+    )
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == expected_lines
+    assert lines[0] == "StudyInstanceUID,PatientID"
+    if format_level != FormatLevel.SERIES:  # fixture has no series level data
+        assert lines[1] == "Study1,"
+
+
+def test_write_query_results_csv_streams(some_query_results):
+    """Each result should be written before the next one is read"""
+    stream = StringIO()
+
+    def results():
+        for result in some_query_results:
+            yield result
+            assert stream.getvalue().count("\n") > 1
+
+    write_query_results(
+        results(),
+        stream,
+        output_format=ResultFormat.CSV,
+        include_fields=["SOPInstanceUID"],
+    )
+    assert stream.getvalue().count("\n") == 55
+
+
+def test_column_table():
+    """Missing values should be empty, later values should win"""
+    table = ColumnTable()
+    table.add_row({"a": 1, "b": 2})
+    table.add_row({"b": 3}, {"c": 4})
+    table.add_row({"a": 5}, {"a": 6})
+    assert table.to_dict() == {"a": [1, "", 6], "b": [2, 3, ""], "c": ["", 4, ""]}
+
+    table = ColumnTable(fields=["c", "a"])
+    table.add_row({"a": 1, "b": 2})
+    table.add_row({"c": 3})
+    assert table.to_dict() == {"c": ["", 3], "a": [1, ""]}
+
+
+@pytest.mark.parametrize(
+    "format_level, row_count",
+    [(FormatLevel.STUDY, 3), (FormatLevel.SERIES, 6), (FormatLevel.INSTANCE, 54)],
+)
+def test_query_results_to_table(some_query_results, format_level, row_count):
+    """One row per object at format level, with higher level values repeated"""
+    table = query_results_to_table(some_query_results, format_level=format_level)
+    assert all(len(x) == row_count for x in table.values())
+    if format_level == FormatLevel.STUDY:
+        assert table["StudyInstanceUID"] == ["Study1"] * 3
+
+    table = query_results_to_table(
+        some_query_results,
+        output_field_filter=["SeriesInstanceUID"],
+        format_level=format_level,
+    )
+    assert list(table) == (
+        ["SeriesInstanceUID"] if format_level == FormatLevel.INSTANCE else []
+    )
+
+
+def test_query_results_to_table_source_channel(some_query_results):
+    """Channels a study was found on are a named column, not an unnamed private
+    element
+    """
+    for result in some_query_results:
+        add_source_channel(result.content, "vna")
+    table = query_results_to_table(some_query_results, format_level=FormatLevel.STUDY)
+    assert "" not in table
+    assert table["SourceChannel"] == [["vna"]] * 3
+
+    table = query_results_to_table(
+        some_query_results,
+        output_field_filter=["SourceChannel"],
+        format_level=FormatLevel.SERIES,
+    )
+    assert table == {"SourceChannel": [["vna"]] * 6}
@@ -1,8 +1,19 @@
+import json
 from unittest.mock import Mock
 
 import pytest
+from dicomtrolley.core import Searcher
+from dicomtrolley.trolley import Trolley
 
+from dicomtrolleytool.cli.job import job
 from dicomtrolleytool.cli.query import query_accession_number, query_suid
+from dicomtrolleytool.cli.base import TrolleyToolContext
+from tests.conftest import MockContextCliRunner
+from tests.factories import (
+    DICOMWebChannelFactory,
+    MintChannelFactory,
+    TrolleyToolSettingsFactory,
+)
 
 
 def test_basic_query_suid(context_runner):
@@ -78,3 +89,235 @@ def test_query_include_fields_errors(context_runner_with_image, include_fields_v
             args=["123", "--include-fields", include_fields_value],
             catch_exceptions=False,
         )
+
+
+def test_query_parallel(context_runner_with_image):
+    """Parallel queries should be capped by the searcher channel maximum"""
+    context_runner_with_image.mock_context.searcher_channel = MintChannelFactory(
+        max_parallel_queries=2
+    )
+    assert context_runner_with_image.mock_context.max_parallel_queries(10) == 2
+    result = context_runner_with_image.invoke(
+        query_accession_number,
+        args=["1", "2", "3", "--parallel", "10"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    assert context_runner_with_image.mock_context.trolley.find_study.call_count == 3
+
+
+def test_query_cache(context_runner_with_image, an_image_level_study, tmp_path):
+    """With --cache, repeated queries should be answered from cache"""
+    context = context_runner_with_image.mock_context
+    context.settings = TrolleyToolSettingsFactory(
+        query_cache_path=tmp_path / "cache.sqlite"
+    )
+    searcher = Mock(spec=Searcher)
+    searcher.find_study = Mock(return_value=an_image_level_study[0])
+    for _ in range(2):
+        context.trolley = Trolley(searcher=searcher, downloader=Mock())
+        result = context_runner_with_image.invoke(
+            query_accession_number, args=["123", "--cache"], catch_exceptions=False
+        )
+        assert result.exit_code == 0
+    assert searcher.find_study.call_count == 1
+
+
+def test_query_expand(context_runner, an_image_level_study):
+    """With --expand, a query runs as study, series and instance sub-queries"""
+    context = context_runner.mock_context
+    context.searcher_channel = MintChannelFactory(max_parallel_queries=2)
+    searcher = Mock(spec=Searcher)
+    searcher.find_studies = Mock(return_value=an_image_level_study)
+    context.trolley = Trolley(searcher=searcher, downloader=Mock())
+    result = context_runner.invoke(
+        query_accession_number,
+        args=["123", "--query-level", "INSTANCE", "--expand"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    levels = [x[0][0].query_level for x in searcher.find_studies.call_args_list]
+    assert levels[:2] == ["STUDY", "SERIES"]
+    assert set(levels[2:]) == {"INSTANCE"}
+
+
+def test_query_input_file(context_runner_with_image):
+    """Identifiers can be read from stdin, in addition to arguments"""
+    result = context_runner_with_image.invoke(
+        query_accession_number,
+        args=["1", "--input-file", "-", "--column", "acc"],
+        input="acc,other\n2,a\n3,b\n",
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    find_study = context_runner_with_image.mock_context.trolley.find_study
+    assert [x.args[0].AccessionNumber for x in find_study.call_args_list] == [
+        "1",
+        "2",
+        "3",
+    ]
+
+
+def test_query_batch_size(context_runner, a_study_level_study):
+    """Lookups should be combined into one query if the channel supports it"""
+    context = context_runner.mock_context
+    context.searcher_channel = DICOMWebChannelFactory(batch_accession_numbers=True)
+    study = a_study_level_study[0]
+    study.data.AccessionNumber = "2"
+    context.trolley.find_studies = Mock(return_value=[study])
+
+    result = context_runner.invoke(
+        query_accession_number, args=["1", "2", "3"], catch_exceptions=False
+    )
+    assert result.exit_code == 0
+    batched = context.trolley.find_studies.call_args_list[0].args[0]
+    assert batched.AccessionNumber == "1,2,3"
+    assert f"Study: {study.uid}" in result.output
+
+    # with batch size 1, each lookup is sent separately
+    context.trolley.find_study.reset_mock()
+    context_runner.invoke(
+        query_accession_number,
+        args=["1", "2", "3", "--batch-size", "1"],
+        catch_exceptions=False,
+    )
+    assert context.trolley.find_study.call_count == 3
+
+    # combining accession numbers is not standard. Only if the channel allows it
+    context.searcher_channel = DICOMWebChannelFactory()
+    context.trolley.find_study.reset_mock()
+    context_runner.invoke(
+        query_accession_number, args=["1", "2", "3"], catch_exceptions=False
+    )
+    assert context.trolley.find_study.call_count == 3
+
+
+def test_query_output_file(context_runner_with_image, tmp_path):
+    """Binary formats need an output file. Text formats can use one"""
+    result = context_runner_with_image.invoke(
+        query_accession_number, args=["123", "--output-format", "PARQUET"]
+    )
+    assert result.exit_code == 2
+    assert "--output-file" in result.output
+
+    output_file = tmp_path / "out.jsonl"
+    result = context_runner_with_image.invoke(
+        query_accession_number,
+        args=["123", "--output-format", "jsonl", "--output-file", str(output_file)],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    assert len(output_file.read_text().splitlines()) == 1
+
+
+def test_query_resume(context_runner_with_image):
+    """Queries from a file are checkpointed. Resuming skips finished queries"""
+    context = context_runner_with_image.mock_context
+    find_study = context.trolley.find_study
+    result = context_runner_with_image.invoke(
+        query_accession_number,
+        args=["--input-file", "-"],
+        input="1\n2\n",
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    (path,) = context.query_jobs_path.glob("*.jsonl")
+    assert find_study.call_count == 2
+
+    result = context_runner_with_image.invoke(
+        query_accession_number,
+        args=["--input-file", "-", "--resume", path.stem],
+        input="1\n2\n3\n",
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    assert find_study.call_count == 3  # only the new one
+    assert result.output.count("Study: ") == 3
+
+    result = context_runner_with_image.invoke(
+        query_accession_number, args=["1", "--resume", "unknown"]
+    )
+    assert result.exit_code == 2
+
+    result = context_runner_with_image.invoke(job, args=["list"])
+    assert path.stem in result.output
+    context_runner_with_image.invoke(job, args=["delete", path.stem])
+    assert not path.exists()
+
+
+def test_query_channels(an_image_level_study):
+    """With --channels, each query goes to all channels and results are merged"""
+    channels = {
+        "vna": MintChannelFactory(key="vna"),
+        "pacs": DICOMWebChannelFactory(key="pacs"),
+    }
+    searchers = {
+        name: Mock(spec=Searcher, find_studies=Mock(return_value=an_image_level_study))
+        for name in channels
+    }
+    context = TrolleyToolContext(
+        settings=TrolleyToolSettingsFactory(),
+        storage=Mock(load_channel=lambda name: channels[name]),
+    )
+    default_searcher = Mock(spec=Searcher)
+    context.trolley = Trolley(searcher=default_searcher, downloader=Mock())
+    context.create_searcher = lambda channel=None: searchers[channel.key]
+    runner = MockContextCliRunner(mock_context=context)
+
+    result = runner.invoke(
+        query_accession_number,
+        args=["123", "--channels", "vna,pacs", "--batch-size", "10"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    assert "[Source Channel]" in result.output
+    assert "['vna', 'pacs']" in result.output
+    assert searchers["pacs"].find_studies.call_count == 1
+    default_searcher.find_studies.assert_not_called()
+    # executors are kept by context, for the next query and command
+    executors = context.trolley.searcher.executors
+    assert executors["vna"] is context.get_federated_executor(channels["vna"])
+
+    result = runner.invoke(
+        query_accession_number,
+        args=["123", "--channels", "vna,pacs", "--output-format", "CSV"],
+        catch_exceptions=False,
+    )
+    header = result.output.splitlines()[0].split(",")
+    assert "SourceChannel" in header
+    assert "" not in header  # private elements have no keyword
+
+    result = runner.invoke(
+        query_accession_number,
+        args=["123", "--channels", "vna,pacs", "--output-format", "JSONL"]
+        + ["--output-fields", "AccessionNumber,SourceChannel"],
+        catch_exceptions=False,
+    )
+    assert json.loads(result.output.splitlines()[0])["SourceChannel"] == [
+        "vna",
+        "pacs",
+    ]
+
+    result = runner.invoke(query_accession_number, args=["123", "--first-hit"])
+    assert result.exit_code == 2  # only with --channels
+
+
+def test_query_csv_instance_level(context_runner_with_image):
+    """Each CSV row at instance level can be traced to its instance"""
+    result = context_runner_with_image.invoke(
+        query_accession_number,
+        args=["123", "--query-level", "INSTANCE", "--output-format", "CSV"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0
+    header, *rows = result.output.splitlines()
+    assert header.split(",")[:3] == [
+        "StudyInstanceUID",
+        "SeriesInstanceUID",
+        "SOPInstanceUID",
+    ]
+    rows = [x for x in rows if x.startswith("Study1,")]  # skip log lines
+    assert len(rows) == 18
+    identifiers = [tuple(x.split(",")[:3]) for x in rows]
+    assert len(set(identifiers)) == len(rows)
+    assert all(all(x) for x in identifiers)
@@ -0,0 +1,208 @@
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from io import StringIO
+from unittest.mock import Mock
+
+import pytest
+
+from dicomtrolleytool.cli import launcher
+from dicomtrolleytool.cli.base import TrolleyToolContext
+from dicomtrolleytool.cli.serve import run_command
+from dicomtrolleytool.daemon import (
+    NO_DAEMON_ENV,
+    SOCKET_PATH_ENV,
+    DaemonError,
+    TrolleyDaemon,
+    connect,
+    forward,
+    send_request,
+    should_forward,
+)
+from tests.factories import DICOMWebChannelFactory, TrolleyToolSettingsFactory
+
+
+@pytest.mark.parametrize(
+    "argv, expected",
+    [
+        (["query", "acc", "123"], True),
+        (["-v", "download", "acc", "123", "/tmp"], True),
+        (["--profile", "query", "acc", "123"], False),
+        (["serve"], False),
+        (["channel", "new", "mint"], False),
+        (["--help"], False),
+    ],
+)
+def test_should_forward(argv, expected):
+    assert should_forward(argv) == expected
+
+
+def test_should_forward_disabled(monkeypatch):
+    monkeypatch.setenv(NO_DAEMON_ENV, "1")
+    assert not should_forward(["query", "acc", "123"])
+
+
+def echo_command(argv):
+    """Writes arguments to stdout and stdin to stderr. Exits with number of args.
+    'wait <path>' waits until path exists
+    """
+    print(" ".join(argv))
+    sys.stderr.write(sys.stdin.read())
+    if argv == ["crash"]:
+        raise ValueError("crashed")
+    if argv[0] == "wait":
+        wait_for(lambda: os.path.exists(argv[1]))
+    return len(argv)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def a_daemon(tmp_path):
+    """A daemon running echo_command in a separate process. Not in a thread of
+    this process, as the daemon redirects sys.stdout and sys.stderr while running
+    a command, which would catch output the client writes at the same time
+    """
+    daemon = TrolleyDaemon(
+        run_command=echo_command,
+        socket_path=tmp_path / "daemon.sock",
+        poll_interval=0.05,
+    )
+    process = multiprocessing.get_context("fork").Process(target=daemon.serve)
+    process.start()
+    for _ in range(500):  # until listening
+        connection = connect(daemon.socket_path)
+        if connection:
+            connection.close()
+            break
+        time.sleep(0.01)
+    yield daemon
+    send_request({"action": "stop"}, socket_path=daemon.socket_path)
+    process.join()
+
+
+def test_daemon_forward(a_daemon, capsys, monkeypatch):
+    """Output and exit code of the command should come back to the client"""
+    assert forward(["query", "acc", "1"], socket_path=a_daemon.socket_path) == 3
+    assert capsys.readouterr().out == "query acc 1\n"
+
+    monkeypatch.setattr("sys.stdin.read", lambda: "from stdin\n")
+    assert forward(["-"], socket_path=a_daemon.socket_path) == 1
+    assert capsys.readouterr().err == "from stdin\n"
+
+    assert forward(["crash"], socket_path=a_daemon.socket_path) == 1
+    assert "ValueError: crashed" in capsys.readouterr().err
+    send_request({"action": "status"}, socket_path=a_daemon.socket_path)
+    assert "commands run  : 3" in capsys.readouterr().out
+
+
+def is_busy(daemon, capsys) -> bool:
+    send_request({"action": "status"}, socket_path=daemon.socket_path)
+    return "busy          : yes" in capsys.readouterr().out
+
+
+@pytest.fixture
+def a_busy_daemon(a_daemon, tmp_path, capsys):
+    """A daemon running a command that waits until the test is done"""
+    done = tmp_path / "done"
+    waiting = threading.Thread(
+        target=forward, args=(["wait", str(done)], a_daemon.socket_path)
+    )
+    waiting.start()
+    wait_for(lambda: is_busy(a_daemon, capsys))  # status is answered while busy
+    yield a_daemon
+    done.touch()
+    waiting.join()
+
+
+def test_daemon_busy(a_busy_daemon, capsys, monkeypatch):
+    """Commands sent while another one runs are left to the client"""
+    monkeypatch.setattr("sys.stdin", StringIO("from stdin\n"))
+    assert forward(["-"], socket_path=a_busy_daemon.socket_path) is None
+    assert sys.stdin.read() == "from stdin\n"  # still there for the local command
+    assert capsys.readouterr().err == ""
+
+
+def test_daemon_not_busy_after_command(a_busy_daemon, tmp_path, capsys):
+    (tmp_path / "done").touch()
+    wait_for(lambda: not is_busy(a_busy_daemon, capsys))
+    assert forward(["query"], socket_path=a_busy_daemon.socket_path) == 1
+
+
+def test_launcher_busy_daemon(a_busy_daemon, monkeypatch):
+    """When the daemon is busy, trolley runs the command itself"""
+    monkeypatch.setenv(SOCKET_PATH_ENV, str(a_busy_daemon.socket_path))
+    monkeypatch.setattr("sys.argv", ["trolley", "query", "acc", "123"])
+    run_here = Mock()
+    monkeypatch.setattr("dicomtrolleytool.cli.entrypoint.main", run_here)
+    launcher.main()
+    run_here.assert_called_once()
+
+
+def test_daemon_stop(a_daemon, tmp_path):
+    with pytest.raises(DaemonError):  # only one daemon per socket
+        TrolleyDaemon(echo_command, socket_path=a_daemon.socket_path).bind()
+
+    assert send_request({"action": "stop"}, socket_path=a_daemon.socket_path) == 0
+    for _ in range(100):  # daemon removes socket when done
+        if not a_daemon.socket_path.exists():
+            break
+        time.sleep(0.01)
+    assert not a_daemon.socket_path.exists()
+    assert forward(["query"], socket_path=a_daemon.socket_path) is None
+
+
+def test_daemon_idle_timeout(tmp_path):
+    daemon = TrolleyDaemon(
+        echo_command,
+        socket_path=tmp_path / "daemon.sock",
+        idle_timeout=0.1,
+        poll_interval=0.05,
+    )
+    daemon.serve()  # returns by itself
+    assert not daemon.socket_path.exists()
+
+
+def test_context_fork():
+    """Forked context shares sessions, but not changes made by a command"""
+    channel = DICOMWebChannelFactory()
+    context = TrolleyToolContext(
+        settings=TrolleyToolSettingsFactory(session_cache=False),
+        searcher_channel=channel,
+    )
+    session = context.get_session(channel)
+
+    forked = context.fork()
+    forked.override_settings(http_chunk_size=1024)
+    assert forked.get_session(channel) is session
+    assert context.settings.http_chunk_size is None
+
+
+def test_context_reload_changed_settings(tmp_path):
+    """A daemon should notice settings changed by commands it did not run"""
+    settings_path = tmp_path / "settings.json"
+    settings = TrolleyToolSettingsFactory(session_cache=False)
+    settings_path.write_text(settings.model_dump_json())
+    channel = DICOMWebChannelFactory()
+    context = TrolleyToolContext(settings_path=settings_path)
+    assert context.settings.searcher_name == "a_searcher"
+    session = context.get_session(channel)
+    assert not context.reload_if_settings_changed()
+
+    settings_path.write_text(
+        TrolleyToolSettingsFactory(
+            searcher_name="other_searcher", session_cache=False
+        ).model_dump_json()
+    )
+    mtime = settings_path.stat().st_mtime + 1  # in case file time is coarse
+    os.utime(settings_path, (mtime, mtime))
+    assert run_command(context, ["channel", "list"]) == 0
+    assert context.settings.searcher_name == "other_searcher"
+    assert context.get_session(channel) is not session
@@ -0,0 +1,139 @@
+from unittest.mock import Mock
+
+import pytest
+import requests
+from dicomtrolley.core import InstanceReference, Study
+from dicomtrolley.dicom_qr import DICOMQR
+from dicomtrolley.exceptions import DICOMTrolleyError
+from dicomtrolley.trolley import Trolley
+
+from dicomtrolleytool.download import BatchDownloader
+from dicomtrolleytool.journal import DownloadJournal
+from tests.conftest import create_c_find_image_response, quick_dataset
+
+
+class FakeTrolley:
+    """Finds and 'downloads' studies from memory. Can be made to fail halfway"""
+
+    def __init__(self, studies):
+        self.studies = {x.uid: x for x in studies}
+        self.storage = Mock()
+        self.fail_after = None  # raise exception after this many datasets
+        self.error: Exception = DICOMTrolleyError("Connection lost")
+        self.fetched = []
+
+    def find_study(self, query):
+        try:
+            return self.studies[query.StudyInstanceUID]
+        except KeyError as e:
+            raise DICOMTrolleyError(f"not found {e}") from e
+
+    def obtain_references(self, objects, max_level):
+        return [x.reference() for obj in objects for x in obj.all_instances()]
+
+    def fetch_all_datasets(self, objects):
+        for obj in objects:
+            refs = obj.all_instances() if isinstance(obj, Study) else [obj]
+            for ref in refs:
+                if isinstance(ref, InstanceReference):
+                    uids = ref.study_uid, ref.series_uid, ref.instance_uid
+                else:
+                    uids = ref.parent.parent.uid, ref.parent.uid, ref.uid
+                if self.fail_after is not None and len(self.fetched) >= self.fail_after:
+                    raise self.error
+                self.fetched.append(uids[2])
+                yield quick_dataset(
+                    StudyInstanceUID=uids[0],
+                    SeriesInstanceUID=uids[1],
+                    SOPInstanceUID=uids[2],
+                )
+
+
+@pytest.fixture
+def a_fake_trolley():
+    studies = []
+    for study_idx in range(3):
+        studies += DICOMQR.parse_c_find_response(
+            create_c_find_image_response(
+                study_instance_uid=f"{study_idx}",
+                series_instance_uids=[f"{study_idx}.1"],
+                sop_class_uids=[f"{study_idx}.1.{x}" for x in range(4)],
+            )
+        )
+    trolley = FakeTrolley(studies)
+    return trolley
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_batch_download(a_fake_trolley, tmp_path, workers):
+    """All found studies should be downloaded, missing ones reported"""
+    downloader = BatchDownloader(
+        trolley=a_fake_trolley,
+        output_dir=tmp_path,
+        search_workers=workers,
+        download_workers=workers,
+    )
+    report = downloader.download(["0", "1", "unknown", "2"])
+
+    assert report.requested == 4
+    assert report.downloaded == 3
+    assert report.not_found == 1
+    assert report.instances == 12
+    assert a_fake_trolley.storage.save.call_count == 12
+    assert "Downloaded        : 3" in report.summary()
+
+
+def test_batch_download_resume(a_fake_trolley, tmp_path):
+    """An interrupted download should continue where it left off"""
+    journal_path = tmp_path / "journal.jsonl"
+    a_fake_trolley.fail_after = 6  # fails halfway through the second study
+
+    with DownloadJournal(journal_path) as journal:
+        report = BatchDownloader(
+            trolley=a_fake_trolley,
+            output_dir=tmp_path,
+            journal=journal,
+            download_workers=1,  # one study after the other, for predictable failure
+        ).download(["0", "1", "2"])
+    assert report.downloaded == 1
+    assert report.failed == 2
+
+    a_fake_trolley.fail_after = None
+    a_fake_trolley.fetched = []
+    with DownloadJournal(journal_path) as journal:
+        report = BatchDownloader(
+            trolley=a_fake_trolley, output_dir=tmp_path, journal=journal
+        ).download(["0", "1", "2"])
+
+    assert report.skipped == 1
+    assert report.downloaded == 2
+    # only the instances not downloaded before
+    assert set(a_fake_trolley.fetched) == {"1.1.2", "1.1.3"} | {
+        f"2.1.{x}" for x in range(4)
+    }
+
+
+def test_batch_download_connection_error(a_fake_trolley, tmp_path):
+    """Errors that are not from dicomtrolley should not stop the batch either"""
+    a_fake_trolley.fail_after = 4  # fails at the start of the second study
+    a_fake_trolley.error = requests.ConnectionError("Connection reset by peer")
+    report = BatchDownloader(
+        trolley=a_fake_trolley, output_dir=tmp_path, download_workers=1
+    ).download(["0", "1", "2"])
+
+    assert report.downloaded == 1
+    assert report.failed == 2
+    assert report.errors == {
+        "1": "Connection reset by peer",
+        "2": "Connection reset by peer",
+    }
+    assert "Failed 1: Connection reset by peer" in report.summary()
+
+
+def test_batch_download_mock_trolley(a_study_level_study, tmp_path):
+    """Should work with a real trolley interface"""
+    trolley = Mock(spec_set=Trolley)
+    trolley.find_study = Mock(return_value=a_study_level_study[0])
+    trolley.fetch_all_datasets = Mock(return_value=[])
+    report = BatchDownloader(trolley=trolley, output_dir=tmp_path).download(["1"])
+    assert report.downloaded == 1
@@ -0,0 +1,123 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock
+
+import pytest
+from dicomtrolley.core import Query, Searcher
+from dicomtrolley.dicom_qr import DICOMQR
+
+from dicomtrolleytool.federation import (
+    FederatedSearcher,
+    FederatedSearchError,
+    FederationMode,
+    get_source_channels,
+    get_unanswered_channels,
+    is_partial,
+)
+from dicomtrolleytool.serialization import study_from_dict, study_to_dict
+from tests.conftest import create_c_find_image_response
+
+
+def a_searcher(*studies):
+    """Searcher that returns studies given as (study uid, [series uids])"""
+    searcher = Mock(spec=Searcher)
+    searcher.find_studies = Mock(
+        side_effect=lambda query: [
+            DICOMQR.parse_c_find_response(
+                create_c_find_image_response(uid, series, ["Instance1"])
+            )[0]
+            for uid, series in studies
+        ]
+    )
+    return searcher
+
+
+def a_blocking_searcher(release: threading.Event):
+    """Searcher that does not answer until release is set"""
+    searcher = Mock(spec=Searcher)
+    searcher.find_studies = Mock(side_effect=lambda query: release.wait() and [])
+    return searcher
+
+
+@pytest.fixture
+def release():
+    event = threading.Event()
+    yield event
+    event.set()  # let any blocked searcher threads finish
+
+
+def test_federated_merge():
+    """Studies found on several channels are merged and tagged with all of them"""
+    searcher = FederatedSearcher(
+        {
+            "vna": a_searcher(("Study1", ["Series1"])),
+            "pacs": a_searcher(("Study1", ["Series1", "Series2"]), ("Study2", ["S3"])),
+        }
+    )
+    studies = searcher.find_studies(Query())
+
+    assert [x.uid for x in studies] == ["Study1", "Study2"]
+    assert [x.uid for x in studies[0].series] == ["Series1", "Series2"]
+    assert studies[0].series[1].parent is studies[0]
+    assert get_source_channels(studies[0]) == ["vna", "pacs"]
+    assert get_source_channels(studies[1]) == ["pacs"]
+    assert not any(is_partial(x) for x in studies)
+
+    # source survives serialization, as used by cache and journal
+    restored = study_from_dict(study_to_dict(studies[0]))
+    assert get_source_channels(restored) == ["vna", "pacs"]
+
+
+def test_federated_first_hit(release):
+    """In FIRST mode, slow channels are not waited for once something is found"""
+    searcher = FederatedSearcher(
+        {"slow": a_blocking_searcher(release), "fast": a_searcher(("Study1", ["S1"]))},
+        mode=FederationMode.FIRST,
+    )
+    studies = searcher.find_studies(Query())
+    assert get_source_channels(studies[0]) == ["fast"]
+
+
+def test_federated_timeout(release):
+    """A channel that times out or fails is skipped. If nothing was found, that
+    is an error
+    """
+    failing = Mock(spec=Searcher)
+    failing.find_studies = Mock(side_effect=ValueError("down"))
+    searcher = FederatedSearcher(
+        {
+            "slow": a_blocking_searcher(release),
+            "broken": failing,
+            "fast": a_searcher(("Study1", ["S1"])),
+        },
+        timeouts={"slow": 0.05},
+    )
+    studies = searcher.find_studies(Query())
+    assert [x.uid for x in studies] == ["Study1"]
+    # the skipped channels might have had more
+    assert get_unanswered_channels(studies[0]) == ["broken", "slow"]
+    assert is_partial(study_from_dict(study_to_dict(studies[0])))
+
+    searcher.searchers["fast"] = a_searcher()
+    with pytest.raises(FederatedSearchError) as e:
+        searcher.find_studies(Query())
+    assert "'slow' timed out" in str(e.value)
+    assert "'broken' failed" in str(e.value)
+
+
+def test_federated_executors(release):
+    """Queries per channel are limited by its executor. A query that times out
+    before it started is not run at all
+    """
+    slow = a_blocking_searcher(release)
+    executor = ThreadPoolExecutor(max_workers=1)
+    searcher = FederatedSearcher(
+        {"slow": slow, "fast": a_searcher(("Study1", ["S1"]))},
+        timeouts={"slow": 0.05},
+        executors={"slow": executor},
+    )
+    searcher.find_studies(Query())  # keeps the only worker of slow busy
+    searcher.find_studies(Query())  # waits for that worker, then times out
+    release.set()
+    executor.shutdown(wait=True)
+    assert slow.find_studies.call_count == 1
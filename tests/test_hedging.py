@@ -0,0 +1,158 @@
+import threading
+import time
+from unittest.mock import Mock
+
+import pytest
+from dicomtrolley.core import Downloader, NonSeriesParameterError, Query, Searcher
+from requests.exceptions import ConnectionError
+
+from dicomtrolleytool.channels import HedgePolicy
+from dicomtrolleytool.hedging import (
+    HedgeBudget,
+    HedgedDownloader,
+    HedgedSearcher,
+    Hedger,
+    LatencyTracker,
+)
+
+
+def test_latency_tracker(monkeypatch):
+    """Replicas are ranked by running score. New and stale replicas first"""
+    tracker = LatencyTracker(smoothing=0.5, stale_after=60)
+    for latency in (0.1, 0.3):
+        tracker.record("a", latency)
+    tracker.record("b", 0.1)
+    assert tracker.scores["a"] == pytest.approx(0.2)
+    assert tracker.ranked(["a", "b", "c"]) == ["c", "b", "a"]
+
+    tracker.record("b", 0.1, failed=True)  # failures count against a replica
+    assert tracker.ranked(["a", "b"]) == ["a", "b"]
+    tracker.record("f", 0.001, failed=True)  # failing fast does not make it fast
+    assert tracker.ranked(["f", "a"]) == ["a", "f"]
+
+    for latency in range(1, 101):
+        tracker.record("d", latency)
+    assert tracker.percentile("d", 95) == 95
+    assert tracker.percentile("e", 95) is None
+
+    now = time.monotonic()
+    monkeypatch.setattr("dicomtrolleytool.hedging.time.monotonic", lambda: now + 61)
+    assert tracker.ranked(["d", "a"]) == ["d", "a"]  # both stale. Keep order
+
+
+def test_hedge_budget():
+    budget = HedgeBudget(ratio=0.5)
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+
+def a_searcher(result=(), delay=0.0, error=None):
+    searcher = Mock(spec=Searcher)
+
+    def find_studies(query):
+        time.sleep(delay)
+        if error:
+            raise error
+        return list(result)
+
+    searcher.find_studies = Mock(side_effect=find_studies)
+    return searcher
+
+
+@pytest.fixture
+def release():
+    event = threading.Event()
+    yield event
+    event.set()
+
+
+def test_hedged_searcher(release):
+    """A replica that does not answer in time is hedged with the next one"""
+    slow = Mock(spec=Searcher, find_studies=Mock(side_effect=lambda q: release.wait()))
+    hedger = Hedger(HedgePolicy(initial_delay=0.02, max_hedge_ratio=1.0))
+    searcher = HedgedSearcher({"slow": slow, "fast": a_searcher(["study"])}, hedger)
+
+    assert searcher.find_studies(Query()) == ["study"]
+    assert hedger.hedged == 1
+    assert hedger.tracker.ranked(["slow", "fast"])[0] == "fast"
+
+
+def test_hedged_searcher_budget():
+    """Without budget, slow replicas are waited for instead of hedged"""
+    hedger = Hedger(HedgePolicy(initial_delay=0.01, max_hedge_ratio=0.0))
+    searcher = HedgedSearcher(
+        {"slow": a_searcher(["slow"], delay=0.05), "fast": a_searcher(["fast"])},
+        hedger,
+    )
+    assert searcher.find_studies(Query()) == ["slow"]
+    assert hedger.hedged == 0
+
+
+def test_hedged_searcher_failover():
+    """Failed queries go to the next replica. If all fail, the last error is
+    raised
+    """
+    hedger = Hedger(HedgePolicy(enabled=False))
+    searcher = HedgedSearcher(
+        {
+            "broken": a_searcher(error=ConnectionError("down")),
+            "ok": a_searcher(["ok"]),
+        },
+        hedger,
+    )
+    assert searcher.find_studies(Query()) == ["ok"]
+
+    searcher.replicas["ok"] = a_searcher(error=ConnectionError("also down"))
+    with pytest.raises(ConnectionError, match="down"):
+        searcher.find_studies(Query())
+
+
+@pytest.mark.parametrize(
+    "error, is_retryable",
+    [
+        (ValueError("bad query"), None),
+        (NonSeriesParameterError("need series"), lambda e: True),
+    ],
+)
+def test_hedged_searcher_no_failover(error, is_retryable):
+    """Errors that are not retryable, or that ask for more detailed objects, are
+    raised right away and do not count against the replica
+    """
+    hedger = Hedger(HedgePolicy(enabled=False), is_retryable=is_retryable)
+    other = a_searcher(["ok"])
+    searcher = HedgedSearcher(
+        {"first": a_searcher(error=error), "other": other}, hedger
+    )
+    with pytest.raises(type(error)):
+        searcher.find_studies(Query())
+    other.find_studies.assert_not_called()
+    assert "first" not in hedger.tracker.scores
+
+
+def test_hedge_delay_from_start():
+    """Time waiting for a free worker does not count towards the hedge delay"""
+    hedger = Hedger(HedgePolicy(initial_delay=0.1, max_hedge_ratio=1.0), max_workers=1)
+    hedger.executor.submit(time.sleep, 0.2)  # keeps the only worker busy
+    searcher = HedgedSearcher(
+        {"first": a_searcher(["first"], delay=0.05), "second": a_searcher(["second"])},
+        hedger,
+    )
+    assert searcher.find_studies(Query()) == ["first"]
+    assert hedger.hedged == 0
+
+
+def test_hedged_downloader():
+    """Streamed downloads are not hedged, but go to the next replica on failure"""
+    broken = Mock(spec=Downloader, datasets=Mock(side_effect=ConnectionError("down")))
+    working = Mock(spec=Downloader, datasets=Mock(return_value=iter(["ds1", "ds2"])))
+    downloader = HedgedDownloader(
+        {"broken": broken, "working": working}, Hedger(HedgePolicy())
+    )
+    assert list(downloader.datasets([])) == ["ds1", "ds2"]
+    assert downloader.hedger.tracker.ranked(["broken", "working"]) == [
+        "working",
+        "broken",
+    ]
@@ -0,0 +1,28 @@
+from io import StringIO
+
+import pytest
+
+from dicomtrolleytool.identifiers import IdentifierReadError, chunks, read_identifiers
+
+
+def test_read_identifiers_lines():
+    stream = StringIO("123\n\n 456 \n789\n")
+    assert list(read_identifiers(stream)) == ["123", "456", "789"]
+
+
+def test_read_identifiers_column():
+    stream = StringIO("PatientID,AccessionNumber\np1,123\np2,\np3,456\n")
+    assert list(read_identifiers(stream, column="AccessionNumber")) == [
+        "123",
+        "456",
+    ]
+
+
+def test_read_identifiers_missing_column():
+    with pytest.raises(IdentifierReadError):
+        read_identifiers(StringIO("PatientID\np1\n"), column="AccessionNumber")
+
+
+def test_chunks():
+    assert list(chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(chunks([], 2)) == []
@@ -0,0 +1,153 @@
+from datetime import date, datetime, timedelta
+from unittest.mock import Mock
+
+import pytest
+from dicomtrolley.core import Query, Searcher
+from dicomtrolley.dicom_qr import DICOMQR
+from dicomtrolley.mint import MintQuery
+
+from dicomtrolleytool.index import (
+    IndexQueryError,
+    IndexSyncError,
+    IndexingSearcher,
+    LocalSearcher,
+    MetadataIndex,
+    sync_index,
+)
+from tests.conftest import quick_dataset
+
+
+@pytest.fixture
+def an_index(tmp_path):
+    return MetadataIndex(path=tmp_path / "index.sqlite")
+
+
+@pytest.fixture
+def some_studies():
+    """Two studies of different patients, on different dates"""
+    return DICOMQR.parse_c_find_response(
+        [
+            quick_dataset(
+                StudyInstanceUID="Study1",
+                AccessionNumber="acc1",
+                PatientID="patient1",
+                StudyDate="20230101",
+                ModalitiesInStudy=["CT", "MR"],
+            ),
+            quick_dataset(
+                StudyInstanceUID="Study2",
+                AccessionNumber="acc2",
+                PatientID="patient2",
+                StudyDate="20230601",
+                ModalitiesInStudy="US",
+            ),
+        ]
+    )
+
+
+@pytest.mark.parametrize(
+    "query, expected",
+    [
+        (Query(AccessionNumber="acc1"), ["Study1"]),
+        (Query(AccessionNumber="acc1,acc2"), ["Study1", "Study2"]),
+        (Query(PatientID="patient*"), ["Study1", "Study2"]),
+        (Query(StudyInstanceUID="Study2"), ["Study2"]),
+        (Query(ModalitiesInStudy="MR"), ["Study1"]),
+        (Query(min_study_date=datetime(2023, 3, 1)), ["Study2"]),
+        (Query(max_study_date=datetime(2023, 3, 1)), ["Study1"]),
+        (Query(AccessionNumber="unknown"), []),
+    ],
+)
+def test_index_find_studies(an_index, some_studies, query, expected):
+    an_index.add(some_studies, channel_key="channel1")
+    assert [x.uid for x in an_index.find_studies(query, "channel1")] == expected
+    assert an_index.find_studies(query, "other_channel") == []
+
+
+def test_index_levels(an_index, an_image_level_study):
+    """Objects are returned down to query level. Repeated adds merge"""
+    an_index.add(an_image_level_study, channel_key="channel1")
+    an_index.add(an_image_level_study, channel_key="channel1")
+    assert an_index.stats().instances == 18
+
+    study = an_index.find_studies(Query(StudyInstanceUID="Study1"), "channel1")[0]
+    assert not study.series
+
+    query = Query(StudyInstanceUID="Study1", query_level="SERIES")
+    study = an_index.find_studies(query, "channel1")[0]
+    assert [x.uid for x in study.series] == ["Series1", "Series2"]
+    assert not study.series[0].instances
+
+    query = Query(SeriesInstanceUID="Series2", query_level="INSTANCE")
+    study = an_index.find_studies(query, "channel1")[0]
+    assert [x.uid for x in study.series] == ["Series2"]
+    assert len(study.series[0].instances) == 9
+
+
+def test_index_merge(an_index):
+    """Elements from different queries on the same study add up"""
+    an_index.add(
+        DICOMQR.parse_c_find_response(
+            [quick_dataset(StudyInstanceUID="Study1", PatientID="patient1")]
+        ),
+        channel_key="channel1",
+    )
+    an_index.add(
+        DICOMQR.parse_c_find_response(
+            [quick_dataset(StudyInstanceUID="Study1", StudyDescription="head")]
+        ),
+        channel_key="channel1",
+    )
+    study = an_index.find_studies(Query(PatientID="patient1"), "channel1")[0]
+    assert study.data.StudyDescription == "head"
+
+
+def test_index_unsupported_query(an_index):
+    with pytest.raises(IndexQueryError):
+        an_index.find_studies(MintQuery(limit=5), "channel1")
+
+
+def test_indexing_and_local_searcher(an_index, some_studies):
+    """Results of any query end up in index and can be found offline"""
+    searcher = Mock(spec=Searcher)
+    searcher.find_studies = Mock(return_value=some_studies)
+    indexing = IndexingSearcher(searcher, index=an_index, channel_key="channel1")
+    indexing.find_studies(Query(PatientID="patient*"))
+
+    local = LocalSearcher(an_index, channel_key="channel1")
+    assert local.find_study(Query(AccessionNumber="acc2")).uid == "Study2"
+
+
+def test_sync_index(an_index, some_studies):
+    searcher = Mock(spec=Searcher)
+    searcher.find_studies = Mock(return_value=some_studies)
+    with pytest.raises(IndexSyncError):
+        sync_index(an_index, searcher, channel_key="channel1")
+
+    since = date.today() - timedelta(days=2)
+    assert sync_index(an_index, searcher, "channel1", since=since) == 6
+    assert an_index.get_last_sync("channel1") == date.today()
+    queries = [x[0][0] for x in searcher.find_studies.call_args_list]
+    assert [(x.min_study_date.date(), x.max_study_date.date()) for x in queries] == [
+        (since + timedelta(days=x), since + timedelta(days=x)) for x in range(3)
+    ]  # one day at a time
+
+    sync_index(an_index, searcher, channel_key="channel1")  # since last sync
+    query = searcher.find_studies.call_args[0][0]
+    assert query.min_study_date.date() == date.today()
+
+
+def test_sync_index_incomplete(an_index, some_studies):
+    """Days that were not fetched completely are fetched again next sync"""
+    since = date.today() - timedelta(days=3)
+    searcher = Mock(spec=Searcher)
+    searcher.find_studies = Mock(side_effect=[some_studies, [], ValueError("down")])
+    with pytest.raises(ValueError):
+        sync_index(an_index, searcher, "channel1", since=since)
+    assert an_index.get_last_sync("channel1") == since + timedelta(days=2)
+
+    # server returns at most 2 results, so the first day might miss some
+    searcher.find_studies = Mock(side_effect=[some_studies, [], [], []])
+    assert sync_index(an_index, searcher, "channel1", since=since, result_limit=2)
+    assert searcher.find_studies.call_count == 4  # still fetches other days
+    assert an_index.get_last_sync("channel1") == since
@@ -0,0 +1,118 @@
+from dicomtrolley.core import Query
+from dicomtrolley.exceptions import DICOMTrolleyError
+
+from dicomtrolleytool.federation import UNANSWERED_ELEMENT, add_channels
+from dicomtrolleytool.journal import DownloadJournal, Journal, QueryJournal
+from dicomtrolleytool.query import QueryErrorResult, QueryStudyResult
+from dicomtrolleytool.serialization import SerializationError
+
+
+def test_journal(tmp_path):
+    """Records should survive reopening. Incomplete lines should be skipped"""
+    path = tmp_path / "journal.jsonl"
+    with Journal(path) as journal:
+        journal.append({"a": 1})
+        journal.append({"b": 2})
+    with open(path, "a") as f:
+        f.write('{"c": ')  # interrupted while writing
+
+    assert list(Journal(path).records()) == [{"a": 1}, {"b": 2}]
+
+    Journal(path).clear()
+    assert list(Journal(path).records()) == []
+
+
+def test_download_journal(tmp_path):
+    """Finished studies and instances should be known after reopening"""
+    path = tmp_path / "journal.jsonl"
+    with DownloadJournal(path) as journal:
+        journal.mark_instance("study1", "instance1", size=10)
+        journal.mark_instance("study1", "instance2", size=10)
+        journal.mark_study("study1")
+        journal.mark_instance("study2", "instance3", size=10)
+
+    journal = DownloadJournal(path)
+    assert journal.is_study_finished("study1")
+    assert not journal.is_study_finished("study2")
+    assert journal.get_finished_instances("study2") == {"instance3"}
+    assert journal.get_finished_instances("study3") == set()
+
+
+def test_journal_torn_line(tmp_path):
+    """Appending after an interrupted write should not corrupt the next record"""
+    path = tmp_path / "journal.jsonl"
+    path.write_text('{"a": 1}\n{"b": ')
+    with Journal(path, sync_every=1) as journal:
+        journal.append({"c": 3})
+    assert list(Journal(path).records()) == [{"a": 1}, {"c": 3}]
+
+
+def test_query_journal(tmp_path, an_image_level_study):
+    """Results should be readable after reopening. Failed queries are not
+    finished
+    """
+    path = tmp_path / "job1.jsonl"
+    study = an_image_level_study[0]
+    with QueryJournal(path) as journal:
+        journal.mark_result("key1", QueryStudyResult(study, query=Query()))
+        journal.mark_result("key2", QueryErrorResult(DICOMTrolleyError("x"), Query()))
+
+    journal = QueryJournal(path)
+    assert journal.job_id == "job1"
+    assert journal.is_finished("key1")
+    assert not journal.is_finished("key2")
+    assert journal.failed == {"key2"}
+    result = journal.get_result("key1", query=Query())
+    assert result.content.uid == study.uid
+    assert [x.uid for x in result.content.series] == [x.uid for x in study.series]
+
+
+def test_query_journal_unserializable(tmp_path, a_study_level_study, monkeypatch):
+    """A study that cannot be stored should be recorded as failed, so that its
+    query runs again on resume
+    """
+
+    def fail(study):
+        raise SerializationError("Could not serialize dataset")
+
+    monkeypatch.setattr("dicomtrolleytool.serialization.study_to_dict", fail)
+    path = tmp_path / "job1.jsonl"
+    with QueryJournal(path) as journal:
+        journal.mark_result(
+            "key1", QueryStudyResult(a_study_level_study[0], query=Query())
+        )
+        assert journal.failed == {"key1"}
+
+    journal = QueryJournal(path)
+    assert not journal.is_finished("key1")
+    assert journal.failed == {"key1"}
+    assert "Could not serialize" in list(journal.records())[0]["error"]
+
+
+def test_query_journal_compact(tmp_path, a_study_level_study):
+    """Compacting keeps the latest record per query"""
+    path = tmp_path / "job1.jsonl"
+    study = a_study_level_study[0]
+    with QueryJournal(path) as journal:
+        journal.mark_result("key1", QueryErrorResult(DICOMTrolleyError("x"), Query()))
+        journal.mark_result("key1", QueryStudyResult(study, query=Query()))
+        journal.mark_result("key1", QueryStudyResult(study, query=Query()))
+        journal.mark_result("key2", QueryErrorResult(DICOMTrolleyError("x"), Query()))
+        journal.mark_result("key2", QueryErrorResult(DICOMTrolleyError("y"), Query()))
+        assert journal.compact() == (5, 2)
+
+    journal = QueryJournal(path)
+    assert journal.record_count == 2
+    assert journal.get_result("key1", query=Query()).content.uid == study.uid
+    assert journal.failed == {"key2"}
+
+
+def test_query_journal_partial(tmp_path, a_study_level_study):
+    """A federated result missing a channel is run again on resume"""
+    add_channels(a_study_level_study[0], UNANSWERED_ELEMENT, ["pacs"])
+    with QueryJournal(tmp_path / "job1.jsonl") as journal:
+        journal.mark_result(
+            "key1", QueryStudyResult(a_study_level_study[0], query=Query())
+        )
+        assert not journal.is_finished("key1")
+        assert "Not answered by: pacs" in list(journal.records())[0]["error"]
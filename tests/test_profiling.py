@@ -0,0 +1,131 @@
+import json
+from io import BytesIO, StringIO
+from unittest.mock import Mock, patch
+
+import pytest
+import requests
+from dicomtrolley.core import Downloader, Query, Searcher
+from pydicom import Dataset
+from requests.adapters import HTTPAdapter
+
+from dicomtrolleytool.profiling import (
+    Phase,
+    Profiler,
+    ProfilingDownloader,
+    ProfilingSearcher,
+    percentile,
+    profile_formatting,
+    profile_session,
+)
+from dicomtrolleytool.retry import RetryPolicy
+from dicomtrolleytool.wrappers import RetryingSearcher
+
+
+@pytest.mark.parametrize(
+    "values, percent, expected",
+    [([], 50, 0), ([1], 99, 1), ([1, 2, 3, 4], 50, 2), (list(range(1, 101)), 95, 95)],
+)
+def test_percentile(values, percent, expected):
+    assert percentile(values, percent) == expected
+
+
+def test_profiler_summary_and_export():
+    profiler = Profiler()
+    for duration in (0.1, 0.2, 0.3):
+        profiler.add(Phase.HTTP, "GET url", start=0, duration=duration, bytes=10)
+    profiler.add(Phase.QUERY, "query", start=0, duration=1)
+
+    http = profiler.summarize()[0]
+    assert (http.phase, http.count, http.bytes) == ("http", 3, 30)
+    assert http.p50 == 0.2
+    assert "p95 ms" in profiler.format_summary()
+
+    stream = StringIO()
+    profiler.write_trace(stream)
+    events = json.loads(stream.getvalue())["traceEvents"]
+    assert len(events) == 4
+    assert events[0]["ph"] == "X"
+
+
+def test_profiling_searcher(a_study_level_study):
+    profiler = Profiler()
+    searcher = Mock(spec=Searcher)
+    searcher.find_studies = Mock(return_value=a_study_level_study)
+    ProfilingSearcher(searcher, profiler).find_study(Query(AccessionNumber="1"))
+    assert [x.phase for x in profiler.spans] == [Phase.QUERY]
+
+
+def test_profile_session():
+    """Requests sent through session are recorded, including refused ones"""
+    profiler = Profiler()
+    session = requests.Session()
+    session.auth = Mock(login_url="https://server/login", side_effect=lambda r: r)
+    profile_session(session, profiler)
+
+    def a_response(*_, **__):
+        response = requests.Response()
+        response.status_code = 401
+        response.raw = BytesIO(b"refused, 401")
+        return response
+
+    with patch.object(HTTPAdapter, "send", side_effect=a_response):
+        session.get("https://server/studies")
+        session.post("https://server/login")
+
+    assert [x.phase for x in profiler.spans] == [Phase.HTTP, Phase.LOGIN]
+    assert profiler.spans[0].bytes == 12  # content as read, not as announced
+    assert profiler.summarize()[0].retries == 1
+
+
+def test_profile_streamed_download():
+    """Bytes of streamed and chunked responses are counted as they are read, per
+    request and per downloaded dataset
+    """
+    profiler = Profiler()
+    session = requests.Session()
+    profile_session(session, profiler)
+
+    def a_response(*_, **__):
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = BytesIO(b"x" * 1000)  # no Content-Length, like chunked
+        return response
+
+    def datasets(objects):
+        for _ in range(2):
+            response = session.get("https://server/wado", stream=True)
+            for _ in response.iter_content(chunk_size=100):
+                pass
+            yield Dataset()
+
+    downloader = Mock(spec=Downloader, datasets=datasets)
+    with patch.object(HTTPAdapter, "send", side_effect=a_response):
+        assert len(list(ProfilingDownloader(downloader, profiler).datasets([]))) == 2
+
+    assert [x.bytes for x in profiler.spans if x.phase == Phase.HTTP] == [1000, 1000]
+    assert [x.bytes for x in profiler.spans if x.phase == Phase.DOWNLOAD] == [
+        1000,
+        1000,
+    ]
+
+
+def test_profile_retries(a_study_level_study):
+    """Retries are recorded with the time waited before them"""
+    profiler = Profiler()
+    searcher = Mock(spec=Searcher)
+    searcher.find_studies = Mock(
+        side_effect=[requests.ConnectionError("reset"), a_study_level_study]
+    )
+    policy = RetryPolicy(max_attempts=2, backoff=0.0, jitter=False)
+    RetryingSearcher(searcher, policy=policy, profiler=profiler).find_studies(Query())
+
+    retry = [x for x in profiler.summarize() if x.phase == Phase.RETRY][0]
+    assert (retry.count, retry.retries) == (1, 1)
+
+
+def test_profile_formatting():
+    """Time waiting for results is not counted as formatting"""
+    profiler = Profiler()
+    with profile_formatting(profiler, iter([1, 2, 3])) as results:
+        assert list(results) == [1, 2, 3]
+    assert [x.phase for x in profiler.spans] == [Phase.FORMAT]
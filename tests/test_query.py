@@ -1,16 +1,31 @@
+import asyncio
 from itertools import cycle
 from unittest.mock import Mock
 
 import pytest
-from dicomtrolley.core import Query
+from dicomtrolley.core import Instance, Query, QueryLevels, Searcher, Series, Study
+from dicomtrolley.dicom_qr import DICOMQR
 from dicomtrolley.exceptions import DICOMTrolleyError
 from dicomtrolley.trolley import Trolley
+from pydicom import Dataset
 
+from dicomtrolleytool.journal import QueryJournal
 from dicomtrolleytool.query import (
+    QueryBatch,
     QueryErrorResult,
+    QueryExpander,
+    QueryPlanner,
     QueryStudyResult,
     collect_query_results,
+    collect_query_results_async,
+    iter_checkpointed_results,
+    iter_query_results,
+    iter_stored_or_run,
+    retry_failed_queries,
+    run_batch,
+    split_include_fields,
 )
+from tests.conftest import create_c_find_study_response
 
 
 def test_query_result(an_image_level_study):
@@ -38,3 +53,313 @@ def test_collect_query_results(a_trolley_with_errors):
     )
     assert not results[0].is_error()
     assert results[1].is_error()
+
+
+def test_collect_query_results_parallel(a_trolley_with_errors):
+    """Running in parallel should keep results in the same order as queries"""
+
+    def find_study(query):
+        if query.AccessionNumber == "2":
+            raise DICOMTrolleyError("BAD!")
+        return Mock(uid=query.AccessionNumber)
+
+    a_trolley_with_errors.find_study = Mock(side_effect=find_study)
+    queries = [Query(AccessionNumber=str(x)) for x in range(10)]
+    results = collect_query_results(a_trolley_with_errors, queries, max_workers=4)
+
+    assert [x.query for x in results] == queries
+    assert [x.is_error() for x in results].count(True) == 1
+    assert results[2].is_error()
+
+
+def test_collect_query_results_async(a_trolley_with_errors):
+    results = asyncio.run(
+        collect_query_results_async(
+            a_trolley_with_errors,
+            [Query(AccessionNumber="1"), Query(AccessionNumber="2")],
+            max_workers=2,
+        )
+    )
+    assert len(results) == 2
+    assert [x.is_error() for x in results].count(True) == 1
+
+
+@pytest.mark.parametrize("max_workers", [1, 3])
+def test_iter_query_results_lazy(a_trolley_with_errors, max_workers):
+    """Queries should only be taken from input when needed"""
+    taken = []
+
+    def queries():
+        for x in range(100):
+            taken.append(x)
+            yield Query(AccessionNumber=str(x))
+
+    results = iter_query_results(
+        a_trolley_with_errors, queries(), max_workers=max_workers
+    )
+    first = next(results)
+    assert first.query.AccessionNumber == "0"
+    assert len(taken) < 10
+    results.close()
+
+
+def test_query_planner():
+    """Only consecutive queries differing in a single batch field should be
+    combined, and batches should keep query order
+    """
+    planner = QueryPlanner(
+        batch_fields=["StudyInstanceUID", "AccessionNumber"], max_batch_size=2
+    )
+    queries = [
+        Query(AccessionNumber="1"),
+        Query(AccessionNumber="2"),
+        Query(AccessionNumber="3"),
+        Query(StudyInstanceUID="4"),
+        Query(AccessionNumber="5", PatientID="p"),
+        Query(AccessionNumber="6", PatientID="p"),
+        Query(PatientID="7"),
+    ]
+    batches = list(planner.plan(queries))
+    assert [
+        [x.AccessionNumber or x.StudyInstanceUID or x.PatientID for x in b.queries]
+        for b in batches
+    ] == [["1", "2"], ["3"], ["4"], ["5", "6"], ["7"]]
+    assert [x for b in batches for x in b.queries] == queries
+
+    combined = batches[0].to_query()
+    assert combined.AccessionNumber == "1,2"
+    assert batches[3].to_query().PatientID == "p"
+
+    # without batch fields, nothing is combined
+    assert all(len(x) == 1 for x in QueryPlanner().plan(queries))
+
+
+def test_query_batch_include_fields():
+    """Combined query should always return the batch field"""
+    batch = QueryBatch(
+        [
+            Query(AccessionNumber="1", include_fields=["PatientID"]),
+            Query(AccessionNumber="2", include_fields=["PatientID"]),
+        ],
+        field="AccessionNumber",
+        separator="\\",
+    )
+    query = batch.to_query()
+    assert query.AccessionNumber == "1\\2"
+    assert set(query.include_fields) == {"PatientID", "AccessionNumber"}
+
+
+def test_run_batch():
+    """Studies from a combined query should be assigned to the right query"""
+    studies = DICOMQR.parse_c_find_response(
+        create_c_find_study_response(study_instance_uids=["3", "1"])
+    )
+    trolley = Mock(spec_set=Trolley)
+    trolley.find_studies = Mock(return_value=studies)
+    batch = QueryBatch(
+        [Query(StudyInstanceUID=x) for x in ("1", "2", "3")], field="StudyInstanceUID"
+    )
+
+    results = run_batch(trolley, batch)
+    assert trolley.find_studies.call_count == 1
+    assert [x.query.StudyInstanceUID for x in results] == ["1", "2", "3"]
+    assert [x.is_error() for x in results] == [False, True, False]
+    assert results[0].content.uid == "1"
+    assert results[2].content.uid == "3"
+
+
+def test_run_batch_fallback(a_study_level_study):
+    """If a combined query fails, queries should be run separately"""
+    trolley = Mock(spec_set=Trolley)
+    trolley.find_studies = Mock(side_effect=DICOMTrolleyError("not supported"))
+    trolley.find_study = Mock(return_value=a_study_level_study[0])
+    batch = QueryBatch(
+        [Query(AccessionNumber=x) for x in ("1", "2")], field="AccessionNumber"
+    )
+
+    results = run_batch(trolley, batch)
+    assert trolley.find_study.call_count == 2
+    assert not any(x.is_error() for x in results)
+
+
+@pytest.mark.parametrize("max_workers", [1, 3])
+def test_iter_query_results_planner(a_study_level_study, max_workers):
+    """Using a planner should send fewer queries, but give one result per query"""
+    trolley = Mock(spec_set=Trolley)
+    trolley.find_studies = Mock(return_value=[])
+    trolley.find_study = Mock(return_value=a_study_level_study[0])
+    queries = [Query(AccessionNumber=str(x)) for x in range(10)]
+    planner = QueryPlanner(batch_fields=["AccessionNumber"], max_batch_size=4)
+
+    results = list(
+        iter_query_results(trolley, queries, max_workers=max_workers, planner=planner)
+    )
+    assert [x.query for x in results] == queries
+    assert trolley.find_studies.call_count == 3  # 4 + 4 + 2
+
+
+def test_retry_failed_queries(a_trolley_with_errors):
+    """Failed queries should be run once more, with their results at the end"""
+    queries = [Query(AccessionNumber=str(x)) for x in range(4)]
+    results = list(
+        retry_failed_queries(
+            a_trolley_with_errors, iter_query_results(a_trolley_with_errors, queries)
+        )
+    )
+    assert a_trolley_with_errors.find_study.call_count == 6  # 4 + 2 failed
+    assert [x.query.AccessionNumber for x in results] == ["0", "2", "1", "3"]
+    assert [x.is_error() for x in results] == [False, False, False, True]
+
+
+class LevelSearcher(Searcher):
+    """Answers queries from a dict of study uid -> series uid -> instance uids,
+    only as deep as the query level. Records all queries
+    """
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.queries = []
+
+    def find_studies(self, query):
+        self.queries.append(query)
+        studies = []
+        for study_uid, series in self.archive.items():
+            if query.StudyInstanceUID not in ("", study_uid):
+                continue
+            study = Study(uid=study_uid, data=Dataset(), series=[])
+            studies.append(study)
+            if query.query_level == QueryLevels.STUDY:
+                continue
+            for series_uid, instance_uids in series.items():
+                if query.SeriesInstanceUID not in ("", series_uid):
+                    continue
+                item = Series(
+                    uid=series_uid, data=Dataset(), instances=[], parent=study
+                )
+                study.series = list(study.series) + [item]
+                if query.query_level == QueryLevels.INSTANCE:
+                    item.instances = [
+                        Instance(uid=x, data=Dataset(), parent=item)
+                        for x in instance_uids
+                    ]
+        return studies
+
+
+def test_query_expander():
+    """Instance query is run as study, then series, then instance sub-queries and
+    merged into one tree
+    """
+    searcher = LevelSearcher(
+        {"1": {"1.1": ["1.1.1", "1.1.2"], "1.2": ["1.2.1"]}, "2": {"2.1": ["2.1.1"]}}
+    )
+    expander = QueryExpander(searcher, max_in_flight=2)
+    studies = expander.find_studies(
+        Query(
+            PatientID="patient",
+            query_level=QueryLevels.INSTANCE,
+            include_fields=["StudyDate", "SeriesDescription", "Rows", "ImageComments"],
+        )
+    )
+
+    assert [x.uid for x in studies[0].all_instances()] == ["1.1.1", "1.1.2", "1.2.1"]
+    assert all(x.root() is studies[0] for x in studies[0].all_instances())
+    assert [x.uid for x in studies[1].all_instances()] == ["2.1.1"]
+    assert [x.query_level for x in searcher.queries].count(QueryLevels.INSTANCE) == 3
+    assert searcher.queries[0].include_fields == ["StudyDate"]
+    assert all(x.PatientID == "patient" for x in searcher.queries)
+
+
+def test_query_expander_series_and_study_level():
+    searcher = LevelSearcher({"1": {"1.1": ["1.1.1"]}})
+    expander = QueryExpander(searcher)
+    study = expander.find_studies(Query(query_level=QueryLevels.SERIES))[0]
+    assert [x.uid for x in study.series] == ["1.1"]
+    assert not study.series[0].instances
+    assert len(searcher.queries) == 2
+
+    expander.find_studies(Query(query_level=QueryLevels.STUDY))
+    assert len(searcher.queries) == 3  # study level is passed on as is
+
+
+def test_query_expander_error():
+    """A failing sub-query fails the whole query"""
+    searcher = LevelSearcher({"1": {"1.1": ["1.1.1"]}})
+    searcher.find_studies = Mock(
+        side_effect=[searcher.find_studies(Query()), DICOMTrolleyError("failed")]
+    )
+    with pytest.raises(DICOMTrolleyError):
+        QueryExpander(searcher).find_studies(Query(query_level=QueryLevels.SERIES))
+
+
+def test_split_include_fields():
+    split = split_include_fields(
+        ["PatientID", "Modality", "SOPClassUID", "ImageComments"], QueryLevels.SERIES
+    )
+    assert split[QueryLevels.STUDY] == {"PatientID"}
+    assert split[QueryLevels.SERIES] == {"Modality", "ImageComments"}
+    assert split[QueryLevels.INSTANCE] == {"SOPClassUID"}
+
+
+def test_iter_checkpointed_results(a_trolley_with_errors, tmp_path):
+    """Resuming should only run queries that did not find a study before, and
+    still yield a result for every query
+    """
+    queries = [Query(AccessionNumber=str(x)) for x in range(4)]
+
+    def run(to_run):
+        return iter_query_results(a_trolley_with_errors, to_run)
+
+    with QueryJournal(tmp_path / "job.jsonl") as journal:
+        results = list(iter_checkpointed_results(journal, queries, run_queries=run))
+    assert [x.is_error() for x in results] == [False, True, False, True]
+
+    a_trolley_with_errors.find_study.reset_mock()
+    with QueryJournal(tmp_path / "job.jsonl") as journal:
+        results = list(iter_checkpointed_results(journal, queries, run_queries=run))
+    assert a_trolley_with_errors.find_study.call_count == 2  # only failed ones
+    assert [x.query.AccessionNumber for x in results] == ["0", "1", "2", "3"]
+    assert sum(x.is_error() for x in results) == 1  # one of the two failed again
+
+
+def test_iter_stored_or_run(an_image_level_study):
+    """Stored results are merged in query order with results that are run in
+    parallel
+    """
+    trolley = Mock(spec_set=Trolley)
+    trolley.find_study = Mock(return_value=an_image_level_study[0])
+    queries = [Query(AccessionNumber=str(x)) for x in range(20)]
+    ran = []
+
+    def get_stored(query):
+        if int(query.AccessionNumber) % 3:
+            return None
+        return QueryStudyResult(an_image_level_study[0], query=query)
+
+    results = iter_stored_or_run(
+        queries,
+        get_stored=get_stored,
+        run_queries=lambda x: iter_query_results(trolley, x, max_workers=4),
+        on_result=ran.append,
+    )
+    assert [x.query for x in results] == queries
+    assert len(ran) == trolley.find_study.call_count == 13
+
+
+def test_iter_stored_or_run_out_of_order(an_image_level_study):
+    """Results that run_queries yields late, like retried ones, do not hold up
+    stored results of later queries
+    """
+    queries = [Query(AccessionNumber=str(x)) for x in range(4)]
+
+    def get_stored(query):
+        if query.AccessionNumber in ("1", "3"):
+            return None
+        return QueryStudyResult(an_image_level_study[0], query=query)
+
+    def run_queries(to_run):  # 1 and 3, in reverse
+        return [QueryErrorResult(ValueError(), x) for x in reversed(list(to_run))]
+
+    results = iter_stored_or_run(
+        queries, get_stored=get_stored, run_queries=run_queries, on_result=Mock()
+    )
+    assert [x.query.AccessionNumber for x in results] == ["0", "2", "3", "1"]
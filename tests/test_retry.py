@@ -0,0 +1,124 @@
+from unittest.mock import Mock
+
+import pytest
+import requests
+from dicomtrolley.core import Query, Searcher
+from dicomtrolley.exceptions import DICOMTrolleyError
+
+from dicomtrolleytool.retry import (
+    AssociationError,
+    CircuitBreaker,
+    RetriesExhaustedError,
+    RetryableStatusError,
+    RetryPolicy,
+    raise_for_status_hook,
+)
+from dicomtrolleytool.wrappers import RetryingSearcher
+
+
+def test_retry_policy_delay():
+    """Backoff doubles each attempt, up to the maximum"""
+    policy = RetryPolicy(backoff=1, max_backoff=5, jitter=False)
+    assert [policy.delay(x) for x in (1, 2, 3, 4)] == [1, 2, 4, 5]
+    assert 0 <= RetryPolicy(backoff=1).delay(3) <= 4
+
+
+def caused_by(error: Exception, cause: Exception) -> Exception:
+    error.__cause__ = cause
+    return error
+
+
+@pytest.mark.parametrize(
+    "error, expected",
+    [
+        (RetryableStatusError("busy", status_code=503), True),
+        (RetryableStatusError("not here", status_code=404), False),
+        (requests.exceptions.ReadTimeout(), True),
+        (requests.exceptions.ConnectionError(), True),
+        (
+            caused_by(DICOMTrolleyError("stream broke"), requests.ConnectionError()),
+            True,
+        ),
+        (DICOMTrolleyError("Association rejected, aborted or never connected"), True),
+        (DICOMTrolleyError("Invalid query"), False),
+        (AssociationError("rejected"), True),
+        (ValueError(), False),
+    ],
+)
+def test_retry_policy_is_retryable(error, expected):
+    assert RetryPolicy().is_retryable(error) == expected
+
+
+def test_raise_for_status_hook():
+    hook = raise_for_status_hook([503])
+    assert hook(Mock(status_code=200))
+    with pytest.raises(RetryableStatusError) as e:
+        hook(Mock(status_code=503, url="https://server/mint", reason="Unavailable"))
+    assert e.value.status_code == 503
+
+
+@pytest.fixture
+def a_failing_searcher():
+    searcher = Mock(spec=Searcher)
+    searcher.find_studies = Mock(
+        side_effect=RetryableStatusError("busy", status_code=503)
+    )
+    return searcher
+
+
+def test_retrying_searcher(a_failing_searcher, a_study_level_study):
+    """Retryable errors are retried until the query succeeds"""
+    a_failing_searcher.find_studies.side_effect = [
+        RetryableStatusError("busy", status_code=503),
+        a_study_level_study,
+    ]
+    searcher = RetryingSearcher(a_failing_searcher, RetryPolicy(backoff=0))
+
+    assert searcher.find_studies(Query()) == a_study_level_study
+    assert a_failing_searcher.find_studies.call_count == 2
+
+
+def test_retrying_searcher_exhausted(a_failing_searcher):
+    """After max attempts the error says how many attempts were made"""
+    searcher = RetryingSearcher(
+        a_failing_searcher, RetryPolicy(max_attempts=3, backoff=0)
+    )
+    with pytest.raises(RetriesExhaustedError) as e:
+        searcher.find_studies(Query(AccessionNumber="1"))
+    assert e.value.attempts == 3
+    assert "after 3 attempt(s)" in str(e.value)
+    assert a_failing_searcher.find_studies.call_count == 3
+
+
+def test_retrying_searcher_not_retryable(a_failing_searcher):
+    a_failing_searcher.find_studies.side_effect = DICOMTrolleyError("Invalid query")
+    searcher = RetryingSearcher(a_failing_searcher, RetryPolicy(backoff=0))
+    with pytest.raises(DICOMTrolleyError):
+        searcher.find_studies(Query())
+    assert a_failing_searcher.find_studies.call_count == 1
+
+
+def test_circuit_breaker(monkeypatch):
+    """Breaker pauses once the failure rate over the window reaches threshold"""
+    sleep = Mock()
+    monkeypatch.setattr("dicomtrolleytool.retry.time.sleep", sleep)
+    breaker = CircuitBreaker(threshold=0.5, window=4, pause=10)
+
+    for success in (True, True, False):
+        breaker.record(success)
+    breaker.wait()
+    sleep.assert_not_called()
+
+    breaker.record(False)  # 2 out of 4 failed
+    assert breaker.trip_count == 1
+    breaker.wait()
+    assert 9 < sleep.call_args[0][0] <= 10
+
+
+def test_watch_session_twice():
+    """Watching a session again should not add a second hook"""
+    session = requests.Session()
+    RetryPolicy().watch_session(session)
+    RetryPolicy(retry_status_codes=[503]).watch_session(session)
+    assert len(session.hooks["response"]) == 1
+    assert session.hooks["response"][0].status_codes == [503]
@@ -0,0 +1,98 @@
+import stat
+from unittest.mock import Mock
+
+import pytest
+from requests import Session
+
+from dicomtrolleytool.sessions import SessionCache, TrackingVitreaAuth
+
+
+def create_session():
+    session = Session()
+    session.auth = TrackingVitreaAuth(
+        login_url="https://server/login", user="user", password="pass", realm="realm"
+    )
+    return session
+
+
+@pytest.fixture
+def a_session():
+    """A fresh session, not logged in"""
+    return create_session()
+
+
+@pytest.fixture
+def a_logged_in_session():
+    """A session that has logged in once and got a cookie"""
+    session = create_session()
+    session.cookies.set("JSESSIONID", "secret_id", domain="server", path="/")
+    session.auth.logins = 1
+    return session
+
+
+def test_session_cache_reuse(tmp_path, a_logged_in_session, a_session):
+    """Cookies should be reused by the next invocation, avoiding a login"""
+    path = tmp_path / "sessions.json"
+    first = SessionCache(path=path)
+    first.attach("channel1", a_logged_in_session)
+    first.save()
+    assert stat.S_IMODE(path.stat().st_mode) == 0o600
+
+    second = SessionCache(path=path)
+    second.attach("channel1", a_session)
+    assert a_session.cookies.get("JSESSIONID") == "secret_id"
+    second.save()
+
+    stats = second.stats()
+    assert stats.logins == 1
+    assert stats.logins_avoided == 1
+
+
+def test_session_cache_expired(tmp_path, a_logged_in_session, a_session):
+    path = tmp_path / "sessions.json"
+    first = SessionCache(path=path, max_age=0)
+    first.attach("channel1", a_logged_in_session)
+    first.save()
+
+    SessionCache(path=path).attach("channel1", a_session)
+    assert not a_session.cookies
+
+
+def test_session_cache_refresh(tmp_path, a_logged_in_session, a_session):
+    """Session about to expire should cause a login right away"""
+    path = tmp_path / "sessions.json"
+    first = SessionCache(path=path, max_age=30)
+    first.attach("channel1", a_logged_in_session)
+    first.save()
+
+    a_session.auth.login = Mock()
+    SessionCache(path=path, refresh_margin=60).attach("channel1", a_session)
+    a_session.auth.login.assert_called_once_with(a_session)
+
+
+def test_session_cache_clear(tmp_path, a_logged_in_session):
+    cache = SessionCache(path=tmp_path / "sessions.json")
+    cache.attach("channel1", a_logged_in_session)
+    cache.save()
+    cache.clear()
+    assert cache.stats().logins == 0
+
+
+def test_session_cache_save_twice(tmp_path, a_logged_in_session, a_session):
+    """Saving the same sessions again, as each command does in daemon mode, should
+    only add logins made since the last save
+    """
+    path = tmp_path / "sessions.json"
+    first = SessionCache(path=path)
+    first.attach("channel1", a_logged_in_session)
+    first.save()
+    first.save()
+    a_logged_in_session.auth.logins += 1
+    first.save()
+    assert first.stats().logins == 2
+
+    second = SessionCache(path=path)
+    second.attach("channel1", a_session)
+    second.save()
+    second.save()
+    assert second.stats().logins_avoided == 1
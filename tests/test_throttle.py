@@ -0,0 +1,160 @@
+import random
+from unittest.mock import Mock
+
+import pytest
+import requests
+from dicomtrolley.core import Query, Searcher
+from requests.adapters import BaseAdapter
+
+from dicomtrolleytool.retry import RetryableStatusError, RetryPolicy
+from dicomtrolleytool.throttle import (
+    AdaptiveConcurrencyLimit,
+    RateLimiter,
+    RateLimitingAdapter,
+    TokenBucket,
+    limit_session,
+)
+from dicomtrolleytool.wrappers import ThrottlingSearcher
+
+
+@pytest.fixture
+def mock_sleep(monkeypatch):
+    sleep = Mock()
+    monkeypatch.setattr("dicomtrolleytool.throttle.time.sleep", sleep)
+    return sleep
+
+
+def test_token_bucket(mock_sleep):
+    """Bursts up to capacity are free. After that, wait for tokens to refill"""
+    bucket = TokenBucket(rate=10, capacity=2)
+    bucket.take()
+    bucket.take()
+    mock_sleep.assert_not_called()
+    bucket.take()
+    assert 0.09 < mock_sleep.call_args[0][0] <= 0.1
+    bucket.take(10)  # more than capacity. Wait for all of it
+    assert 1.0 < mock_sleep.call_args[0][0] <= 1.1
+
+
+class ChunksAdapter(BaseAdapter):
+    """Answers every request with the same content, in chunks"""
+
+    def __init__(self, chunks):
+        super().__init__()
+        self.chunks = chunks
+
+    def send(self, request, *args, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = Mock(stream=lambda *args, **kwargs: iter(self.chunks))
+        return response
+
+    def close(self):
+        pass
+
+
+def test_limit_session():
+    """Each request waits for a request token and each chunk read for bytes"""
+    limiter = Mock(spec=RateLimiter, bytes=Mock())
+    session = requests.Session()
+    session.mount("https://", ChunksAdapter([b"abc", b"de"]))
+    limit_session(session, limiter)
+    assert isinstance(session.get_adapter("https://server"), RateLimitingAdapter)
+
+    assert session.get("https://server/qido").content == b"abcde"
+    limiter.wait_for_request.assert_called_once()
+    assert [x[0][0] for x in limiter.wait_for_bytes.call_args_list] == [3, 2]
+
+
+def test_adaptive_concurrency_increase():
+    """Limit grows while fully used and latency stays low, up to max"""
+    limit = AdaptiveConcurrencyLimit(max_limit=3)
+    for _ in range(10):
+        in_flight = limit.limit
+        for _ in range(in_flight):
+            limit.acquire()
+        for _ in range(in_flight):
+            limit.release(latency=0.1)
+    assert limit.limit == 3
+
+    unbounded = AdaptiveConcurrencyLimit(initial_limit=2)
+    for _ in range(10):
+        unbounded.acquire()  # never more than 1 in flight. Should not grow
+        unbounded.release(latency=0.1)
+    assert unbounded.limit == 2
+
+
+@pytest.mark.parametrize("latency, overloaded", [(0.5, False), (0.1, True)])
+def test_adaptive_concurrency_decrease(latency, overloaded):
+    """Limit halves when latency rises or the server signals overload"""
+    limit = AdaptiveConcurrencyLimit(initial_limit=8, latency_tolerance=2)
+    limit.acquire()
+    limit.release(latency=0.1)
+    limit.acquire()
+    limit.release(latency=latency, overloaded=overloaded)
+    assert limit.limit == 4
+    limit.acquire()  # requests sent before decrease do not decrease again
+    limit.release(latency=latency, overloaded=overloaded)
+    assert limit.limit == 4
+
+
+def run_rounds(limit, latency, rounds, monkeypatch):
+    """Send rounds of requests that use the whole limit, on a simulated clock.
+    latency(n) gives the latency of a request when n are in flight
+    """
+    clock = Mock(return_value=0.0)
+    monkeypatch.setattr("dicomtrolleytool.throttle.time", Mock(monotonic=clock))
+    limits = []
+    for _ in range(rounds):
+        in_flight = limit.limit
+        for _ in range(in_flight):
+            limit.acquire()
+        latencies = [latency(in_flight) for _ in range(in_flight)]
+        clock.return_value += max(latencies)
+        for x in latencies:
+            limit.release(latency=x)
+        limits.append(limit.limit)
+    return limits
+
+
+def test_adaptive_concurrency_mixed_latency(monkeypatch):
+    """Queries differ in cost. Without overload, the limit should still grow"""
+    randomness = random.Random(42)
+    limit = AdaptiveConcurrencyLimit(max_limit=8)
+    limits = run_rounds(
+        limit, lambda _: randomness.uniform(0.005, 0.05), 200, monkeypatch
+    )
+    assert sum(limits[-100:]) / 100 > 7
+
+    # server that handles 6 requests at a time. More have to wait
+    limit = AdaptiveConcurrencyLimit(max_limit=32)
+    limits = run_rounds(
+        limit,
+        lambda n: randomness.uniform(0.005, 0.05) * (1 if n <= 6 else 4),
+        200,
+        monkeypatch,
+    )
+    assert max(limits[-100:]) <= 7
+
+
+def test_throttling_searcher(a_study_level_study):
+    """Rate limit is taken for each query. Overload errors lower concurrency"""
+    searcher = Mock(spec=Searcher)
+    searcher.find_studies = Mock(
+        side_effect=[a_study_level_study, RetryableStatusError("busy", 503)]
+    )
+    rate_limiter = Mock(spec=RateLimiter)
+    concurrency = AdaptiveConcurrencyLimit(initial_limit=4)
+    throttling = ThrottlingSearcher(
+        searcher,
+        rate_limiter=rate_limiter,
+        concurrency=concurrency,
+        is_overload=RetryPolicy().is_retryable,
+    )
+
+    throttling.find_studies(Query())
+    with pytest.raises(RetryableStatusError):
+        throttling.find_studies(Query())
+    assert rate_limiter.wait_for_request.call_count == 2
+    assert concurrency.in_flight == 0
+    assert concurrency.limit == 2